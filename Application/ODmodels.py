@@ -1,4 +1,4 @@
-import random
+import random, threading
 from system_constants import *
 
 
@@ -23,18 +23,26 @@ class LocalConversation:
         self.model = model
         self.conversation_length = random.uniform(2, 6)
         self.in_progress = 1
-        self.bettor1.in_conversation = 1
-        self.bettor2.in_conversation = 1
+        self.set_in_conversation(1)
+
+    def set_in_conversation(self, in_conversation):
+        for bettor in [self.bettor1, self.bettor2]:
+            with bettor.opinion_lock:
+                bettor.in_conversation = in_conversation
 
     def change_local_opinions(self):
-        if self.model == 'BC':
-            self.bounded_confidence_step(mu, delta)
-        elif self.model == 'RA':
-            self.relative_agreement_step(mu)
-        elif self.model == 'RD':
-            self.relative_disagreement_step(mu, lmda)
-        else:
-            return print('OD model does not exist')
+        # both bettors are held, in order of ID, so neither agent's thread changes its local
+        # opinion between it being read here and the update being written back
+        first, second = sorted([self.bettor1, self.bettor2], key=lambda bettor: bettor.id)
+        with first.opinion_lock, second.opinion_lock:
+            if self.model == 'BC':
+                self.bounded_confidence_step(mu, delta)
+            elif self.model == 'RA':
+                self.relative_agreement_step(mu)
+            elif self.model == 'RD':
+                self.relative_disagreement_step(mu, lmda)
+            else:
+                return print('OD model does not exist')
 
     # # Opinion dynamics models
 
@@ -110,6 +118,9 @@ class OpinionDynamicsPlatform:
         self.model = model
         self.conversations = []
         self.number_of_conversations = 0
+        # every exchange thread drives the platform, so conversations and opinions are
+        # only changed by one of them at a time
+        self.lock = threading.Lock()
 
         self.all_influenced_by_opinions = [bettor for bettor in bettors if bettor.influenced_by_opinions == 1]
         self.all_opinionated = [bettor for bettor in bettors if bettor.opinionated == 1]
@@ -126,43 +137,46 @@ class OpinionDynamicsPlatform:
 
     def initiate_conversations(self, time):
 
-        for bettor in self.available_influenced_by_opinions:
+        with self.lock:
+            for bettor in self.available_influenced_by_opinions:
 
-            bettor1 = bettor
-            bettor2 = bettor
+                bettor1 = bettor
+                bettor2 = bettor
 
-            while bettor1 == bettor2:
-                if len(self.available_influenced_by_opinions) == 0 or len(self.available_opinionated) < 2:
-                    return
-                else:
-                    bettor2 = random.sample(self.available_opinionated, 1)[0]
+                while bettor1 == bettor2:
+                    if len(self.available_influenced_by_opinions) == 0 or len(self.available_opinionated) < 2:
+                        return
+                    else:
+                        bettor2 = random.sample(self.available_opinionated, 1)[0]
 
-            id = self.number_of_conversations
+                id = self.number_of_conversations
 
-            Conversation = LocalConversation(id, bettor1, bettor2, time, self.model)
+                Conversation = LocalConversation(id, bettor1, bettor2, time, self.model)
 
-            self.available_influenced_by_opinions = [bettor for bettor in self.all_influenced_by_opinions if
-                                                     bettor.in_conversation == 0]
-            self.available_opinionated = [bettor for bettor in self.all_opinionated if
-                                          bettor.in_conversation == 0]
+                self.available_influenced_by_opinions = [bettor for bettor in self.all_influenced_by_opinions if
+                                                         bettor.in_conversation == 0]
+                self.available_opinionated = [bettor for bettor in self.all_opinionated if
+                                              bettor.in_conversation == 0]
 
-            self.conversations.append(Conversation)
-            self.number_of_conversations = self.number_of_conversations + 1
+                self.conversations.append(Conversation)
+                self.number_of_conversations = self.number_of_conversations + 1
 
     def settle_opinions(self, winningCompetitor):
 
-        for bettor in self.all_influenced_by_opinions:
+        with self.lock:
+            for bettor in self.all_influenced_by_opinions:
+                with bettor.opinion_lock:
 
-            bettor.a3 = 1
-            bettor.a2 = 0
-            bettor.a1 = 0
+                    bettor.a3 = 1
+                    bettor.a2 = 0
+                    bettor.a1 = 0
 
-            if OPINION_COMPETITOR == winningCompetitor:
-                bettor.event_opinion = 1
-            else:
-                bettor.event_opinion = 0
+                    if OPINION_COMPETITOR == winningCompetitor:
+                        bettor.event_opinion = 1
+                    else:
+                        bettor.event_opinion = 0
 
-            bettor.opinion = bettor.a1 * bettor.local_opinion + bettor.a2 * bettor.global_opinion + bettor.a3 * bettor.event_opinion
+                    bettor.opinion = bettor.a1 * bettor.local_opinion + bettor.a2 * bettor.global_opinion + bettor.a3 * bettor.event_opinion
 
     def change_opinion(self, bettor, markets):
 
@@ -205,26 +219,27 @@ class OpinionDynamicsPlatform:
                          bettor.a2 * bettor.global_opinion + bettor.a3 * bettor.event_opinion
 
     def update_opinions(self, time, markets):
-        active_conversations = [c for c in self.conversations if c.in_progress == 1]
+        with self.lock:
+            active_conversations = [c for c in self.conversations if c.in_progress == 1]
 
-        # Update bettor local opinions (where conversation has reached an end)
-        for c in active_conversations:
+            # Update bettor local opinions (where conversation has reached an end)
+            for c in active_conversations:
 
-            if c.start_time + c.conversation_length <= time:
+                if c.start_time + c.conversation_length <= time:
 
-                c.change_local_opinions()
-                c.in_progress = 0
-                c.bettor1.in_conversation = 0
-                c.bettor2.in_conversation = 0
+                    c.change_local_opinions()
+                    c.in_progress = 0
+                    c.set_in_conversation(0)
 
-                self.available_influenced_by_opinions = [bettor for bettor in self.all_influenced_by_opinions if
-                                                         bettor.in_conversation == 0]
-                self.available_opinionated = [bettor for bettor in self.all_opinionated if
-                                              bettor.in_conversation == 0]
+                    self.available_influenced_by_opinions = [bettor for bettor in self.all_influenced_by_opinions if
+                                                             bettor.in_conversation == 0]
+                    self.available_opinionated = [bettor for bettor in self.all_opinionated if
+                                                  bettor.in_conversation == 0]
 
-            else:
-                continue
+                else:
+                    continue
 
-        # Update bettor global opinion, opinion weights, event opinion and finally calculate overall bettor opinion.
-        for bettor in self.all_influenced_by_opinions:
-            self.change_opinion(bettor, markets)
+            # Update bettor global opinion, opinion weights, event opinion and finally calculate overall bettor opinion.
+            for bettor in self.all_influenced_by_opinions:
+                with bettor.opinion_lock:
+                    self.change_opinion(bettor, markets)
@@ -2,6 +2,7 @@
 
 import sys, math, threading, time, queue, random, csv, config, pandas
 from copy import deepcopy
+from types import MappingProxyType
 
 from system_constants import *
 from betting_agents import *
@@ -9,6 +10,12 @@ import numpy as np
 from race_simulator import Simulator
 from ex_ante_odds_generator import *
 from exchange import Exchange
+from sharding import ShardedExchange
+from tape import TapeWriter, TapeChain
+from orderflow import OrderFlowRecorder
+from consolidated import ConsolidatedMarket, OrderRouter
+from positions import ExposureLedger
+from market_data import ConflatingQueue
 from message_protocols import *
 from session_stats import *
 from ODmodels import *
@@ -38,12 +45,14 @@ class Session:
         self.numberOfTimesteps = None
         self.lengthOfRace = None
         self.event = threading.Event()
+        self.orderFlowRecorder = None
         self.endOfInPlayBettingPeriod = None
         self.winningCompetitor = None
         self.distances = None
 
         # Record keeping attributes
-        self.tape = []
+        self.recordLock = threading.Lock()
+        self.tape = TapeChain()
         self.priceRecord = {}
         self.spreads = {}
         self.opinion_hist = {'id': [], 'time': [], 'opinion': [], 'competitor': []}
@@ -69,13 +78,30 @@ class Session:
         competitor_odds = {'time': [], 'odds': [], 'competitor': []}
 
         while self.event.isSet():
+            # sleep until orders arrive, waking now and then to notice the end of the event
+            try: orders = exchangeOrderQ.get(timeout=EXCHANGE_QUEUE_TIMEOUT)
+            except queue.Empty:
+                # no orders for a while, but resting orders may still have run out of time
+                timeInEvent = (time.time() - self.startTime) / SESSION_SPEED_MULTIPLIER
+                if exchange.expireOrders(timeInEvent) > 0:
+                    self.conflateMarkets(exchange.id, exchange.publishMarketState(timeInEvent))
+                continue
+            # None is put on the queue to wake the exchange at the end of the event
+            if orders is None: continue
+
+            # match everything that has queued up as one batch so markets are only
+            # published and opinions only updated once per batch
+            while True:
+                try: queued = exchangeOrderQ.get_nowait()
+                except queue.Empty: break
+                if queued is not None: orders = orders + queued
+
             timeInEvent = (time.time() - self.startTime) / SESSION_SPEED_MULTIPLIER
-            try: order = exchangeOrderQ.get(block=False)
-            except: continue
 
-            marketUpdates = {}
-            for i in range(NUM_OF_EXCHANGES):
-                marketUpdates[i] = self.exchanges[i].publishMarketState(timeInEvent)
+            if self.orderFlowRecorder is not None:
+                self.orderFlowRecorder.record(timeInEvent, orders)
+
+            marketUpdates = self.consolidatedMarket.refresh(timeInEvent)
 
             if timeInEvent < self.endOfInPlayBettingPeriod:
                 self.OpinionDynamicsPlatform.initiate_conversations(timeInEvent)
@@ -86,12 +112,27 @@ class Session:
 
 
 
-            (transactions, markets) = exchange.processOrder(timeInEvent, order)
+            (transactions, markets) = exchange.processOrders(timeInEvent, orders)
+            self.conflateMarkets(exchange.id, markets)
 
             if transactions != None:
-                for id, q in self.bettingAgentQs.items():
-                    update = exchangeUpdate(transactions, order, markets)
-                    q.put(update)
+                # fills only go to the backers and layers they concern, market state reaches
+                # agents through the consolidated view, or their conflating queue, instead
+                orders = tuple(orders)
+                for agentId, fills in fillsByAgent(transactions).items():
+                    q = self.bettingAgentQs.get(agentId)
+                    if q is not None:
+                        q.put(exchangeUpdate(fills, orders))
+
+
+    def conflateMarkets(self, exchangeId, markets):
+        """
+        Leave an exchange's latest market state on every betting agent's queue, in place
+        of any the agent has not read yet, if market data is conflated
+        """
+        if CONFLATE_MARKET_DATA:
+            for id, q in self.bettingAgentQs.items():
+                q.putMarkets(exchangeId, markets)
 
 
     def agentLogic(self, agent, agentQ):
@@ -123,62 +164,77 @@ class Session:
 
 
 
-            marketUpdates = {}
-            for i in range(NUM_OF_EXCHANGES):
-                marketUpdates[i] = self.exchanges[i].publishMarketState(timeInEvent)
+            # conflating agents act on the latest market state left on their queue
+            if CONFLATE_MARKET_DATA:
+                marketUpdates = agentQ.latestMarkets()
+            else:
+                marketUpdates = self.consolidatedMarket.refresh(timeInEvent)
 
             agent.respond(timeInEvent, marketUpdates, trade)
+            # collect every order the agent has ready so that bursts, such as one order
+            # per competitor, reach the exchange together as one batch
+            orders = []
             order = agent.getorder(timeInEvent, marketUpdates)
-
-
-            if agent.id == 0:
-                for i in range(NUM_OF_COMPETITORS):
-                    self.competitor_odds['time'].append(timeInEvent)
-                    self.competitor_odds['competitor'].append(i)
-                    if marketUpdates[0][i]['backs']['n'] > 0:
-                        self.competitor_odds['odds'].append(marketUpdates[0][i]['backs']['best'])
-                    else:
-                        self.competitor_odds['odds'].append(marketUpdates[0][i]['backs']['worst'])
-
-                    self.competitor_distances['competitor'].append(i)
-                    self.competitor_distances['time'].append(timeInEvent)
-                    if len(agent.currentRaceState) == 0:
-                        self.competitor_distances['distance'].append(0)
-                    else:
-                        self.competitor_distances['distance'].append(agent.currentRaceState[i])
-
-
-            self.opinion_hist['id'].append(agent.id)
-            self.opinion_hist['time'].append(timeInEvent)
-            self.opinion_hist['opinion'].append(agent.opinion)
-            self.opinion_hist['competitor'].append(OPINION_COMPETITOR)
-
-            self.opinion_hist_e['id'].append(agent.id)
-            self.opinion_hist_e['time'].append(timeInEvent)
-            self.opinion_hist_e['opinion'].append(agent.event_opinion)
-            self.opinion_hist_e['competitor'].append(OPINION_COMPETITOR)
-
-            self.opinion_hist_l['id'].append(agent.id)
-            self.opinion_hist_l['time'].append(timeInEvent)
-            self.opinion_hist_l['opinion'].append(agent.local_opinion)
-            self.opinion_hist_l['competitor'].append(OPINION_COMPETITOR)
-
-            self.opinion_hist_g['id'].append(agent.id)
-            self.opinion_hist_g['time'].append(timeInEvent)
-            self.opinion_hist_g['opinion'].append(agent.global_opinion)
-            self.opinion_hist_g['competitor'].append(OPINION_COMPETITOR)
-
-            self.opinion_hist_s['id'].append(agent.id)
-            self.opinion_hist_s['time'].append(timeInEvent)
-            self.opinion_hist_s['opinion'].append(agent.strategy_opinion)
-            self.opinion_hist_s['competitor'].append(OPINION_COMPETITOR)
-
-            if order != None:
-
-                if TBBE_VERBOSE:
-                    print(order)
-                agent.numOfBets = agent.numOfBets + 1
-                self.exchangeOrderQs[order.exchange].put(order)
+            while order != None:
+                orders.append(order)
+                order = agent.getorder(timeInEvent, marketUpdates)
+
+
+            # agent threads append to the same records, each row is written whole under the lock
+            with self.recordLock:
+                if agent.id == 0:
+                    for i in range(NUM_OF_COMPETITORS):
+                        self.competitor_odds['time'].append(timeInEvent)
+                        self.competitor_odds['competitor'].append(i)
+                        if marketUpdates[0][i]['backs']['n'] > 0:
+                            self.competitor_odds['odds'].append(marketUpdates[0][i]['backs']['best'])
+                        else:
+                            self.competitor_odds['odds'].append(marketUpdates[0][i]['backs']['worst'])
+
+                        self.competitor_distances['competitor'].append(i)
+                        self.competitor_distances['time'].append(timeInEvent)
+                        if len(agent.currentRaceState) == 0:
+                            self.competitor_distances['distance'].append(0)
+                        else:
+                            self.competitor_distances['distance'].append(agent.currentRaceState[i])
+
+
+                self.opinion_hist['id'].append(agent.id)
+                self.opinion_hist['time'].append(timeInEvent)
+                self.opinion_hist['opinion'].append(agent.opinion)
+                self.opinion_hist['competitor'].append(OPINION_COMPETITOR)
+
+                self.opinion_hist_e['id'].append(agent.id)
+                self.opinion_hist_e['time'].append(timeInEvent)
+                self.opinion_hist_e['opinion'].append(agent.event_opinion)
+                self.opinion_hist_e['competitor'].append(OPINION_COMPETITOR)
+
+                self.opinion_hist_l['id'].append(agent.id)
+                self.opinion_hist_l['time'].append(timeInEvent)
+                self.opinion_hist_l['opinion'].append(agent.local_opinion)
+                self.opinion_hist_l['competitor'].append(OPINION_COMPETITOR)
+
+                self.opinion_hist_g['id'].append(agent.id)
+                self.opinion_hist_g['time'].append(timeInEvent)
+                self.opinion_hist_g['opinion'].append(agent.global_opinion)
+                self.opinion_hist_g['competitor'].append(OPINION_COMPETITOR)
+
+                self.opinion_hist_s['id'].append(agent.id)
+                self.opinion_hist_s['time'].append(timeInEvent)
+                self.opinion_hist_s['opinion'].append(agent.strategy_opinion)
+                self.opinion_hist_s['competitor'].append(OPINION_COMPETITOR)
+
+            if len(orders) > 0:
+                batches = {}
+                for order in orders:
+                    if TBBE_VERBOSE:
+                        print(order)
+                    agent.numOfBets = agent.numOfBets + 1
+                    if self.orderRouter is not None:
+                        self.orderRouter.route(order)
+                    batches.setdefault(order.exchange, []).append(order)
+                for e, batch in batches.items():
+                    self.exchangeOrderQs[e].put(batch)
 
 
        # print("ENDING AGENT " + str(agent.id))
@@ -226,9 +282,20 @@ class Session:
         """
         Initialise exchanges, returns list of exchange objects
         """
+        # one ledger of every agent's liability shared by all exchanges, so an agent's balance
+        # covers its orders across all of them rather than on each one
+        self.exposure = ExposureLedger()
         for i in range(NUM_OF_EXCHANGES):
-            self.exchanges[i] = Exchange(i, NUM_OF_COMPETITORS) # NUM_OF_COMPETITORS may be changed to list of competitor objects that are participating
+            if EXCHANGE_SHARDS > 1:
+                self.exchanges[i] = ShardedExchange(i, NUM_OF_COMPETITORS, exposure=self.exposure)
+            else:
+                self.exchanges[i] = Exchange(i, NUM_OF_COMPETITORS, exposure=self.exposure) # NUM_OF_COMPETITORS may be changed to list of competitor objects that are participating
             self.exchangeOrderQs[i] = queue.Queue()
+        # best odds across all exchanges, and routing of orders to the best of them
+        self.consolidatedMarket = ConsolidatedMarket(self.exchanges)
+        self.orderRouter = None
+        if ORDER_ROUTING:
+            self.orderRouter = OrderRouter(self.consolidatedMarket)
 
     def initialiseBettingAgents(self):
         """
@@ -241,10 +308,19 @@ class Session:
         # Create threads for all betting agents that wait until event session
         # has started
         for id, agent in self.bettingAgents.items():
-            self.bettingAgentQs[id] = queue.Queue()
+            if CONFLATE_MARKET_DATA:
+                self.bettingAgentQs[id] = ConflatingQueue(id)
+                for exchangeId, exchange in self.exchanges.items():
+                    self.bettingAgentQs[id].putMarkets(exchangeId, exchange.publishMarketState(0))
+            else:
+                self.bettingAgentQs[id] = queue.Queue()
             thread = threading.Thread(target = self.agentLogic, args = [agent, self.bettingAgentQs[id]])
             self.bettingAgentThreads.append(thread)
 
+        # exchanges check the liability of every order against its agent's balance on entry
+        for id, agent in self.bettingAgents.items():
+            self.exposure.setBalance(id, agent.balance)
+
 
     def updateRaceQ(self, timestep):
         """
@@ -258,12 +334,26 @@ class Session:
         for c in range(NUM_OF_COMPETITORS):
             compDistances[c] = float(r[0][c+1])
 
-        # Create update
-        update = raceUpdate(time, compDistances)
+        # Create update, read only as every betting agent is sent the same one
+        update = raceUpdate(time, MappingProxyType(compDistances))
 
         for id, q in self.bettingAgentQs.items():
             q.put(update)
 
+        self.captureSnapshots(timestep)
+
+    def captureSnapshots(self, timestep):
+        """
+        Expire the orders good until a race timestep and record the top of book and
+        depth of every exchange at it
+        """
+        timeInEvent = (time.time() - self.startTime) / SESSION_SPEED_MULTIPLIER
+        if self.orderFlowRecorder is not None:
+            self.orderFlowRecorder.recordTimestep(timestep, timeInEvent)
+        for id, exchange in self.exchanges.items():
+            exchange.captureTimestep(timestep, timeInEvent)
+            self.conflateMarkets(id, exchange.snapshot)
+
     def preRaceBetPeriod(self):
         print("Start of pre-race betting period, lasting " + str(PRE_RACE_BETTING_PERIOD_LENGTH))
         time.sleep(PRE_RACE_BETTING_PERIOD_LENGTH / SESSION_SPEED_MULTIPLIER)
@@ -283,6 +373,12 @@ class Session:
         # Record start time
         self.startTime = time.time()
 
+        # Record the order flow into the exchanges so the session's matching can be replayed
+        if ORDER_FLOW_RECORDER:
+            self.orderFlowRecorder = OrderFlowRecorder(ORDER_FLOW_FILENAME % simulationId)
+            # replay checks orders against the same balances so it trims and rejects the same ones
+            self.orderFlowRecorder.recordBalances(self.exposure.balances)
+
         # Start exchange threads
         for id, exchange in self.exchanges.items():
             thread = threading.Thread(target = self.exchangeLogic, args = [exchange, self.exchangeOrderQs[id]])
@@ -291,6 +387,12 @@ class Session:
         for thread in self.exchangeThreads:
             thread.start()
 
+        # Stream tapes to this simulation's own file while the session runs
+        tapeWriter = None
+        if TAPE_WRITER:
+            tapeWriter = TapeWriter(list(self.exchanges.values()), TAPE_FILENAME % simulationId)
+            tapeWriter.start()
+
         # Start betting agent threads
         for thread in self.bettingAgentThreads:
             thread.start()
@@ -309,6 +411,8 @@ class Session:
         while(i < self.numberOfTimesteps):
             self.updateRaceQ(i+1)
             i = i+1
+            recordPrices(i, self.exchanges, self.priceRecord)
+            recordSpread(i, self.exchanges, self.spreads)
             if TBBE_VERBOSE: print(i)
             print(i)
             time.sleep(1 / SESSION_SPEED_MULTIPLIER)
@@ -319,6 +423,8 @@ class Session:
 
         # End event
         self.event.clear()
+        for id, q in self.exchangeOrderQs.items():
+            q.put(None)
 
         # Close threads
         for thread in self.exchangeThreads: thread.join()
@@ -327,15 +433,22 @@ class Session:
         print("Simulation complete")
 
         print("Writing data....")
+        if tapeWriter is not None:
+            tapeWriter.close()
+        if self.orderFlowRecorder is not None:
+            self.orderFlowRecorder.close()
+        if SNAPSHOT_HISTORY:
+            for id, ex in self.exchanges.items():
+                ex.snapshotRing.export(SNAPSHOT_HISTORY_FILENAME % simulationId, id, 'w' if id == min(self.exchanges) else 'a')
         for id, ex in self.exchanges.items():
             for orderbook in ex.compOrderbooks:
-                for trade in orderbook.tape:
-                    #print(trade)
-                    self.tape.append(trade)
+                self.tape.add(orderbook.tape)
 
         # Settle up all transactions over all exchanges
         for id, ex in self.exchanges.items():
             ex.settleUp(self.bettingAgents, self.winningCompetitor)
+            if EXCHANGE_SHARDS > 1:
+                ex.close()
 
         
                 
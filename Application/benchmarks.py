@@ -0,0 +1,417 @@
+### ~ THREADED BRISTOL BETTING EXCHANGE ~ ###
+
+# Microbenchmarks of the matching engine, driving an Exchange directly with synthetic
+# order flow and reporting throughput and latency percentiles as JSON, and how throughput
+# changes as the agents' work is spread over more agent threads feeding one exchange
+# thread, which can only use more than one core on free-threaded builds
+#
+# python benchmarks.py [output file]
+
+import sys, json, time, random, platform, threading, queue
+from collections import deque
+from exchange import Exchange
+from message_protocols import Order
+from consolidated import ConsolidatedMarket
+
+# book depth (price levels per side), number of agents, number of competitors and share
+# of the mixed order flow that crosses the spread
+DEPTHS = [10, 100, 1000]
+NUM_OF_AGENTS = [50, 500]
+NUMS_OF_COMPETITORS = [5, 20]
+CROSSING_RATIOS = [0.1, 0.5]
+# numbers of agent threads sending orders to the same exchange at once
+THREAD_COUNTS = [1, 2, 4]
+# recent implied probabilities a synthetic agent averages its view of each competitor over
+AGENT_HISTORY_LENGTH = 20
+
+OPERATIONS_PER_BENCHMARK = 1000
+# orders an agent may rest on each side of a book, as a market maker quoting a few levels,
+# so books deeper than the agents can fill overwrite orders and aggressors stop at their own
+ORDERS_PER_AGENT = 10
+SWEEP_LEVELS = 10
+BENCHMARK_OUTPUT_FILENAME = 'benchmark_results.json'
+
+
+class SyntheticBook:
+    """
+    Books of an exchange filled to a given depth, with one order per price level on
+    each side, lays between 1.1 and 2.0 and backs from 2.02 upwards. Agents may only
+    rest so many orders, so with too few agents for the depth some levels are
+    overwritten while the books are filled
+    """
+    def __init__(self, depth, numOfAgents, numOfCompetitors, seed=0, maxOrdersPerAgent=ORDERS_PER_AGENT):
+        self.depth = depth
+        self.numOfAgents = numOfAgents
+        self.numOfCompetitors = numOfCompetitors
+        self.random = random.Random(seed)
+        self.exchange = Exchange(0, numOfCompetitors, maxOrdersPerAgent=maxOrdersPerAgent)
+        # agent that sends the aggressive orders, only what is left of them rests
+        self.aggressor = numOfAgents
+        self.orderId = 0
+        self.time = 0
+        step = 0.9 / depth
+        self.layOdds = [round(2.0 - level * step, 6) for level in range(depth)]
+        self.backOdds = [round(2.02 + level * step * 10, 6) for level in range(depth)]
+        for competitor in range(numOfCompetitors):
+            for level in range(depth):
+                self.rest(competitor, 'Back', self.backOdds[level])
+                self.rest(competitor, 'Lay', self.layOdds[level])
+
+    def order(self, agentId, competitor, direction, odds, stake):
+        self.orderId = self.orderId + 1
+        self.time = self.time + 1
+        return Order(self.exchange.id, agentId, competitor, direction, odds, stake, self.orderId, self.time)
+
+    def rest(self, competitor, direction, odds, stake=10):
+        order = self.order(self.random.randrange(self.numOfAgents), competitor, direction, odds, stake)
+        self.exchange.processOrder(self.time, order)
+        return order
+
+    def restingOdds(self, direction, rnd=None):
+        # odds strictly inside the book on that side, so the order never crosses, from
+        # the book's own random numbers unless the caller has its own
+        if rnd is None:
+            rnd = self.random
+        if direction == 'Back':
+            return rnd.choice(self.backOdds)
+        return rnd.choice(self.layOdds)
+
+    def refill(self, transactions, competitor, direction):
+        # put back the orders taken by an aggressive order, on the opposite side to it
+        if transactions is None:
+            return
+        side = 'Lay' if direction == 'Back' else 'Back'
+        levels = {}
+        for transaction in transactions:
+            levels[transaction['odds']] = levels.get(transaction['odds'], 0) + transaction['stake']
+        for odds, stake in levels.items():
+            self.rest(competitor, side, odds, stake)
+
+
+def percentile(sortedSamples, fraction):
+    return sortedSamples[min(len(sortedSamples) - 1, int(fraction * len(sortedSamples)))]
+
+
+def summarise(samples, duration):
+    """
+    Throughput of the timed operations alone, the rate they went through over the
+    wall clock duration in seconds of the benchmark's whole loop, untimed setup and
+    clean-up included, and percentiles of a list of latencies in nanoseconds,
+    latencies reported in microseconds
+    """
+    timed = sum(samples) / 1e9
+    samples = sorted(samples)
+    return {'count': len(samples),
+            'ordersPerSecond': len(samples) / timed if timed > 0 else None,
+            'wallClockOrdersPerSecond': len(samples) / duration if duration > 0 else None,
+            'p50': percentile(samples, 0.5) / 1e3,
+            'p99': percentile(samples, 0.99) / 1e3,
+            'p999': percentile(samples, 0.999) / 1e3}
+
+
+def benchmarkAdd(book, operations):
+    """
+    Non-crossing orders rested inside the book, each taken off again untimed
+    """
+    samples = []
+    loopStart = time.perf_counter()
+    for i in range(operations):
+        competitor = book.random.randrange(book.numOfCompetitors)
+        direction = book.random.choice(['Back', 'Lay'])
+        order = book.order(book.random.randrange(book.numOfAgents), competitor, direction,
+                           book.restingOdds(direction), 10)
+        start = time.perf_counter_ns()
+        book.exchange.processOrder(book.time, order)
+        samples.append(time.perf_counter_ns() - start)
+        book.exchange.delOrder(book.time, order)
+    return samples, time.perf_counter() - loopStart
+
+
+def benchmarkCancel(book, operations):
+    """
+    Cancellations of orders rested inside the book untimed
+    """
+    samples = []
+    loopStart = time.perf_counter()
+    for i in range(operations):
+        competitor = book.random.randrange(book.numOfCompetitors)
+        direction = book.random.choice(['Back', 'Lay'])
+        order = book.rest(competitor, direction, book.restingOdds(direction))
+        start = time.perf_counter_ns()
+        book.exchange.delOrder(book.time, order)
+        samples.append(time.perf_counter_ns() - start)
+    return samples, time.perf_counter() - loopStart
+
+
+def benchmarkCross(book, operations):
+    """
+    Aggressive orders partly filling the order at the best odds, refilled untimed
+    """
+    samples = []
+    loopStart = time.perf_counter()
+    for i in range(operations):
+        competitor = book.random.randrange(book.numOfCompetitors)
+        direction = book.random.choice(['Back', 'Lay'])
+        orderbook = book.exchange.compOrderbooks[competitor]
+        odds = orderbook.lays.bestOdds if direction == 'Back' else orderbook.backs.bestOdds
+        order = book.order(book.aggressor, competitor, direction, odds, 1)
+        start = time.perf_counter_ns()
+        (transactions, markets) = book.exchange.processOrder(book.time, order)
+        samples.append(time.perf_counter_ns() - start)
+        book.refill(transactions, competitor, direction)
+    return samples, time.perf_counter() - loopStart
+
+
+def benchmarkSweep(book, operations, levels=SWEEP_LEVELS):
+    """
+    Aggressive orders taking every order on several price levels, refilled untimed
+    """
+    samples = []
+    loopStart = time.perf_counter()
+    levels = min(levels, book.depth)
+    for i in range(operations):
+        competitor = book.random.randrange(book.numOfCompetitors)
+        direction = book.random.choice(['Back', 'Lay'])
+        half = book.exchange.compOrderbooks[competitor].lays if direction == 'Back' else \
+            book.exchange.compOrderbooks[competitor].backs
+        # stake of every order on the best levels, and the odds of the last of them
+        stake = 0
+        seen = 0
+        odds = None
+        for levelOdds, entry in half.iterOrders():
+            if levelOdds != odds:
+                if seen == levels:
+                    break
+                seen = seen + 1
+                odds = levelOdds
+            stake = stake + entry[1]
+        order = book.order(book.aggressor, competitor, direction, odds, stake)
+        start = time.perf_counter_ns()
+        (transactions, markets) = book.exchange.processOrder(book.time, order)
+        samples.append(time.perf_counter_ns() - start)
+        book.refill(transactions, competitor, direction)
+    return samples, time.perf_counter() - loopStart
+
+
+def benchmarkFlow(book, operations, crossingRatio):
+    """
+    Mixed order flow, crossingRatio of the orders cross the best odds and the rest
+    rest inside the book, each resting order is cancelled untimed once 100 more
+    have arrived so the book keeps its depth
+    """
+    samples = []
+    loopStart = time.perf_counter()
+    resting = []
+    for i in range(operations):
+        competitor = book.random.randrange(book.numOfCompetitors)
+        direction = book.random.choice(['Back', 'Lay'])
+        orderbook = book.exchange.compOrderbooks[competitor]
+        if book.random.random() < crossingRatio:
+            odds = orderbook.lays.bestOdds if direction == 'Back' else orderbook.backs.bestOdds
+            order = book.order(book.aggressor, competitor, direction, odds, book.random.randint(1, 20))
+        else:
+            order = book.order(book.random.randrange(book.numOfAgents), competitor, direction,
+                               book.restingOdds(direction), 10)
+            resting.append(order)
+        start = time.perf_counter_ns()
+        (transactions, markets) = book.exchange.processOrder(book.time, order)
+        samples.append(time.perf_counter_ns() - start)
+        if len(resting) > 100:
+            book.exchange.delOrder(book.time, resting.pop(0))
+        if order.agentId == book.aggressor:
+            book.refill(transactions, competitor, direction)
+    return samples, time.perf_counter() - loopStart
+
+
+def benchmarkScenario(depth, numOfAgents, numOfCompetitors, crossingRatio, operations=OPERATIONS_PER_BENCHMARK):
+    """
+    Run every benchmark on freshly filled books, returns dictionary of scenario
+    parameters and the summary of each operation
+    """
+    results = {}
+    for name, benchmark in [('add', benchmarkAdd), ('cancel', benchmarkCancel),
+                            ('cross', benchmarkCross), ('sweep', benchmarkSweep)]:
+        book = SyntheticBook(depth, numOfAgents, numOfCompetitors)
+        results[name] = summarise(*benchmark(book, operations))
+    book = SyntheticBook(depth, numOfAgents, numOfCompetitors)
+    # price levels left on each side once filled, fewer than the depth if agents ran out of orders
+    filledDepth = min(min(orderbook.backs.marketDepth, orderbook.lays.marketDepth)
+                      for orderbook in book.exchange.compOrderbooks)
+    results['flow'] = summarise(*benchmarkFlow(book, operations, crossingRatio))
+    return {'depth': depth,
+            'filledDepth': filledDepth,
+            'agents': numOfAgents,
+            'ordersPerAgent': ORDERS_PER_AGENT,
+            'competitors': numOfCompetitors,
+            'crossingRatio': crossingRatio,
+            'operations': results}
+
+
+class SyntheticAgent:
+    """
+    Betting agent doing the work of an opinionated agent each time it responds, keeping
+    an average of each competitor's implied probability and blending it into its opinion,
+    then betting on the competitor it disagrees with the market about most. It backs a
+    competitor it rates above the market and lays one it rates below, resting its order
+    on the book or, as often as the crossing ratio, taking the best odds
+    """
+    def __init__(self, id, book, crossingRatio, seed):
+        self.id = id
+        self.book = book
+        self.crossingRatio = crossingRatio
+        self.random = random.Random(seed)
+        self.opinions = [1 / book.numOfCompetitors] * book.numOfCompetitors
+        self.history = [deque(maxlen=AGENT_HISTORY_LENGTH) for competitor in range(book.numOfCompetitors)]
+        self.orders = []
+
+    def respond(self, time, markets, trade):
+        markets = markets[self.book.exchange.id]
+        chosen = None
+        for competitor in range(self.book.numOfCompetitors):
+            backs = markets[competitor]['backs']
+            lays = markets[competitor]['lays']
+            if backs['best'] is None or lays['best'] is None:
+                continue
+            history = self.history[competitor]
+            history.append(2 / (backs['best'] + lays['best']))
+            implied = history[0]
+            for probability in history:
+                implied = 0.8 * implied + 0.2 * probability
+            opinion = 0.9 * self.opinions[competitor] + 0.1 * implied + self.random.gauss(0, 0.01)
+            self.opinions[competitor] = min(0.99, max(0.01, opinion))
+            if chosen is None or abs(self.opinions[competitor] - implied) > abs(self.opinions[chosen[0]] - chosen[1]):
+                chosen = (competitor, implied)
+        if chosen is None:
+            return
+        competitor = chosen[0]
+        direction = 'Back' if self.opinions[competitor] > chosen[1] else 'Lay'
+        if self.random.random() < self.crossingRatio:
+            odds = markets[competitor]['lays']['best'] if direction == 'Back' else markets[competitor]['backs']['best']
+            stake = self.random.randint(1, 20)
+        else:
+            odds = self.book.restingOdds(direction, self.random)
+            stake = 10
+        self.orders.append(Order(self.book.exchange.id, self.id, competitor, direction, odds, stake, 0, time))
+
+    def getorder(self, time, markets):
+        if len(self.orders) > 0:
+            return self.orders.pop()
+        return None
+
+
+def benchmarkThreads(numOfThreads, depth, numOfAgents, numOfCompetitors, crossingRatio,
+                     operations=OPERATIONS_PER_BENCHMARK):
+    """
+    The agents of a session spread over several agent threads, each agent responding to
+    the consolidated markets operations times and its orders going on a queue to a single
+    exchange thread that matches whatever has queued up as one batch, as in a session.
+    The same agents do the same work whatever the number of threads, returns dictionary
+    of orders matched and agent responses per second
+    """
+    book = SyntheticBook(depth, numOfAgents, numOfCompetitors)
+    exchange = book.exchange
+    consolidatedMarket = ConsolidatedMarket({exchange.id: exchange})
+    agents = [SyntheticAgent(agentId, book, crossingRatio, agentId) for agentId in range(numOfAgents)]
+    orderQ = queue.Queue()
+    # threads wait here so they all start together
+    barrier = threading.Barrier(numOfThreads + 2)
+    numOfOrders = [0]
+
+    def agentLogic(thread):
+        barrier.wait()
+        for i in range(operations):
+            markets = consolidatedMarket.refresh(i)
+            orders = []
+            for agent in agents[thread::numOfThreads]:
+                agent.respond(i, markets, None)
+                order = agent.getorder(i, markets)
+                while order is not None:
+                    orders.append(order)
+                    order = agent.getorder(i, markets)
+            if len(orders) > 0:
+                orderQ.put(orders)
+
+    def exchangeLogic():
+        barrier.wait()
+        running = True
+        while running:
+            orders = orderQ.get()
+            if orders is None:
+                break
+            while True:
+                try: queued = orderQ.get_nowait()
+                except queue.Empty: break
+                if queued is None:
+                    running = False
+                    break
+                orders = orders + queued
+            exchange.processOrders(time.perf_counter(), orders)
+            numOfOrders[0] = numOfOrders[0] + len(orders)
+
+    threads = [threading.Thread(target=agentLogic, args=(thread,)) for thread in range(numOfThreads)]
+    exchangeThread = threading.Thread(target=exchangeLogic)
+    for thread in threads + [exchangeThread]:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    orderQ.put(None)
+    exchangeThread.join()
+    duration = time.perf_counter() - start
+    return {'ordersPerSecond': numOfOrders[0] / duration,
+            'responsesPerSecond': numOfAgents * operations / duration}
+
+
+def benchmarkScaling(depth, numOfAgents, numOfCompetitors, crossingRatio, operations=OPERATIONS_PER_BENCHMARK,
+                     threadCounts=THREAD_COUNTS):
+    """
+    Throughput of the same agents spread over each number of agent threads, and the
+    speedup of their responses against the first, returns dictionary with whether the
+    GIL was enabled
+    """
+    results = []
+    for numOfThreads in threadCounts:
+        result = benchmarkThreads(numOfThreads, depth, numOfAgents, numOfCompetitors, crossingRatio, operations)
+        result['threads'] = numOfThreads
+        result['speedup'] = result['responsesPerSecond'] / results[0]['responsesPerSecond'] if len(results) > 0 else 1.0
+        results.append(result)
+    # only free-threaded builds have sys._is_gil_enabled, and may still have the GIL turned on
+    gilEnabled = getattr(sys, '_is_gil_enabled', lambda: True)()
+    return {'depth': depth,
+            'agents': numOfAgents,
+            'competitors': numOfCompetitors,
+            'crossingRatio': crossingRatio,
+            'gilEnabled': gilEnabled,
+            'scaling': results}
+
+
+def run_benchmarks(fileName=BENCHMARK_OUTPUT_FILENAME):
+    scenarios = []
+    for depth in DEPTHS:
+        for numOfAgents in NUM_OF_AGENTS:
+            for numOfCompetitors in NUMS_OF_COMPETITORS:
+                for crossingRatio in CROSSING_RATIOS:
+                    print("Benchmarking depth %d, %d agents, %d competitors, crossing ratio %s..." %
+                          (depth, numOfAgents, numOfCompetitors, crossingRatio))
+                    scenarios.append(benchmarkScenario(depth, numOfAgents, numOfCompetitors, crossingRatio))
+    print("Benchmarking agent threads feeding an exchange thread %s..." % THREAD_COUNTS)
+    threadScaling = benchmarkScaling(DEPTHS[1], NUM_OF_AGENTS[0], NUMS_OF_COMPETITORS[0], CROSSING_RATIOS[1])
+    results = {'time': time.time(),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'operationsPerBenchmark': OPERATIONS_PER_BENCHMARK,
+               'latencyUnit': 'us',
+               'scenarios': scenarios,
+               'threadScaling': threadScaling}
+    with open(fileName, 'w') as file:
+        json.dump(results, file, indent=2)
+    print("Wrote benchmark results to " + fileName)
+    return results
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        run_benchmarks(sys.argv[1])
+    else:
+        run_benchmarks()
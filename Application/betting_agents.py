@@ -29,7 +29,6 @@ class BettingAgent:
         self.liability = 0  # Amount that bettor is liable for if bettor lays winner
         self.availableBalance = self.balance
         self.orders = []
-        self.amountFromOrders = 0
         self.amountFromTransactions = 0
         self.numOfBets = 0  # Number of bets live on BBE
         self.exchange = random.randint(0, NUM_OF_EXCHANGES - 1)
@@ -83,6 +82,9 @@ class BettingAgent:
         self.influenced_by_opinions = influenced_by_opinions  # [0,1] values. 0 - agent shares opinions, but does not listen.
         # 1 - agent shares and listens to opinions
         self.in_conversation = 0
+        # the opinion dynamics platform changes local_opinion, in_conversation and the opinion
+        # weights from exchange threads while the agent's own thread changes them too
+        self.opinion_lock = threading.RLock()
 
     def observeRaceState(self, timestep, compDistances):
         if self.raceStarted == False: self.raceStarted = True
@@ -124,7 +126,8 @@ class BettingAgent:
             # set to lower bound
             validated_update = self.lower_op_bound
 
-        self.local_opinion = validated_update
+        with self.opinion_lock:
+            self.local_opinion = validated_update
 
     def set_uncertainty(self, updated_uncertainty):
 
@@ -175,10 +178,11 @@ class Agent_Opinionated_Random(BettingAgent):
                 c = random.randint(0, NUM_OF_COMPETITORS - 1)
                 self.chosen_competitor = c
 
-                if self.chosen_competitor == OPINION_COMPETITOR:
-                    self.local_opinion = random.uniform(1 / NUM_OF_COMPETITORS, 1)
-                else:
-                    self.local_opinion = random.uniform(0, 1 / NUM_OF_COMPETITORS)
+                with self.opinion_lock:
+                    if self.chosen_competitor == OPINION_COMPETITOR:
+                        self.local_opinion = random.uniform(1 / NUM_OF_COMPETITORS, 1)
+                    else:
+                        self.local_opinion = random.uniform(0, 1 / NUM_OF_COMPETITORS)
 
             else:
                 c = self.chosen_competitor
@@ -200,19 +204,7 @@ class Agent_Opinionated_Random(BettingAgent):
                     #print("LAY MADE BY AGENT " + str(self.id)+"   "+str(c))
 
         if order != None:
-            if(order.direction == 'Back'):
-                liability = self.amountFromOrders + order.stake
-                if liability > self.balance: return
-                else:
-                    self.orders.append(order)
-                    self.amountFromOrders = liability
-
-            elif(order.direction == 'Lay'):
-                liability = self.amountFromOrders + ((order.stake * order.odds) - order.stake)
-                if liability > self.balance: return
-                else:
-                    self.orders.append(order)
-                    self.amountFromOrders = liability
+            self.orders.append(order)
 
 
 class Agent_Opinionated_Leader_Wins(BettingAgent):
@@ -252,10 +244,11 @@ class Agent_Opinionated_Leader_Wins(BettingAgent):
 
             if compInTheLead != self.chosen_competitor:
 
-                if compInTheLead == OPINION_COMPETITOR:
-                    self.local_opinion = random.uniform(1/NUM_OF_COMPETITORS, 1)
-                else:
-                    self.local_opinion = random.uniform(0, 1/NUM_OF_COMPETITORS)
+                with self.opinion_lock:
+                    if compInTheLead == OPINION_COMPETITOR:
+                        self.local_opinion = random.uniform(1/NUM_OF_COMPETITORS, 1)
+                    else:
+                        self.local_opinion = random.uniform(0, 1/NUM_OF_COMPETITORS)
 
             self.chosen_competitor = compInTheLead
 
@@ -268,19 +261,7 @@ class Agent_Opinionated_Leader_Wins(BettingAgent):
 
 
         if order != None:
-            if(order.direction == 'Back'):
-                liability = self.amountFromOrders + order.stake
-                if liability > self.balance: return
-                else:
-                    self.orders.append(order)
-                    self.amountFromOrders = liability
-
-            elif(order.direction == 'Lay'):
-                liability = self.amountFromOrders + ((order.stake * order.odds) - order.stake)
-                if liability > self.balance: return
-                else:
-                    self.orders.append(order)
-                    self.amountFromOrders = liability
+            self.orders.append(order)
 
 
 class Agent_Opinionated_Underdog(BettingAgent):
@@ -333,10 +314,11 @@ class Agent_Opinionated_Underdog(BettingAgent):
             if self.job == 'back_underdog':
                 if self.compInSecond != self.chosen_competitor:
 
-                    if self.compInSecond == OPINION_COMPETITOR:
-                        self.local_opinion = random.uniform(1/NUM_OF_COMPETITORS, 1)
-                    else:
-                        self.local_opinion = random.uniform(0, 1/NUM_OF_COMPETITORS)
+                    with self.opinion_lock:
+                        if self.compInSecond == OPINION_COMPETITOR:
+                            self.local_opinion = random.uniform(1/NUM_OF_COMPETITORS, 1)
+                        else:
+                            self.local_opinion = random.uniform(0, 1/NUM_OF_COMPETITORS)
 
                 self.chosen_competitor = self.compInSecond
 
@@ -364,21 +346,7 @@ class Agent_Opinionated_Underdog(BettingAgent):
                 self.job = None
 
         if order != None:
-            if (order.direction == 'Back'):
-                liability = self.amountFromOrders + order.stake
-                if liability > self.balance:
-                    return
-                else:
-                    self.orders.append(order)
-                    self.amountFromOrders = liability
-
-            elif (order.direction == 'Lay'):
-                liability = self.amountFromOrders + ((order.stake * order.odds) - order.stake)
-                if liability > self.balance:
-                    return
-                else:
-                    self.orders.append(order)
-                    self.amountFromOrders = liability
+            self.orders.append(order)
 
 
 class Agent_Opinionated_Back_Favourite(BettingAgent):
@@ -392,6 +360,7 @@ class Agent_Opinionated_Back_Favourite(BettingAgent):
                               local_opinion, uncertainty, lower_op_bound,
                               upper_op_bound)
         self.marketsFave = None
+        self.marketsVersion = None  # version of the market snapshot the favourite was last worked out from
         self.opinionated = 1
         self.name = 'Agent_Opinionated_Back_Favourite'
 
@@ -405,6 +374,9 @@ class Agent_Opinionated_Back_Favourite(BettingAgent):
 
 
         if self.bettingPeriod == False: return None
+        # markets unchanged since last look therefore favourite is unchanged too
+        if markets[self.exchange].version == self.marketsVersion: return None
+        self.marketsVersion = markets[self.exchange].version
         order = None
         marketsFave = None
         lowestOdds = MAX_ODDS
@@ -425,10 +397,11 @@ class Agent_Opinionated_Back_Favourite(BettingAgent):
 
             if self.marketsFave != self.chosen_competitor:
 
-                if self.marketsFave == OPINION_COMPETITOR:
-                    self.local_opinion = random.uniform(1/NUM_OF_COMPETITORS, 1)
-                else:
-                    self.local_opinion = random.uniform(0, 1/NUM_OF_COMPETITORS)
+                with self.opinion_lock:
+                    if self.marketsFave == OPINION_COMPETITOR:
+                        self.local_opinion = random.uniform(1/NUM_OF_COMPETITORS, 1)
+                    else:
+                        self.local_opinion = random.uniform(0, 1/NUM_OF_COMPETITORS)
 
             self.chosen_competitor = self.marketsFave
 
@@ -438,21 +411,7 @@ class Agent_Opinionated_Back_Favourite(BettingAgent):
                           time)
 
         if order != None:
-            if (order.direction == 'Back'):
-                liability = self.amountFromOrders + order.stake
-                if liability > self.balance:
-                    return
-                else:
-                    self.orders.append(order)
-                    self.amountFromOrders = liability
-
-            elif (order.direction == 'Lay'):
-                liability = self.amountFromOrders + ((order.stake * order.odds) - order.stake)
-                if liability > self.balance:
-                    return
-                else:
-                    self.orders.append(order)
-                    self.amountFromOrders = liability
+            self.orders.append(order)
 
 
 
@@ -542,10 +501,11 @@ class Agent_Opinionated_Linex(BettingAgent):
 
             if self.predictedWinner != self.chosen_competitor:
 
-                if self.predictedWinner == OPINION_COMPETITOR:
-                    self.local_opinion = random.uniform(1/NUM_OF_COMPETITORS, 1)
-                else:
-                    self.local_opinion = random.uniform(0, 1/NUM_OF_COMPETITORS)
+                with self.opinion_lock:
+                    if self.predictedWinner == OPINION_COMPETITOR:
+                        self.local_opinion = random.uniform(1/NUM_OF_COMPETITORS, 1)
+                    else:
+                        self.local_opinion = random.uniform(0, 1/NUM_OF_COMPETITORS)
 
             self.chosen_competitor = self.predictedWinner
 
@@ -574,23 +534,7 @@ class Agent_Opinionated_Linex(BettingAgent):
             self.job = None
 
         if order != None:
-            if (order.direction == 'Back'):
-                liability = self.amountFromOrders + order.stake
-                if liability > self.balance:
-                    return
-                else:
-                    # print("\n LINEX BACKS: ",order.odds)
-                    self.orders.append(order)
-                    self.amountFromOrders = liability
-
-            elif (order.direction == 'Lay'):
-                liability = self.amountFromOrders + ((order.stake * order.odds) - order.stake)
-                if liability > self.balance:
-                    return
-                else:
-                    # print("\n LINEX LAYS: ", order.odds)
-                    self.orders.append(order)
-                    self.amountFromOrders = liability
+            self.orders.append(order)
 
 
 
@@ -678,19 +622,20 @@ class Agent_Opinionated_Priviledged(BettingAgent):
             winner = None
             winnerOdds = MAX_ODDS
 
-            if self.latest_odds is None:
-                self.strategy_opinion = 1 / odds[OPINION_COMPETITOR]
-                local_op = (1 - self.strategy_weight) * self.local_opinion + self.strategy_opinion * self.strategy_weight
-                self.local_opinion = local_op
-                self.opinion = self.a1 * self.local_opinion + self.a2 * self.global_opinion + self.a3 * self.event_opinion
-
-            else:
-                if odds[OPINION_COMPETITOR] != self.latest_odds[OPINION_COMPETITOR]:
+            with self.opinion_lock:
+                if self.latest_odds is None:
                     self.strategy_opinion = 1 / odds[OPINION_COMPETITOR]
                     local_op = (1 - self.strategy_weight) * self.local_opinion + self.strategy_opinion * self.strategy_weight
                     self.local_opinion = local_op
                     self.opinion = self.a1 * self.local_opinion + self.a2 * self.global_opinion + self.a3 * self.event_opinion
 
+                else:
+                    if odds[OPINION_COMPETITOR] != self.latest_odds[OPINION_COMPETITOR]:
+                        self.strategy_opinion = 1 / odds[OPINION_COMPETITOR]
+                        local_op = (1 - self.strategy_weight) * self.local_opinion + self.strategy_opinion * self.strategy_weight
+                        self.local_opinion = local_op
+                        self.opinion = self.a1 * self.local_opinion + self.a2 * self.global_opinion + self.a3 * self.event_opinion
+
             self.latest_odds = odds
 
             for i in range(len(odds)):
@@ -836,13 +781,7 @@ class XGBoostBettingAgent(BettingAgent):
                                 random.randint(self.stakeLower, self.stakeHigher), 
                                 markets[self.exchange][competitor]['QID'], time)
 
-                    if order.direction == 'Back':
-                        liability = self.amountFromOrders + order.stake
-                        if liability > self.balance:
-                            continue
-                        else:
-                            self.orders.append(order)
-                            self.amountFromOrders = liability
+                    self.orders.append(order)
 
                 elif decision == 0: ## Decision = lay 
                     if markets[self.exchange][competitor]['lays']['n'] > 0:
@@ -854,13 +793,7 @@ class XGBoostBettingAgent(BettingAgent):
                                 random.randint(self.stakeLower, self.stakeHigher),
                                 markets[self.exchange][competitor]['QID'], time)
 
-                    if order.direction == 'Lay':
-                        liability = self.amountFromOrders + ((order.stake * order.odds) - order.stake)
-                        if liability > self.balance:
-                            continue
-                        else:
-                            self.orders.append(order)
-                            self.amountFromOrders = liability
+                    self.orders.append(order)
 
         return None
 
@@ -983,10 +916,7 @@ class RLBettingAgent(BettingAgent):
         self.last_action = action
         self.last_balance = self.balance
 
-        liability = stake if direction == 'Back' else (stake * quoteodds - stake)
-        if self.amountFromOrders + liability <= self.balance:
-            self.orders.append(order)
-            self.amountFromOrders += liability
+        self.orders.append(order)
             
     def print_replay_buffer(self):
         print(f"\n[RL Agent {self.id}] Replay Buffer:")
@@ -0,0 +1,107 @@
+### ~ THREADED BRISTOL BETTING EXCHANGE ~ ###
+
+# Consolidated view of the markets of every exchange, with the best odds for each
+# competitor across all of them, and routing of orders to the exchange with the best odds
+
+import threading
+from types import MappingProxyType
+
+
+class ConsolidatedMarket:
+    """
+    Latest snapshots published by a set of exchanges, and the best back and lay odds
+    for each competitor across all of them. Only the books whose snapshot changed
+    since the last refresh are looked at again
+    """
+    def __init__(self, exchanges):
+        # dictionary of exchanges indexed by exchange ID
+        self.exchanges = exchanges
+        self.snapshots = {}
+        self.markets = MappingProxyType({})
+        # (odds, exchange ID) of the best odds on each side for each competitor,
+        # indexed by competitor ID, lowest back odds and highest lay odds
+        self.bestBacks = {}
+        self.bestLays = {}
+        # agent threads share the view
+        self.lock = threading.Lock()
+
+    def refresh(self, time):
+        """
+        Take in any snapshots published since the last refresh, returns read only
+        dictionary of the latest snapshot of each exchange indexed by exchange ID
+        """
+        with self.lock:
+            changedCompetitors = set()
+            for id, exchange in self.exchanges.items():
+                # read the last published snapshot rather than publishing, which is left
+                # to the exchange's own thread once it is running
+                snapshot = exchange.snapshot
+                if snapshot is None:
+                    snapshot = exchange.publishMarketState(time)
+                previous = self.snapshots.get(id)
+                if snapshot is previous:
+                    continue
+                for competitorId, market in snapshot.items():
+                    if previous is None or previous.get(competitorId) is not market:
+                        changedCompetitors.add(competitorId)
+                self.snapshots[id] = snapshot
+            if len(changedCompetitors) > 0:
+                self.markets = MappingProxyType(dict(self.snapshots))
+                for competitorId in changedCompetitors:
+                    self.updateBest(competitorId)
+            return self.markets
+
+    def updateBest(self, competitorId):
+        bestBack = None
+        bestLay = None
+        for id, snapshot in self.snapshots.items():
+            market = snapshot.get(competitorId)
+            if market is None:
+                continue
+            backOdds = market['backs']['best']
+            layOdds = market['lays']['best']
+            if backOdds is not None and (bestBack is None or backOdds < bestBack[0]):
+                bestBack = (backOdds, id)
+            if layOdds is not None and (bestLay is None or layOdds > bestLay[0]):
+                bestLay = (layOdds, id)
+        self.bestBacks[competitorId] = bestBack
+        self.bestLays[competitorId] = bestLay
+
+    def bestBack(self, competitorId):
+        """
+        Lowest back odds for the competitor on any exchange as (odds, exchange ID),
+        None if no exchange has any
+        """
+        return self.bestBacks.get(competitorId)
+
+    def bestLay(self, competitorId):
+        """
+        Highest lay odds for the competitor on any exchange as (odds, exchange ID),
+        None if no exchange has any
+        """
+        return self.bestLays.get(competitorId)
+
+
+class OrderRouter:
+    """
+    Sends each order that would trade straight away to the exchange with the best
+    odds for it, orders that would not trade anywhere stay on their own exchange
+    """
+    def __init__(self, consolidatedMarket):
+        self.consolidatedMarket = consolidatedMarket
+
+    def route(self, order):
+        """
+        Set the order's exchange to the one it should be sent to, returns exchange ID
+        """
+        if order.direction == 'Back':
+            # a back trades against lays at the same or longer odds, the longer the better
+            best = self.consolidatedMarket.bestLay(order.competitorId)
+            if best is not None and best[0] >= order.odds:
+                order.exchange = best[1]
+        else:
+            # a lay trades against backs at the same or shorter odds, the shorter the better
+            best = self.consolidatedMarket.bestBack(order.competitorId)
+            if best is not None and best[0] <= order.odds:
+                order.exchange = best[1]
+        return order.exchange
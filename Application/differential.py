@@ -0,0 +1,187 @@
+### ~ THREADED BRISTOL BETTING EXCHANGE ~ ###
+
+# Differential stress testing of order book engines: random order flow is run through
+# the reference exchange and a candidate side by side, comparing their tapes and books
+# after every step, and a sequence that makes them diverge is shrunk to a minimal one
+#
+# python differential.py [number of orders] [first seed]
+
+import sys, random
+from message_protocols import Order, GOOD_TILL_CANCELLED, GOOD_FOR_SECONDS, FILL_OR_KILL
+from exchange import Exchange, ODDS_LADDER
+
+# orders per generated sequence, each run on fresh exchanges so failures stay short to shrink
+SEQUENCE_LENGTH = 1000
+STRESS_ORDERS = 1000000
+NUM_OF_AGENTS = 8
+NUM_OF_COMPETITORS = 2
+MAX_ORDERS_PER_AGENT = 2
+# time in event between steps
+STEP_TIME = 0.05
+# odds are drawn from a few neighbouring ladder odds so orders cross often
+ODDS = [hundredths / 100 for hundredths in ODDS_LADDER if 240 <= hundredths <= 280]
+
+
+def referenceExchange():
+    return Exchange(0, NUM_OF_COMPETITORS, maxOrdersPerAgent=MAX_ORDERS_PER_AGENT)
+
+
+def tickLadderExchange():
+    return Exchange(0, NUM_OF_COMPETITORS, tickLadder=True, maxOrdersPerAgent=MAX_ORDERS_PER_AGENT)
+
+
+def generateSteps(seed, length=SEQUENCE_LENGTH):
+    """
+    Random sequence of steps, each a tuple of ('order', key, agent, competitor, direction,
+    odds, stake, time-in-force, expiry), ('cancel', key) or ('amend', key, stake), where
+    cancels and amends refer to the key of an earlier order
+    """
+    rnd = random.Random(seed)
+    steps = []
+    keys = []
+    for i in range(length):
+        draw = rnd.random()
+        if draw < 0.15 and len(keys) > 0:
+            steps.append(('cancel', rnd.choice(keys)))
+        elif draw < 0.25 and len(keys) > 0:
+            steps.append(('amend', rnd.choice(keys), rnd.randint(1, 20)))
+        else:
+            timeInForce = GOOD_TILL_CANCELLED
+            expiry = None
+            draw = rnd.random()
+            if draw < 0.1:
+                timeInForce = FILL_OR_KILL
+            elif draw < 0.2:
+                timeInForce = GOOD_FOR_SECONDS
+                expiry = rnd.choice([0.1, 0.5, 2.0])
+            steps.append(('order', i, rnd.randrange(NUM_OF_AGENTS), rnd.randrange(NUM_OF_COMPETITORS),
+                          rnd.choice(['Back', 'Lay']), rnd.choice(ODDS), rnd.randint(1, 20), timeInForce, expiry))
+            keys.append(i)
+    return steps
+
+
+def applyStep(exchange, step, orders, time):
+    """
+    Apply a step to an exchange, orders holds the orders sent to it indexed by key,
+    cancels and amends of orders no longer in a sequence are passed over
+    """
+    if step[0] == 'order':
+        kind, key, agentId, competitorId, direction, odds, stake, timeInForce, expiry = step
+        order = Order(exchange.id, agentId, competitorId, direction, odds, stake, 0, time, timeInForce, expiry)
+        orders[key] = order
+        exchange.processOrder(time, order)
+        return competitorId
+    order = orders.get(step[1])
+    if order is None:
+        return None
+    if step[0] == 'cancel':
+        exchange.delOrder(time, order)
+    else:
+        exchange.amendOrder(time, order, step[2])
+    return order.competitorId
+
+
+def bookState(exchange, competitorId):
+    """
+    Everything compared between engines for a competitor's book: its published market
+    and, where the engine holds the orders itself, every order in price-time order
+    """
+    market = exchange.publishMarketState(0)[competitorId]
+    state = {}
+    for side in ['backs', 'lays']:
+        state[side] = {key: market[side][key] for key in ['best', 'worst', 'n', 'market']}
+    orderbook = exchange.compOrderbooks[competitorId]
+    if hasattr(orderbook.backs, 'iterOrders'):
+        for side, half in [('backOrders', orderbook.backs), ('layOrders', orderbook.lays)]:
+            state[side] = [(odds, entry[1], entry[2], entry[3]) for odds, entry in half.iterOrders()]
+    return state
+
+
+def firstDivergence(steps, candidateFactory, referenceFactory=referenceExchange):
+    """
+    Run steps through a reference and a candidate exchange, comparing them after every
+    step, returns (index of the step after which they differ, description) or None
+    """
+    reference = referenceFactory()
+    candidate = candidateFactory()
+    exchanges = [reference, candidate]
+    orders = [{}, {}]
+    cursors = [[orderbook.tape.cursor() for orderbook in exchange.compOrderbooks] for exchange in exchanges]
+    for index, step in enumerate(steps):
+        time = index * STEP_TIME
+        results = []
+        for exchange, exchangeOrders in zip(exchanges, orders):
+            try:
+                results.append(applyStep(exchange, step, exchangeOrders, time))
+            except Exception as e:
+                results.append(repr(e))
+        if results[0] != results[1]:
+            return index, 'step results %r' % results
+        for competitorId in range(len(reference.compOrderbooks)):
+            records = [cursors[0][competitorId].read(), cursors[1][competitorId].read()]
+            if records[0] != records[1]:
+                return index, 'tape of competitor %d: %r' % (competitorId, records)
+        if results[0] is not None and not isinstance(results[0], str):
+            states = [bookState(exchange, results[0]) for exchange in exchanges]
+            if states[0] != states[1]:
+                return index, 'book of competitor %d: %r' % (results[0], states)
+    return None
+
+
+def shrink(steps, candidateFactory, referenceFactory=referenceExchange):
+    """
+    Smallest sequence found that still makes the exchanges diverge, by removing ever
+    smaller chunks of steps for as long as the divergence remains
+    """
+    def fails(candidateSteps):
+        return firstDivergence(candidateSteps, candidateFactory, referenceFactory) is not None
+
+    divergence = firstDivergence(steps, candidateFactory, referenceFactory)
+    steps = steps[:divergence[0] + 1]
+    numOfChunks = 2
+    while len(steps) >= 2:
+        chunk = -(-len(steps) // numOfChunks)
+        for start in range(0, len(steps), chunk):
+            reduced = steps[:start] + steps[start + chunk:]
+            if fails(reduced):
+                steps = reduced
+                numOfChunks = max(numOfChunks - 1, 2)
+                break
+        else:
+            if numOfChunks >= len(steps):
+                break
+            numOfChunks = min(len(steps), numOfChunks * 2)
+    return steps
+
+
+def stressTest(candidateFactory, numOfOrders=STRESS_ORDERS, seed=0, referenceFactory=referenceExchange,
+               sequenceLength=SEQUENCE_LENGTH):
+    """
+    Run generated sequences until numOfOrders steps have been compared, returns None if
+    the exchanges always agreed, otherwise (seed, shrunk steps, description of divergence)
+    """
+    numOfSteps = 0
+    while numOfSteps < numOfOrders:
+        steps = generateSteps(seed, sequenceLength)
+        if firstDivergence(steps, candidateFactory, referenceFactory) is not None:
+            steps = shrink(steps, candidateFactory, referenceFactory)
+            return seed, steps, firstDivergence(steps, candidateFactory, referenceFactory)[1]
+        numOfSteps = numOfSteps + len(steps)
+        seed = seed + 1
+    return None
+
+
+if __name__ == "__main__":
+    numOfOrders = int(sys.argv[1]) if len(sys.argv) > 1 else STRESS_ORDERS
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    print("Comparing tick ladder book with the price level book over %d orders..." % numOfOrders)
+    failure = stressTest(tickLadderExchange, numOfOrders, seed)
+    if failure is None:
+        print("No divergence")
+    else:
+        seed, steps, description = failure
+        print("Diverged on seed %d, minimal sequence of %d steps:" % (seed, len(steps)))
+        for step in steps:
+            print("    %r," % (step,))
+        print(description)
+        sys.exit(1)
@@ -1,22 +1,44 @@
 ### ~ THREADED BRISTOL BETTING EXCHANGE ~ ###
 
-import sys, config
-from system_constants import EXCHANGE_VERBOSE, MIN_ODDS, MAX_ODDS, NUM_OF_COMPETITORS
-from betting_agents import *
-from race_simulator import Simulator
-from message_protocols import Order
+import sys, bisect, threading, functools, config
+from collections import deque
+from types import MappingProxyType
+from system_constants import EXCHANGE_VERBOSE, MIN_ODDS, MAX_ODDS, NUM_OF_COMPETITORS, TICK_LADDER, TICK_LADDER_BANDS, MAX_ORDERS_PER_AGENT, DEPTH_DELTAS, ANALYTICS_DEPTH_LEVELS
+from message_protocols import Order, Transaction, MarketSnapshot, TapeView, GOOD_FOR_SECONDS, GOOD_UNTIL_TIMESTEP, FILL_OR_KILL
+from tape import Tape, TapeWriter
+from market_data import DepthFeed, SnapshotRing
+from positions import PositionLedger, ExposureLedger, liability
+from timer_wheel import TimerWheel
 
 # Orderbook_half is one side of the book: a list of bids or a list of lays, each sorted best-first
+# Price levels are kept in a sorted list of odds with a FIFO queue of orders per level, so that
+# additions, cancellations and fills only touch the level concerned instead of rebuilding the market
 class OrderbookHalf:
-	def __init__(self, booktype, worstodds):
+	def __init__(self, booktype, worstodds, maxOrdersPerAgent=1):
 		# booktype: backs or lays?
 		self.booktype = booktype
-		# dictionary of orders received, indexed by Betting Agent ID
+		# dictionary of orders received, indexed by Order ID
 		self.orders = {}
-		# the market, dictionary indexed by price, with order info
+		# IDs of each betting agent's orders on this side in arrival order, indexed by Betting Agent ID
+		self.agentOrders = {}
+		# how many orders a betting agent may rest before its oldest is overwritten
+		self.maxOrdersPerAgent = maxOrdersPerAgent
+		# the market, dictionary indexed by price, with [total stake, FIFO queue of order info, number of orders]
 		self.market = {}
-		# anonymized market, list of two-valued lists, only odds/stake info
-		self.anonymisedMarket = []
+		# order info held on the market for each order, indexed by Order ID
+		# order info removed from the middle of a queue is only dropped from the queue once it reaches the
+		# front, or once the queue is compacted
+		self.entries = {}
+		# sorted list of the prices currently on the market
+		self.prices = []
+		# anonymized market, list of two-valued lists, only odds/stake info, built on demand
+		self.cachedAnonymisedMarket = []
+		# odds of price levels whose total stake has changed since last collected, only kept
+		# when the exchange publishes depth deltas
+		self.trackChanges = False
+		self.changedLevels = {}
+		# exchange's ledger of agents' liabilities, told of every change to an order's stake
+		self.exposure = None
 		# summary stats
 		self.bestOrderStake = None
 		self.bestOdds = None
@@ -26,56 +48,152 @@ class OrderbookHalf:
 		self.marketDepth = 0  # how many different prices in market?
 
 
+	@property
+	def anonymisedMarket(self):
+		"""
+		Anonymised market as a sorted list [[odds, stake]], only rebuilt after the market has changed
+		"""
+		if self.cachedAnonymisedMarket is None:
+			self.cachedAnonymisedMarket = self.anonymiseMarket()
+		return self.cachedAnonymisedMarket
+
+
 	def anonymiseMarket(self):
 		"""
 		Anonymise market and format as a sorted list [[odds, stake]]
 		"""
-		# anonymise the market, strip out order details, format as a sorted list
-		# NB for lays, the sorting should be reversed
-		self.anonymisedMarket = []
-		for odds in list(sorted(self.market)):
-			stake = self.market[odds][0]
-			self.anonymisedMarket.append([odds, stake])
+		# prices are already held in sorted order so no sort is needed here
+		# NB for lays, the best odds are at the end of the list
+		return [[odds, self.market[odds][0]] for odds in self.prices]
 
 
-	def buildMarket(self):
+	def getLevel(self, odds):
 		"""
-		Build market from list of orders, returns an unsorted dictionary [odds, [order info]]
+		Price level at odds as [total stake, FIFO queue of order info, number of orders]
 		"""
-		# take a list of orders and build the betting market from it
-		# NB the exchange needs to know arrival times and betting agent id associated with each order
-		# returns as a dictionary (i.e., unsorted)
-		# also builds anonymized version (just price/quantity, sorted, as a list) for publishing to betting agents
-		self.market = {}
+		return self.market[odds]
 
-		for key, order in self.orders.items():
-			odds = order.odds
-			if odds in self.market:
-				# update existing entry
-				stake = self.market[odds][0]
-				orderList = self.market[odds][1]
-				orderList.append([order.timestamp, order.stake, order.agentId, order.orderId])
-				self.market[odds] = [stake + order.stake, orderList]
-			else:
-				# create a new dictionary entry
-				self.market[odds] = [order.stake, [[order.timestamp, order.stake, order.agentId, order.orderId]]]
-		# create anonymized version
-		self.anonymiseMarket()
-		# record best price and associated betting agent id
-		if len(self.market) > 0 :
+
+	def levelStake(self, odds):
+		"""
+		Total stake at odds, 0 if there is no price level at those odds
+		"""
+		if odds in self.market:
+			return self.market[odds][0]
+		return 0
+
+
+	def stakeChanged(self, agentId, odds, stake):
+		"""
+		Note the stake of an agent's order at odds changing by stake
+		"""
+		if self.trackChanges:
+			self.changedLevels[odds] = True
+		if self.exposure is not None:
+			self.exposure.openChanged(agentId, self.booktype, odds, stake)
+
+
+	def collectChangedLevels(self):
+		"""
+		Odds and new total stake of every price level changed since last collected
+		"""
+		changes = [[odds, self.levelStake(odds)] for odds in self.changedLevels]
+		self.changedLevels = {}
+		return changes
+
+
+	def openLevel(self, odds):
+		"""
+		Price level at odds, creating an empty level if there are no orders at those odds
+		"""
+		if odds not in self.market:
+			self.market[odds] = [0, deque(), 0]
+			bisect.insort(self.prices, odds)
+		return self.market[odds]
+
+
+	def closeLevel(self, odds):
+		"""
+		Delete price level once its last order has gone
+		"""
+		del(self.market[odds])
+		del(self.prices[bisect.bisect_left(self.prices, odds)])
+
+
+	def updateBest(self):
+		"""
+		Update best/worst odds and best order details from the top of the sorted price levels
+		"""
+		self.cachedAnonymisedMarket = None
+		self.numOfOrders = len(self.orders)
+		self.marketDepth = len(self.prices)
+		if self.marketDepth > 0:
 			if self.booktype == 'Back':
-				self.bestOdds = self.anonymisedMarket[0][0]
-				self.worstOdds = self.anonymisedMarket[-1][0]
-			else :
-				self.bestOdds = self.anonymisedMarket[-1][0]
-				self.worstOdds = self.anonymisedMarket[0][0]
-			self.bestAgentId = self.market[self.bestOdds][1][0][2]
-			self.bestOrderStake = self.market[self.bestOdds][1][0][1]
-		else :
+				self.bestOdds = self.prices[0]
+				self.worstOdds = self.prices[-1]
+			else:
+				self.bestOdds = self.prices[-1]
+				self.worstOdds = self.prices[0]
+			bestEntry = self.getLevel(self.bestOdds)[1][0]
+			self.bestAgentId = bestEntry[2]
+			self.bestOrderStake = bestEntry[1]
+		else:
 			self.bestOdds = None
 			self.bestAgentId = None
 
-		#if EXCHANGE_VERBOSE : print(self.market)
+
+	def isLive(self, entry):
+		"""
+		Is order info still on the market, or has its order since been removed
+		"""
+		return self.entries.get(entry[3]) is entry
+
+
+	def addEntry(self, order):
+		"""
+		Queue order info at the back of its price level, creating the level if needed
+		"""
+		entry = [order.timestamp, order.stake, order.agentId, order.orderId]
+		level = self.openLevel(order.odds)
+		level[0] = level[0] + order.stake
+		self.stakeChanged(order.agentId, order.odds, order.stake)
+		level[1].append(entry)
+		level[2] = level[2] + 1
+		self.entries[order.orderId] = entry
+
+
+	def removeEntry(self, orderId):
+		"""
+		Remove order info from its price level, deleting the level once empty
+		"""
+		entry = self.entries.pop(orderId)
+		odds = self.orders[orderId].odds
+		level = self.getLevel(odds)
+		level[0] = level[0] - entry[1]
+		level[2] = level[2] - 1
+		self.stakeChanged(entry[2], odds, -entry[1])
+		if level[2] == 0:
+			self.closeLevel(odds)
+		else:
+			# drop removed order info from the front so the head of the queue is always a live order
+			while not self.isLive(level[1][0]):
+				level[1].popleft()
+			# and compact the queue once removed order info outnumbers the live orders behind a
+			# long lived head, so the queue never grows beyond twice the orders at the level
+			if len(level[1]) > 2 * level[2]:
+				level[1] = deque(entry for entry in level[1] if self.isLive(entry))
+
+
+	def deleteOrder(self, orderId):
+		"""
+		Take order off the market and out of the order indexes
+		"""
+		self.removeEntry(orderId)
+		order = self.orders.pop(orderId)
+		agentOrders = self.agentOrders[order.agentId]
+		del(agentOrders[orderId])
+		if len(agentOrders) == 0:
+			del(self.agentOrders[order.agentId])
 
 
 	def bookAddOrder(self, order):
@@ -84,106 +202,292 @@ class OrderbookHalf:
 		returns as string instruction
 		"""
 		# add order to the dictionary holding the list of orders
-		# either overwrites old order from this betting agent
+		# either overwrites the oldest order from this betting agent if it
+		# already has the maximum number of orders on this side of the book
 		# or dynamically creates new entry in the dictionary
-		# so, max of one order per trader per list
-		# checks whether length or order list has changed, to distinguish addition/overwrite
+		# an overwritten order loses its place in the queue of its old price level
+
+		response = 'Addition'
+		agentOrders = self.agentOrders.setdefault(order.agentId, {})
+		if len(agentOrders) >= self.maxOrdersPerAgent:
+			self.deleteOrder(next(iter(agentOrders)))
+			agentOrders = self.agentOrders.setdefault(order.agentId, {})
+			response = 'Overwrite'
+		self.orders[order.orderId] = order
+		agentOrders[order.orderId] = None
+		self.addEntry(order)
+		self.updateBest()
+		return response
+
+
+	def quotable(self, odds):
+		"""
+		True if an order at odds can be taken on this side of the book
+		"""
+		return True
 
-		numOfOrdersBefore = self.numOfOrders
-		self.orders[order.agentId] = order
-		self.numOfOrders = len(self.orders)
-		self.buildMarket()
 
-		if numOfOrdersBefore != self.numOfOrders :
-			return('Addition')
+	def overwrittenOrder(self, agentId):
+		"""
+		Order that adding another for the agent would overwrite, None if the agent has room
+		"""
+		agentOrders = self.agentOrders.get(agentId)
+		if agentOrders is None or len(agentOrders) < self.maxOrdersPerAgent:
+			return None
+		return self.orders[next(iter(agentOrders))]
+
+
+	def bookDeleteOrder(self, order):
+		"""
+		Delete order from orders dictionary by its order ID, returns the order deleted
+		as it rested on the book, None if there was no such order
+		"""
+		# checks that the order does actually exist in the dict, and belongs to
+		# the betting agent asking, before deletion
+		resting = self.orders.get(order.orderId)
+		if resting is not None and resting.agentId == order.agentId:
+			self.deleteOrder(order.orderId)
+			self.updateBest()
+			return resting
+		return None
+
+
+	def bookAmendOrder(self, orderId, stake):
+		"""
+		Change the stake of an order on the market, a reduced stake keeps its place in
+		the queue whereas an increased stake goes to the back of the queue
+		"""
+		order = self.orders[orderId]
+		entry = self.entries[orderId]
+		if stake <= 0:
+			self.deleteOrder(orderId)
+		elif stake <= entry[1]:
+			level = self.getLevel(order.odds)
+			level[0] = level[0] - entry[1] + stake
+			self.stakeChanged(order.agentId, order.odds, stake - entry[1])
+			entry[1] = stake
+			order.stake = stake
 		else:
-			return('Overwrite')
+			self.removeEntry(orderId)
+			order.stake = stake
+			self.addEntry(order)
+		self.updateBest()
+
 
+	def iterOrders(self):
+		"""
+		Iterate over the orders on the market in price-time order, best odds first,
+		yields (odds, order info)
+		"""
+		if self.booktype == 'Back':
+			prices = self.prices
+		else:
+			prices = reversed(self.prices)
+		for odds in prices:
+			for entry in self.market[odds][1]:
+				if self.isLive(entry):
+					yield odds, entry
 
 
-	def bookDeleteOrder(self, order):
+	def topLevels(self, n):
 		"""
-		Delete order from orders dictionary, assuming one order per trader
-		"""
-		# delete order from the dictionary holding the orders
-		# assumes max of one order per trader per list
-		# checks that the Trader ID does actually exist in the dict before deletion
-		if self.orders[order.agentId] != None :
-			del(self.orders[order.agentId])
-			if self.market[self.bestOdds][0] == order.stake:
-				del(self.market[self.bestOdds])
-			self.numOfOrders = len(self.orders)
-			self.buildMarket()
-
-
-	def bookDeleteBest(self, orderStake, order):
-		"""
-		Delete order from book when has been fulfilled, returns agent ID of
-		order as the counterparty
-		"""
-		# delete order: when the best bid/ask has been hit, delete it from the book
-		# the betting agent id of the deleted order is return-value, as counterparty to the trade
-		bestOddsOrders = self.market[self.bestOdds]
-		bestOddsStake = bestOddsOrders[0]
-		bestOddsCounterparty = bestOddsOrders[1][0][2]
-		bestOddsCounterpartyStake = bestOddsOrders[1][0][1]
-		# if bestOddsStake == 1:
-		# here the order deletes the best odds
-		# print(self.market)
-		# print(self.numOfOrders)
-		# print(self.orders)
-		# print("...............")
-
-		# if order has used up all orders for odds then delete bestodds from market
-		# and counterparty order otherwise just delete counterparty order
-
-		del(self.orders[bestOddsCounterparty])
-		if self.market[self.bestOdds][0] == orderStake:
-			self.numOfOrders -= len(self.market[self.bestOdds][1])
-			del(self.market[self.bestOdds])
+		Odds and total stake of the best n price levels, best first
+		"""
+		if self.booktype == 'Back':
+			prices = self.prices[:n]
 		else:
-			self.numOfOrders = self.numOfOrders - 1
-		#
-		# print(self.market)
-		# print(self.numOfOrders)
-		# print(self.orders)
+			prices = reversed(self.prices[-n:])
+		return [[odds, self.market[odds][0]] for odds in prices]
 
 
-		if self.numOfOrders > 0:
-			if self.booktype == 'Back':
-				self.bestOdds = min(self.market.keys())
+	def bookFill(self, fills):
+		"""
+		Take the stakes matched in a sweep off the orders concerned, deleting orders
+		that have been fulfilled, then update the best odds once for the whole sweep
+		"""
+		for orderId, takenStake in fills:
+			order = self.orders[orderId]
+			if takenStake >= order.stake:
+				self.deleteOrder(orderId)
 			else:
+				# partially fulfilled, keeps its place in the queue
+				order.stake = order.stake - takenStake
+				self.entries[orderId][1] = order.stake
+				level = self.getLevel(order.odds)
+				level[0] = level[0] - takenStake
+				self.stakeChanged(order.agentId, order.odds, -takenStake)
+		self.updateBest()
+
+
 
-				self.bestOdds = max(self.market.keys())
-			self.marketDepth = len(self.market.keys())
+
+
+
+
+
+
+def buildOddsLadder(minOdds, maxOdds):
+	"""
+	Build Betfair style ladder of valid odds between minOdds and maxOdds, returns
+	sorted list of odds in hundredths so that ticks are compared as integers
+	"""
+	ladder = []
+	odds = int(round(minOdds * 100))
+	while odds <= int(round(maxOdds * 100)):
+		ladder.append(odds)
+		for bandLimit, tickSize in TICK_LADDER_BANDS:
+			if odds < int(round(bandLimit * 100)):
+				odds = odds + int(round(tickSize * 100))
+				break
 		else:
-			self.bestOdds = self.worstOdds
-			self.marketDepth = 0
-		# else:
-		# 	# stake > 1 so the order decrements the quantity of the best back
-		# 	# update the market with the decremented order data
-		# 	self.market[self.bestOdds] = [bestOddsStake - 1, bestOddsOrders[1][1:]]
-		#
-		# 	# update the back list: counterparty's back has been deleted
-		# 	del(self.orders[bestOddsCounterparty])
-		# 	self.numOfOrders = self.numOfOrders - 1
-		self.buildMarket()
-		return bestOddsCounterparty
+			break
+	return ladder
+
+ODDS_LADDER = buildOddsLadder(MIN_ODDS, MAX_ODDS)
+
+
+def oddsToTick(odds, direction):
+	"""
+	Snap odds onto the ladder, returns tick index. Backs are rounded up and lays
+	rounded down so an order is never made more aggressive than quoted, odds
+	must be onLadder for the direction
+	"""
+	hundredths = odds * 100
+	if direction == 'Back':
+		return bisect.bisect_left(ODDS_LADDER, hundredths - 1e-6)
+	return bisect.bisect_right(ODDS_LADDER, hundredths + 1e-6) - 1
+
+
+def onLadder(odds, direction):
+	"""
+	True if odds can be snapped onto the ladder without making the order more
+	aggressive, a back above the top or a lay below the bottom cannot be
+	"""
+	hundredths = odds * 100
+	if direction == 'Back':
+		return hundredths - 1e-6 <= ODDS_LADDER[-1]
+	return hundredths + 1e-6 >= ODDS_LADDER[0]
+
+
+def tickToOdds(tick):
+	return ODDS_LADDER[tick] / 100
+
 
-	def bookModifyBest(self, diff, id):
+# Tick ladder version of an orderbook half: odds are snapped to integer tick indexes and the
+# market is an array indexed by tick, each holding [total stake, FIFO queue of order info, number of orders]
+class TickLadderOrderbookHalf(OrderbookHalf):
+	def __init__(self, booktype, worstodds, maxOrdersPerAgent=1):
+		OrderbookHalf.__init__(self, booktype, worstodds, maxOrdersPerAgent)
+		self.market = [[0, deque(), 0] for tick in ODDS_LADDER]
+		# lowest and highest ticks holding orders, None when this side of book is empty
+		self.lowTick = None
+		self.highTick = None
+
+
+	def getLevel(self, odds):
+		return self.market[oddsToTick(odds, self.booktype)]
+
+
+	def levelStake(self, odds):
+		return self.market[oddsToTick(odds, self.booktype)][0]
+
+
+	def openLevel(self, odds):
+		tick = oddsToTick(odds, self.booktype)
+		if self.market[tick][2] == 0:
+			self.marketDepth = self.marketDepth + 1
+			if self.lowTick is None or tick < self.lowTick: self.lowTick = tick
+			if self.highTick is None or tick > self.highTick: self.highTick = tick
+		return self.market[tick]
+
+
+	def closeLevel(self, odds):
 		"""
-		Modify order from book when order is partially fulfilled or proportion
-		of amount staked is taken
+		Empty the tick once its last order has gone, moving the outermost occupied
+		ticks inwards if needed
 		"""
+		tick = oddsToTick(odds, self.booktype)
+		self.market[tick] = [0, deque(), 0]
+		self.marketDepth = self.marketDepth - 1
+		if self.marketDepth == 0:
+			self.lowTick = None
+			self.highTick = None
+		elif tick == self.lowTick:
+			while self.market[self.lowTick][2] == 0: self.lowTick = self.lowTick + 1
+		elif tick == self.highTick:
+			while self.market[self.highTick][2] == 0: self.highTick = self.highTick - 1
+
+
+	def iterOrders(self):
+		if self.lowTick is None:
+			return
+		if self.booktype == 'Back':
+			ticks = range(self.lowTick, self.highTick + 1)
+		else:
+			ticks = range(self.highTick, self.lowTick - 1, -1)
+		for tick in ticks:
+			for entry in self.market[tick][1]:
+				if self.isLive(entry):
+					yield tickToOdds(tick), entry
+
+
+	def topLevels(self, n):
+		levels = []
+		if self.lowTick is None:
+			return levels
+		if self.booktype == 'Back':
+			ticks = range(self.lowTick, self.highTick + 1)
+		else:
+			ticks = range(self.highTick, self.lowTick - 1, -1)
+		for tick in ticks:
+			if self.market[tick][2] > 0:
+				levels.append([tickToOdds(tick), self.market[tick][0]])
+				if len(levels) == n: break
+		return levels
 
-		# change amount staked by diff
-		self.orders[id].stake = self.orders[id].stake - diff
-		self.buildMarket()
 
+	def anonymiseMarket(self):
+		"""
+		Anonymise market and format as a sorted list [[odds, stake]]
+		"""
+		if self.lowTick is None:
+			return []
+		return [[tickToOdds(tick), self.market[tick][0]] for tick in range(self.lowTick, self.highTick + 1)
+				if self.market[tick][2] > 0]
 
 
+	def updateBest(self):
+		"""
+		Update best/worst odds and best order details from the outermost occupied ticks
+		"""
+		self.cachedAnonymisedMarket = None
+		self.numOfOrders = len(self.orders)
+		if self.lowTick is not None:
+			if self.booktype == 'Back':
+				bestTick, worstTick = self.lowTick, self.highTick
+			else:
+				bestTick, worstTick = self.highTick, self.lowTick
+			self.bestOdds = tickToOdds(bestTick)
+			self.worstOdds = tickToOdds(worstTick)
+			bestEntry = self.market[bestTick][1][0]
+			self.bestAgentId = bestEntry[2]
+			self.bestOrderStake = bestEntry[1]
+		else:
+			self.bestOdds = None
+			self.bestAgentId = None
 
 
+	def addEntry(self, order):
+		"""
+		Snap order onto the ladder and queue its order info at the back of that tick
+		"""
+		order.odds = tickToOdds(oddsToTick(order.odds, self.booktype))
+		OrderbookHalf.addEntry(self, order)
+
+
+	def quotable(self, odds):
+		return onLadder(odds, self.booktype)
+
 
 
 
@@ -192,24 +496,137 @@ class OrderbookHalf:
 
 class Orderbook(OrderbookHalf):
 
-	def __init__(self, competitorId):
+	def __init__(self, competitorId, tickLadder=False, maxOrdersPerAgent=1, exchangeId=0):
 		self.competitorId = competitorId
-		self.backs = OrderbookHalf('Back', MAX_ODDS)
-		self.lays = OrderbookHalf('Lay', MIN_ODDS)
-		self.tape = []
+		# tick ladder mode snaps odds onto the ladder and indexes the market by tick
+		if tickLadder:
+			self.backs = TickLadderOrderbookHalf('Back', MAX_ODDS, maxOrdersPerAgent)
+			self.lays = TickLadderOrderbookHalf('Lay', MIN_ODDS, maxOrdersPerAgent)
+		else:
+			self.backs = OrderbookHalf('Back', MAX_ODDS, maxOrdersPerAgent)
+			self.lays = OrderbookHalf('Lay', MIN_ODDS, maxOrdersPerAgent)
+		self.tape = Tape(exchangeId, competitorId)
+		# held while the book is changed or read for a snapshot, so books of different
+		# competitors are matched at the same time by different threads
+		self.lock = threading.RLock()
 		self.quoteId = 0  #unique ID code for each quote accepted onto the book
+		self.version = 0  # incremented every time the book or its tape changes
+		self.snapshot = None  # published market data for the latest version
+		self.lastTradedOdds = None
+		# running totals of the stake traded and of odds * stake, for the traded VWAP
+		self.tradedStake = 0
+		self.tradedValue = 0
+
+
+	def analytics(self, depthLevels=ANALYTICS_DEPTH_LEVELS):
+		"""
+		Summary of the book from its best odds, the stake on its best levels and its
+		running traded totals, returns dictionary
+		"""
+		bestBack = self.backs.bestOdds
+		bestLay = self.lays.bestOdds
+		bestBackStake = 0 if bestBack is None else self.backs.levelStake(bestBack)
+		bestLayStake = 0 if bestLay is None else self.lays.levelStake(bestLay)
+		spread = None
+		microprice = None
+		if bestBack is not None and bestLay is not None:
+			# spread in implied probability, and the best odds weighted by the stake on the other side
+			spread = abs((1 / bestBack) - (1 / bestLay))
+			microprice = ((bestBack * bestLayStake) + (bestLay * bestBackStake)) / (bestBackStake + bestLayStake)
+		vwap = None
+		if self.tradedStake > 0:
+			vwap = self.tradedValue / self.tradedStake
+		return {'bestBack': bestBack,
+				'bestLay': bestLay,
+				'bestBackStake': bestBackStake,
+				'bestLayStake': bestLayStake,
+				'spread': spread,
+				'microprice': microprice,
+				'backDepth': sum(stake for odds, stake in self.backs.topLevels(depthLevels)),
+				'layDepth': sum(stake for odds, stake in self.lays.topLevels(depthLevels)),
+				'lastTradedOdds': self.lastTradedOdds,
+				'tradedStake': self.tradedStake,
+				'vwap': vwap}
+
+
+def synchronised(method):
+	"""
+	Run an exchange method holding the exchange's lock, for state shared by all of its
+	books. Books have their own locks, taken before the exchange's and never while
+	holding it. Readers take the published snapshot, which is never changed once
+	built, and need no lock
+	"""
+	@functools.wraps(method)
+	def lockedMethod(self, *args, **kwargs):
+		with self.lock:
+			return method(self, *args, **kwargs)
+	return lockedMethod
 
 
 # Exchange's internal orderbook
 
 class Exchange(Orderbook):
 	# Need to take in number of competitors and create an individual orderbook for each
-	def __init__(self, id, numOfCompetitors):
-		self.id = id
+	def __init__(self, id, numOfCompetitors, tickLadder=TICK_LADDER, maxOrdersPerAgent=MAX_ORDERS_PER_AGENT, depthDeltas=DEPTH_DELTAS, exposure=None):
 		# list of unique orderbooks for all competitors
-		self.compOrderbooks = []
+		compOrderbooks = []
 		for i in range(numOfCompetitors):
-			self.compOrderbooks.append(Orderbook(i))
+			compOrderbooks.append(Orderbook(i, tickLadder, maxOrdersPerAgent, id))
+		self.initialiseExchange(id, compOrderbooks, exposure)
+		for orderbook in self.compOrderbooks:
+			orderbook.backs.exposure = self.exposure
+			orderbook.lays.exposure = self.exposure
+		# market data mode publishing only the price levels that changed, None if not in use
+		if depthDeltas:
+			self.depthFeed = DepthFeed()
+			for orderbook in self.compOrderbooks:
+				orderbook.backs.trackChanges = True
+				orderbook.lays.trackChanges = True
+
+
+	def initialiseExchange(self, id, compOrderbooks, exposure):
+		"""
+		State every kind of exchange keeps whatever its orderbooks are
+		"""
+		self.id = id
+		# held briefly for the version, published snapshot, timer wheels and market data
+		# shared by all books, reentrant as locked methods call each other
+		self.lock = threading.RLock()
+		self.compOrderbooks = compOrderbooks
+		# monotonically increasing version of the exchange's markets and the snapshot published for it
+		self.version = 0
+		self.snapshot = None
+		# net position of each betting agent on each competitor, updated on every trade
+		self.positions = PositionLedger(len(compOrderbooks))
+		# liability of each betting agent's open orders and matched bets, checked on order entry,
+		# shared with the session's other exchanges if given
+		if exposure is None:
+			exposure = ExposureLedger()
+		self.exposure = exposure
+		# top of book and depth of each competitor at every race timestep
+		self.snapshotRing = SnapshotRing(len(compOrderbooks))
+		# resting orders good for some seconds, expired as the event time moves on
+		self.expiryWheel = TimerWheel()
+		# resting orders good until a race timestep, on a wheel a timestep per tick expired
+		# as the race reaches each timestep
+		self.timestepWheel = TimerWheel(tick=1)
+		# market data mode publishing only the price levels that changed, None if not in use
+		self.depthFeed = None
+
+
+	def bookChanged(self, orderbook):
+		"""
+		Move the orderbook and the exchange on to a new version so the next
+		published snapshot is rebuilt, publishing depth deltas for the changed
+		price levels if in that market data mode
+		"""
+		orderbook.version = orderbook.version + 1
+		with self.lock:
+			if self.depthFeed is not None:
+				for half in [orderbook.backs, orderbook.lays]:
+					for odds, stake in half.collectChangedLevels():
+						self.depthFeed.publish(orderbook.competitorId, half.booktype, odds, stake)
+			self.version = self.version + 1
 
 
 	def addOrder(self, order):
@@ -220,89 +637,134 @@ class Exchange(Orderbook):
 		# retrieve orderbook for competitor in question
 		orderbook = self.compOrderbooks[order.competitorId]
 
-		order.orderId = orderbook.quoteId
-		orderbook.quoteId = order.orderId + 1
+		with orderbook.lock:
+			order.orderId = orderbook.quoteId
+			orderbook.quoteId = order.orderId + 1
 
-		if order.direction == 'Back':
-			response = orderbook.backs.bookAddOrder(order)
-			bestOdds = orderbook.backs.anonymisedMarket[0][0]
-			orderbook.backs.bestOdds = bestOdds
-			orderbook.backs.bestAgentId = orderbook.backs.market[bestOdds][1][0][2]
-		else:
-			response = orderbook.lays.bookAddOrder(order)
-			bestOdds = orderbook.lays.anonymisedMarket[-1][0]
-			orderbook.lays.bestOdds = bestOdds
-			orderbook.lays.bestAgentId = orderbook.lays.market[bestOdds][1][0][2]
+			# best odds and best agent are kept up to date by the book itself
+			if order.direction == 'Back':
+				response = orderbook.backs.bookAddOrder(order)
+			else:
+				response = orderbook.lays.bookAddOrder(order)
+			self.bookChanged(orderbook)
 		return [order.orderId, response]
 
 
 	def delOrder(self, time, order):
 		"""
-		Delete order from exchange, update all internal records, returns order ID
+		Delete order from exchange by its order ID, update all internal records
 		"""
 		# delete a betting agent's order from the exchange, update all internal records
 
 		# retrieve orderbook for competitor in question
 		orderbook = self.compOrderbooks[order.competitorId]
 
-		if order.direction == 'Back':
-			orderbook.backs.bookDeleteOrder(order)
-			if orderbook.backs.numOfOrders > 0 :
-				bestOdds = orderbook.backs.anonymisedMarket[0][0]
-				orderbook.backs.bestOdds = bestOdds
-				orderbook.backs.bestAgentId = orderbook.backs.market[bestOdds][1][0][2]
-			else: # this side of book is empty
-				orderbook.backs.bestOdds = None
-				orderbook.backs.bestAgentId = None
-			cancelRecord = { 'type': 'Cancel', 'time': time, 'order': order }
-			orderbook.tape.append(cancelRecord)
+		with orderbook.lock:
+			if order.direction == 'Back':
+				resting = orderbook.backs.bookDeleteOrder(order)
+			elif order.direction == 'Lay':
+				resting = orderbook.lays.bookDeleteOrder(order)
+			else:
+				# neither back nor lay?
+				sys.exit('bad order type in delOrder')
 
+			# cancelling an order that has already gone, or another agent's order, changes nothing.
+			# The tape records the order as it rested, at its odds on the book and with what was left of it
+			if resting is not None:
+				orderbook.tape.recordCancel(time, resting)
+				self.bookChanged(orderbook)
+
+	def amendOrder(self, time, order, stake):
+		"""
+		Change the stake of an order on the exchange by its order ID, update all internal records
+		"""
+		orderbook = self.compOrderbooks[order.competitorId]
+		if order.direction == 'Back':
+			half = orderbook.backs
 		elif order.direction == 'Lay':
-			orderbook.lays.bookDeleteOrder(order)
-			if orderbook.lays.numOfOrders > 0 :
-				bestOdds = orderbook.lays.anonymisedMarket[-1][0]
-				orderbook.lays.bestOdds = bestOdds
-				orderbook.lays.bestAgentId = orderbook.lays.market[bestOdds][1][0][2]
-			else: # this side of book is empty
-				orderbook.lays.bestOdds = None
-				orderbook.lays.bestAgentId = None
-			cancelRecord = { 'type': 'Cancel', 'time': time, 'order': order }
-			orderbook.tape.append(cancelRecord)
-			print(orderbook.tape)
+			half = orderbook.lays
 		else:
 			# neither back nor lay?
-			sys.exit('bad order type in delOrder')
+			sys.exit('bad order type in amendOrder')
+
+		with orderbook.lock:
+			if order.orderId in half.orders and half.orders[order.orderId].agentId == order.agentId:
+				resting = half.orders[order.orderId]
+				half.bookAmendOrder(order.orderId, stake)
+				if stake <= 0:
+					# amending to nothing takes the order off the book, so it is cancelled on the tape too
+					orderbook.tape.recordCancel(time, resting)
+				self.bookChanged(orderbook)
 
 	# this returns the LOB data "published" by the exchange,
 	# i.e., what is accessible to the betting agents
 	def publishMarketState(self, time):
 		"""
-		Publish market state to betting agents, returns dictionary of best,
-		worst, number and anonymised market state
+		Publish market state to betting agents, returns immutable MarketSnapshot of
+		best, worst, number and anonymised market state for each competitor. The
+		snapshot is cached and only rebuilt for books that changed since the last call,
+		each under its own book's lock so matching on the other books carries on
 		"""
+		with self.lock:
+			version = self.version
+			sequence = 0
+			if self.depthFeed is not None:
+				sequence = self.depthFeed.sequence
+			if self.snapshot is not None and self.snapshot.version == version:
+				return self.snapshot
+		# books changed since version was read are taken as they are now, which is newer
+		# than the snapshot says so the next call looks at them again
 		competitorsMarkets = {}
 		for book in self.compOrderbooks:
-			publicData = {}
-			publicData['time'] = time
-			publicData['competitor'] = book.competitorId
-			publicData['backs'] = {'best':book.backs.bestOdds,
-									'worst':book.backs.worstOdds,
-									'n': book.backs.numOfOrders,
-									'market':book.backs.anonymisedMarket}
-			publicData['lays'] = {'best':book.lays.bestOdds,
-									'worst':book.lays.worstOdds,
-									'n': book.lays.numOfOrders,
-									'market':book.lays.anonymisedMarket}
-			publicData['QID'] = book.quoteId
-			publicData['tape'] = book.tape
-			competitorsMarkets[book.competitorId] = publicData
+			with book.lock:
+				if book.snapshot is None or book.snapshot['version'] != book.version:
+					book.snapshot = self.snapshotOrderbook(book, time)
+				competitorsMarkets[book.competitorId] = book.snapshot
+		with self.lock:
+			# another thread may have published a later version meanwhile
+			if self.snapshot is None or self.snapshot.version < version:
+				self.snapshot = MarketSnapshot(version, competitorsMarkets, sequence)
 
 			# if EXCHANGE_VERBOSE:
 			# 	print("Market Published at timestamp: " + str(time) + " - BACKS[" +
 			# 	str(publicData['backs']['market']) + "] LAYS[" +
 			# 	str(publicData['lays']['market']) + "]")
 
-		return competitorsMarkets
+		return self.snapshot
+
+	def captureTimestep(self, timestep, time):
+		"""
+		Expire the orders good until a race timestep once it is reached, then record every
+		competitor's top of book and depth at it, from the last published snapshot so
+		matching is not held up
+		"""
+		snapshot = self.snapshot
+		if self.expireTimestep(timestep, time) > 0 or snapshot is None:
+			snapshot = self.publishMarketState(time)
+		with self.lock:
+			self.snapshotRing.capture(timestep, time, snapshot)
+
+	def snapshotOrderbook(self, book, time):
+		"""
+		Take read only copy of a single orderbook's public data, returns mapping
+		of best, worst, number and anonymised market state
+		"""
+		publicData = {}
+		publicData['version'] = book.version
+		publicData['time'] = time
+		publicData['competitor'] = book.competitorId
+		publicData['backs'] = MappingProxyType({'best':book.backs.bestOdds,
+								'worst':book.backs.worstOdds,
+								'n': book.backs.numOfOrders,
+								'market':tuple(tuple(level) for level in book.backs.anonymisedMarket)})
+		publicData['lays'] = MappingProxyType({'best':book.lays.bestOdds,
+								'worst':book.lays.worstOdds,
+								'n': book.lays.numOfOrders,
+								'market':tuple(tuple(level) for level in book.lays.anonymisedMarket)})
+		publicData['QID'] = book.quoteId
+		publicData['analytics'] = MappingProxyType(book.analytics())
+		publicData['tape'] = TapeView(book.tape, len(book.tape))
+		return MappingProxyType(publicData)
 
 	def createTransactionRecord(self, orderbook, order, counterparty, odds, time, takenStake):
 		# process the trade
@@ -318,146 +780,182 @@ class Exchange(Orderbook):
 			backer = counterparty
 			layer = order.agentId
 
-		transactionRecord = { 'type': 'Trade',
-								'time': time,
-								'exchange': order.exchange,
-								'competitor': order.competitorId,
-								'odds': odds,
-								'backer':backer,
-								'layer':layer,
-								'stake': takenStake
-								}
-		orderbook.tape.append(transactionRecord)
-		#print(orderbook.tape)
+		transactionRecord = Transaction('Trade', time, order.exchange, order.competitorId, odds,
+										backer, layer, takenStake)
+		orderbook.tape.recordTrade(time, odds, backer, layer, takenStake)
+		orderbook.lastTradedOdds = odds
+		orderbook.tradedStake = orderbook.tradedStake + takenStake
+		orderbook.tradedValue = orderbook.tradedValue + (odds * takenStake)
+		self.positions.recordTrade(orderbook.competitorId, odds, backer, layer, takenStake)
+		self.exposure.recordTrade(odds, backer, layer, takenStake)
 
 		return transactionRecord
 
-	def match(self, order, orderOdds, orderStake, orderDirection, orderbook, transactions, time):
-		bestLay = orderbook.lays.bestOdds
-		bestLayAgentId = orderbook.lays.bestAgentId
-		bestBack = orderbook.backs.bestOdds
-		bestBackAgentId = orderbook.backs.bestAgentId
-
-
-
-
-		if orderDirection == 'Back':
-			if orderbook.lays.numOfOrders > 0 and bestBack <= bestLay:
-
-				# get amount staked at best lay
-				oppositeOrderStake = orderbook.lays.bestOrderStake
-
-				if orderStake == oppositeOrderStake:
-					if EXCHANGE_VERBOSE:
-						print("ORDER STAKE == OPP ORDER STAKE")
-					# bid lifts the best ask
-					if EXCHANGE_VERBOSE:
-						print("Amount staked on market covers order stake")
-						print("Back $%s lifts best lay" % orderOdds)
-					counterparty = bestLayAgentId
-					#counter_coid = self.lays.orders[counterparty].coid
-					odds = bestLay  # bid crossed ask, so use ask price
-					# delete the ask just crossed
-					orderbook.lays.bookDeleteBest(orderStake, order)
-					# delete the bid that was the latest order
-					orderbook.backs.bookDeleteBest(orderStake, order)
-
-					# create transaction record
-					transactions.append(self.createTransactionRecord(orderbook, order, counterparty, odds, time, orderStake))
-
-				elif(orderStake < oppositeOrderStake):
-					if EXCHANGE_VERBOSE:
-						print("ORDER STAKE < OPP ORDER STAKE")
-
-					counterparty = bestLayAgentId
-					odds = bestLay
-
-					orderbook.lays.bookModifyBest(orderStake, counterparty)
-					orderbook.backs.bookDeleteBest(orderStake, order)
-
-					# create transaction record
-					transactions.append(self.createTransactionRecord(orderbook, order, counterparty, odds, time, orderStake))
-
-				# else orderStake > amountStaked
-				elif(orderStake > oppositeOrderStake):
-					if EXCHANGE_VERBOSE:
-						print("ORDER STAKE > OPP ORDER STAKE")
-
-					counterparty = bestLayAgentId
-					odds = bestLay
-
-					orderbook.lays.bookDeleteBest(orderStake, order)
-					orderbook.backs.bookModifyBest(oppositeOrderStake, order.agentId)
-
-
-					# create transaction record
-					transactions.append(self.createTransactionRecord(orderbook, order, counterparty, odds, time, oppositeOrderStake))
-
-					newOrderStake = orderStake - oppositeOrderStake
-					self.match(order, orderOdds, newOrderStake, orderDirection, orderbook, transactions, time)
-			# if order odds are greater than any lays on the LOB
-			# then just leave unfilled portion of best back on the market
-			else:
-				if EXCHANGE_VERBOSE:
-					print("BACK")
-					print("ORDER partially unfilled, stake of " + str(orderStake) + " left on the market")
-
-		if orderDirection == 'Lay':
-			if orderbook.backs.numOfOrders > 0 and bestLay >= bestBack:
-
-				oppositeOrderStake = orderbook.backs.bestOrderStake
-
-				if orderStake == oppositeOrderStake:
-					# if EXCHANGE_VERBOSE:
-					# 	print("Amount staked on market covers order stake")
-
-					counterparty = bestBackAgentId
-					#counter_coid = self.bids.orders[counterparty].coid
-					odds = bestBack  # ask crossed bid, so use bid price
-					# delete the bid just crossed, from the exchange's records
-					orderbook.backs.bookDeleteBest(orderStake, order)
-					# delete the ask that was the latest order, from the exchange's records
-					orderbook.lays.bookDeleteBest(orderStake, order)
-
-					# create transaction record
-					transactions.append(self.createTransactionRecord(orderbook, order, counterparty, odds, time, orderStake))
-
-				elif(orderStake < oppositeOrderStake):
-					counterparty = bestBackAgentId
-					odds = bestBack
-
-					orderbook.lays.bookDeleteBest(orderStake, order)
-					orderbook.backs.bookModifyBest(orderStake, counterparty)
-
-					# create transaction record
-					transactions.append(self.createTransactionRecord(orderbook, order, counterparty, odds, time, orderStake))
-
-				# else orderStake > amountStaked
-				elif(orderStake > oppositeOrderStake):
-					if bestLay >= bestBack:
-						counterparty = bestBackAgentId
-						odds = bestBack
+	def match(self, order, orderbook, transactions, time):
+		"""
+		Sweep the opposite side of the book for an order in price-time order,
+		recording a transaction for every counter-order taken, then update both
+		sides of the book once at the end of the sweep
+		"""
+		if order.direction == 'Back':
+			book = orderbook.backs
+			opposite = orderbook.lays
+		else:
+			book = orderbook.lays
+			opposite = orderbook.backs
 
-						orderbook.lays.bookModifyBest(oppositeOrderStake, order.agentId)
-						orderbook.backs.bookDeleteBest(orderStake, order)
+		orderStake = order.stake
+		fills = []
+		for odds, entry in opposite.iterOrders():
+			# a back crosses lays at the same or longer odds, a lay crosses backs at the same or shorter odds
+			if order.direction == 'Back' and odds < order.odds: break
+			if order.direction == 'Lay' and odds > order.odds: break
+			# Check to make sure that betting agent does not fulfill own orders
+			if entry[2] == order.agentId: break
+
+			counterparty = entry[2]
+			takenStake = min(orderStake, entry[1])
+			if EXCHANGE_VERBOSE:
+				print(str(order.direction) + " $%s takes stake of %s at %s from %s" % (order.odds, takenStake, odds, counterparty))
+			fills.append([entry[3], takenStake])
+			# trade at the odds of the counter-order already on the book
+			transactions.append(self.createTransactionRecord(orderbook, order, counterparty, odds, time, takenStake))
+			orderStake = orderStake - takenStake
+			if orderStake == 0: break
+
+		if len(fills) > 0:
+			opposite.bookFill(fills)
+			if order.timeInForce != FILL_OR_KILL:
+				book.bookFill([[order.orderId, order.stake - orderStake]])
+
+		# if order has not been fully matched then unfilled portion is left on the market
+		if orderStake > 0 and EXCHANGE_VERBOSE:
+			print(str(order.direction))
+			print("ORDER partially unfilled, stake of " + str(orderStake) + " left on the market")
+
+
+	def fillable(self, order, orderbook):
+		"""
+		Could the order be filled in full straight away, the same sweep as match
+		without taking anything
+		"""
+		opposite = orderbook.lays if order.direction == 'Back' else orderbook.backs
+		available = 0
+		for odds, entry in opposite.iterOrders():
+			if order.direction == 'Back' and odds < order.odds: break
+			if order.direction == 'Lay' and odds > order.odds: break
+			if entry[2] == order.agentId: break
+			available = available + entry[1]
+			if available >= order.stake:
+				return True
+		return False
+
+
+	def cancelExpired(self, orders, time):
+		"""
+		Cancel orders whose time-in-force has run out, orders already filled or
+		cancelled are passed over, returns number cancelled
+		"""
+		numOfExpired = 0
+		for order in orders:
+			orderbook = self.compOrderbooks[order.competitorId]
+			half = orderbook.backs if order.direction == 'Back' else orderbook.lays
+			with orderbook.lock:
+				if half.orders.get(order.orderId) is order:
+					self.delOrder(time, order)
+					numOfExpired = numOfExpired + 1
+		return numOfExpired
+
+
+	def expireOrders(self, time):
+		"""
+		Cancel the resting orders good for some seconds whose time has run out by time,
+		returns number cancelled
+		"""
+		with self.lock:
+			expired = self.expiryWheel.advance(time)
+		return self.cancelExpired(expired, time)
 
-						# create transaction record
-						transactions.append(self.createTransactionRecord(orderbook, order, counterparty, odds, time, oppositeOrderStake))
 
-						newOrderStake = orderStake - oppositeOrderStake
-						self.match(order, orderOdds, newOrderStake, orderDirection, orderbook, transactions, time)
-						# if order odds are greater than any lays on the LOB
-						# then just leave unfilled portion of best back on the market
-			else:
-				if EXCHANGE_VERBOSE:
-					print("LAY")
-					print("ORDER partially unfilled, stake of " + str(orderStake) + " left on the market")
+	def expireTimestep(self, timestep, time):
+		"""
+		Cancel the resting orders good until a race timestep now that timestep has been
+		reached, at event time time, returns number cancelled
+		"""
+		with self.lock:
+			expired = self.timestepWheel.advance(timestep)
+		return self.cancelExpired(expired, time)
 
 
+	def executeOrder(self, time, order, transactions):
+		"""
+		Add order to the book and match it against the opposite side, appending
+		any trades to transactions
+		"""
+		# an order good until a timestep the race has already reached would only rest
+		# until the next one, so it is rejected
+		if order.timeInForce == GOOD_UNTIL_TIMESTEP and order.expiry <= self.timestepWheel.currentTick:
+			return
 
+		# retrieve orderbook for competitor in question
+		orderbook = self.compOrderbooks[order.competitorId]
+		half = orderbook.backs if order.direction == 'Back' else orderbook.lays
+		if not half.quotable(order.odds):
+			return
+
+		with orderbook.lock:
+			# pre-trade check against the agent's balance, which may only cover part of the order.
+			# The agent stays locked in the ledger until the order is on the book so that another
+			# book or exchange sharing it cannot admit an order against the same balance in between
+			with self.exposure.agentLock(order.agentId):
+				# a fill-or-kill order never rests, so it overwrites nothing
+				if order.timeInForce == FILL_OR_KILL:
+					overwritten = None
+				elif order.direction == 'Back':
+					overwritten = orderbook.backs.overwrittenOrder(order.agentId)
+				else:
+					overwritten = orderbook.lays.overwrittenOrder(order.agentId)
+				released = 0
+				if overwritten is not None:
+					released = liability(overwritten.direction, overwritten.odds, overwritten.stake)
+				stake = self.exposure.admit(order, released)
+				if stake <= 0:
+					return
+				if order.timeInForce == FILL_OR_KILL and (stake < order.stake or not self.fillable(order, orderbook)):
+					return
+				order.stake = stake
+
+				# a fill-or-kill order is matched straight off the opposite side without taking
+				# a place, or an order ID, on the book
+				response = 'Fill-or-kill'
+				if order.timeInForce != FILL_OR_KILL:
+					[order.orderId, response] = self.addOrder(order)  # add it to the order lists -- overwriting any previous order
+			if EXCHANGE_VERBOSE :
+				if order.agentId>50 and order.agentId<100:
+					print("Order ID: " + str(order.orderId))
+					print("Reponse is: " + response)
+					print(order)
+
+			if order.direction != 'Back' and order.direction != 'Lay':
+				# we should never get here
+				sys.exit('processOrder given neither Back nor Lay')
 
+			numOfTransactions = len(transactions)
+			self.match(order, orderbook, transactions, time)
 
+			# whatever is left of an order with a time-in-force rests until it expires
+			if order.timeInForce == GOOD_FOR_SECONDS or order.timeInForce == GOOD_UNTIL_TIMESTEP:
+				if half.orders.get(order.orderId) is order:
+					with self.lock:
+						if order.timeInForce == GOOD_FOR_SECONDS:
+							self.expiryWheel.schedule(time + order.expiry, order)
+						else:
+							self.timestepWheel.schedule(order.expiry, order)
 
+			# NB at this point we have deleted the order from the exchange's records
+			# but the two traders concerned still have to be notified
+			if len(transactions) > numOfTransactions:
+				self.bookChanged(orderbook)
 
 
 	def processOrder(self, time, order):
@@ -468,52 +966,10 @@ class Exchange(Orderbook):
 		"""
 		# receive an order and either add it to the relevant market (treat as limit order)
 		# or if it crosses the best counterparty offer, execute it (treat as a market order)
-
-		# retrieve orderbook for competitor in question
-		orderbook = self.compOrderbooks[order.competitorId]
-
-		orderOdds = order.odds
-		orderStake = order.stake
-		orderDirection = order.direction
-		counterparty = None
-		#counter_coid = None
-		[orderId, response] = self.addOrder(order)  # add it to the order lists -- overwriting any previous order
-		order.orderId = orderId
-		if EXCHANGE_VERBOSE :
-			if order.agentId>50 and order.agentId<100:
-				print("Order ID: " + str(order.orderId))
-				print("Reponse is: " + response)
-				print(order)
-
-		bestLay = orderbook.lays.bestOdds
-		bestLayAgentId = orderbook.lays.bestAgentId
-		bestBack = orderbook.backs.bestOdds
-		bestBackAgentId = orderbook.backs.bestAgentId
-
 		transactions = []
-		tradeOccurred = False
-
-		# if EXCHANGE_VERBOSE:
-			# print(order)
-
-		# Check to make sure that betting agent does not fulfill own orders
-		if bestLayAgentId != bestBackAgentId:
-			if orderDirection == 'Back':
-				if orderbook.lays.numOfOrders > 0 and bestBack <= bestLay:
-					self.match(order, orderOdds, orderStake, orderDirection, orderbook, transactions, time)
-					tradeOccurred = True
-
-			elif orderDirection == 'Lay':
-				if orderbook.backs.numOfOrders > 0 and bestLay >= bestBack:
-					self.match(order, orderOdds, orderStake, orderDirection, orderbook, transactions, time)
-					tradeOccurred = True
-
-			else:
-				# we should never get here
-				sys.exit('processOrder given neither Back nor Lay')
-		# NB at this point we have deleted the order from the exchange's records
-		# but the two traders concerned still have to be notified
-		# if EXCHANGE_VERBOSE: print("Counterparty: " + str(counterparty))
+		self.expireOrders(time)
+		self.executeOrder(time, order, transactions)
+		tradeOccurred = len(transactions) > 0
 
 		markets = self.publishMarketState(time)
 		# if counterparty != None:
@@ -547,36 +1003,85 @@ class Exchange(Orderbook):
 			return (None, markets)
 
 
+	def processOrders(self, time, orders):
+		"""
+		Process a burst of orders in arrival order, returns consolidated record of
+		transactions and a single market state published once the whole batch
+		has been matched
+		"""
+		transactions = []
+		self.expireOrders(time)
+		for order in orders:
+			self.executeOrder(time, order, transactions)
+
+		markets = self.publishMarketState(time)
+		if len(transactions) > 0:
+			return (transactions, markets)
+		else:
+			return (None, markets)
+
+
 	def settleUp(self, bettingAgents, winningCompetitor):
 		"""
 		Settle up bets between betting agents at end of event, updates agent's
-		balances
+		balances from their net positions
 		"""
 		print("Winner : ", winningCompetitor)
+		for agentId, profit in self.positions.settle(winningCompetitor).items():
+			bettingAgents[agentId].balance = bettingAgents[agentId].balance + profit
+
+
+	def setBalances(self, balances):
+		"""
+		Balances orders are checked against on entry, dictionary indexed by agent ID
+		"""
+		for agentId, balance in balances.items():
+			self.exposure.setBalance(agentId, balance)
+
+
+	def impliedProbabilities(self):
+		"""
+		Each competitor's probability of winning implied by its last traded odds, or the
+		middle of its best odds if it has not traded, normalised to sum to 1
+		"""
+		probabilities = []
 		for orderbook in self.compOrderbooks:
-			for trade in orderbook.tape:
-				backer = bettingAgents[trade['backer']]
-				layer = bettingAgents[trade['layer']]
-				odds = trade['odds']
-				stake = trade['stake']
-				if orderbook.competitorId == winningCompetitor:
-					backer.balance = backer.balance + (odds * stake) - stake
-					layer.balance = layer.balance - (odds * stake) + stake
-				else:
-					layer.balance = layer.balance + stake
-					backer.balance = backer.balance - stake
+			with orderbook.lock:
+				odds = orderbook.lastTradedOdds
+				if odds is None:
+					bestOdds = [half.bestOdds for half in [orderbook.backs, orderbook.lays] if half.bestOdds is not None]
+					if len(bestOdds) > 0:
+						odds = sum(bestOdds) / len(bestOdds)
+			if odds is None:
+				probabilities.append(1 / len(self.compOrderbooks))
+			else:
+				probabilities.append(1 / odds)
+		total = sum(probabilities)
+		return [probability / total for probability in probabilities]
+
+
+	def markToMarket(self, probabilities=None):
+		"""
+		Live profit and loss of each betting agent's positions, valued at the implied
+		probabilities of the current market unless given, returns dictionary indexed by agent ID
+		"""
+		if probabilities is None:
+			probabilities = self.impliedProbabilities()
+		return self.positions.markToMarket(probabilities)
 
 
 
 
 
 	def tapeDump(self, fname, fmode, tmode):
-		dumpfile = open(fname, fmode)
-		for id in range(NUM_OF_COMPETITORS):
-			orderbook = self.compOrderbooks[id]
-			for tapeitem in orderbook.tape:
-				if tapeitem['type'] == 'Trade' :
-					dumpfile.write('%s, %s\n' % (tapeitem['time'], tapeitem['odds']))
-			dumpfile.close()
-			if tmode == 'wipe':
-				orderbook.tape = []
+		"""
+		Write the tapes of all orderbooks to file in one go, for streaming them
+		during a session use a TapeWriter instead
+		"""
+		writer = TapeWriter([self], fname, fmode)
+		writer.close()
+		if tmode == 'wipe':
+			for orderbook in self.compOrderbooks:
+				with orderbook.lock:
+					orderbook.tape = Tape(self.id, orderbook.competitorId)
+					self.bookChanged(orderbook)
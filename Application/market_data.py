@@ -0,0 +1,245 @@
+### ~ THREADED BRISTOL BETTING EXCHANGE ~ ###
+
+# Incremental depth market data, only the price levels that changed rather than whole markets,
+# histories of the top of book captured at every race timestep, and conflated delivery of
+# market state to betting agents that cannot keep up with it
+
+import csv, queue, threading, time
+from collections import namedtuple, deque
+from types import MappingProxyType
+import numpy as np
+from system_constants import DEPTH_FEED_LENGTH, SNAPSHOT_RING_LENGTH
+
+# new total stake at a price level of one side of a competitor's orderbook, a stake
+# of 0 means the price level has gone from the market
+DepthDelta = namedtuple('DepthDelta', ['sequence', 'competitor', 'side', 'odds', 'stake'])
+
+
+class DepthFeed:
+    """
+    Sequenced log of depth deltas published by an exchange, only the most recent
+    deltas are kept so readers that fall too far behind have to recover from a snapshot
+    """
+    def __init__(self, length=DEPTH_FEED_LENGTH):
+        self.length = length
+        self.sequence = 0
+        self.deltas = []
+
+    def publish(self, competitor, side, odds, stake):
+        self.sequence = self.sequence + 1
+        self.deltas.append(DepthDelta(self.sequence, competitor, side, odds, stake))
+        if len(self.deltas) > 2 * self.length:
+            # replace rather than trim in place so readers on other threads keep a whole list
+            self.deltas = self.deltas[-self.length:]
+
+    def read(self, afterSequence):
+        """
+        Deltas published after the given sequence number, returns None if some of
+        them are no longer held
+        """
+        deltas = self.deltas
+        if len(deltas) == 0 or afterSequence >= deltas[-1].sequence:
+            return []
+        start = afterSequence + 1 - deltas[0].sequence
+        if start < 0:
+            return None
+        return deltas[start:]
+
+
+class DepthBook:
+    """
+    Local copy of an exchange's depth built from a market snapshot and kept up to
+    date by applying depth deltas, a gap in the sequence triggers recovery
+    """
+    def __init__(self, exchange):
+        self.exchange = exchange
+        self.sequence = 0
+        # competitor ID -> side -> {odds: stake}
+        self.depth = {}
+
+    def recover(self, time):
+        """
+        Rebuild the whole depth from a fresh market snapshot
+        """
+        snapshot = self.exchange.publishMarketState(time)
+        self.depth = {}
+        for competitor, market in snapshot.items():
+            self.depth[competitor] = {'Back': dict(market['backs']['market']),
+                                      'Lay': dict(market['lays']['market'])}
+        self.sequence = snapshot.sequence
+
+    def apply(self, delta):
+        """
+        Apply a single depth delta, returns False without applying it if it does not
+        follow on from the last delta applied
+        """
+        if delta.sequence <= self.sequence:
+            return True
+        if delta.sequence != self.sequence + 1:
+            return False
+        levels = self.depth.setdefault(delta.competitor, {'Back': {}, 'Lay': {}})[delta.side]
+        if delta.stake > 0:
+            levels[delta.odds] = delta.stake
+        else:
+            levels.pop(delta.odds, None)
+        self.sequence = delta.sequence
+        return True
+
+    def update(self, time):
+        """
+        Catch up with the exchange's depth feed, recovering from a snapshot on a gap
+        """
+        deltas = self.exchange.depthFeed.read(self.sequence)
+        if deltas is None:
+            self.recover(time)
+            return
+        for delta in deltas:
+            if not self.apply(delta):
+                self.recover(time)
+                return
+
+    def market(self, competitor, side):
+        """
+        Price levels of one side of a competitor's orderbook sorted by odds, in the
+        same order as the anonymised market of a snapshot
+        """
+        levels = self.depth.get(competitor, {}).get(side, {})
+        return sorted(levels.items())
+
+    def best(self, competitor, side):
+        levels = self.depth.get(competitor, {}).get(side, {})
+        if len(levels) == 0:
+            return None
+        if side == 'Back':
+            return min(levels)
+        return max(levels)
+
+
+# book analytics kept for each competitor at each race timestep, NaN where the book had none
+SNAPSHOT_FIELDS = ['bestBack', 'bestBackStake', 'bestLay', 'bestLayStake', 'backDepth', 'layDepth',
+                   'microprice', 'spread', 'lastTradedOdds', 'tradedStake']
+SNAPSHOT_RECORD = np.dtype([('timestep', 'i4'), ('time', 'f8')] + [(field, 'f8') for field in SNAPSHOT_FIELDS])
+
+
+class SnapshotRing:
+    """
+    Top of book and depth of every competitor captured from an exchange's published
+    snapshots once per race timestep, held in a preallocated ring so the most recent
+    timesteps are kept whatever the length of the race
+    """
+    def __init__(self, numOfCompetitors, length=SNAPSHOT_RING_LENGTH):
+        self.length = length
+        # one row per captured timestep, one record per competitor
+        self.records = np.zeros((length, numOfCompetitors), dtype=SNAPSHOT_RECORD)
+        self.numOfCaptures = 0
+
+    def capture(self, timestep, time, snapshot):
+        row = self.records[self.numOfCaptures % self.length]
+        for competitorId, market in snapshot.items():
+            analytics = market['analytics']
+            row[competitorId] = (timestep, time) + tuple(np.nan if analytics[field] is None else analytics[field]
+                                                         for field in SNAPSHOT_FIELDS)
+        self.numOfCaptures = self.numOfCaptures + 1
+
+    def history(self):
+        """
+        Captured records oldest first, returns array of timesteps by competitors
+        """
+        if self.numOfCaptures <= self.length:
+            return self.records[:self.numOfCaptures].copy()
+        start = self.numOfCaptures % self.length
+        return np.concatenate((self.records[start:], self.records[:start]))
+
+    def export(self, fileName, exchangeId, mode='w'):
+        """
+        Write the history to a CSV file, one line per competitor per timestep
+        """
+        history = self.history()
+        with open(fileName, mode, newline='') as file:
+            writer = csv.writer(file)
+            if file.tell() == 0:
+                writer.writerow(['exchange', 'competitor', 'timestep', 'time'] + SNAPSHOT_FIELDS)
+            for row in history:
+                for competitorId, record in enumerate(row):
+                    writer.writerow([exchangeId, competitorId] + list(record.item()))
+
+
+class ConflatingQueue:
+    """
+    Betting agent's message queue that conflates market state, the agent's own fills and
+    race updates are delivered exactly and in order while only the latest market state
+    of each exchange is kept, so a slow agent's backlog is bounded by its own trades.
+    Messages are taken off as from a queue.Queue, and market state read with latestMarkets
+    """
+    def __init__(self, agentId):
+        self.agentId = agentId
+        self.messages = deque()
+        # latest market snapshot received from each exchange, indexed by exchange ID
+        self.markets = {}
+        # exchanges whose latest snapshot the agent has not read yet
+        self.unread = set()
+        # number of snapshots replaced before the agent read them
+        self.numOfConflated = 0
+        self.lock = threading.Lock()
+        self.notEmpty = threading.Condition(self.lock)
+
+    def put(self, update, block=True, timeout=None):
+        # never full, so never blocks
+        with self.lock:
+            self.messages.append(update)
+            self.notEmpty.notify()
+
+    def putMarkets(self, exchangeId, markets):
+        """
+        Replace the market snapshot of an exchange, unless it is already held or newer
+        """
+        with self.lock:
+            previous = self.markets.get(exchangeId)
+            if previous is not None and markets.version <= previous.version:
+                return
+            if exchangeId in self.unread:
+                self.numOfConflated = self.numOfConflated + 1
+            self.markets[exchangeId] = markets
+            self.unread.add(exchangeId)
+
+    def get(self, block=True, timeout=None):
+        """
+        Take the oldest message off the queue, waiting for one as queue.Queue.get does
+        """
+        with self.notEmpty:
+            if not block:
+                if len(self.messages) == 0:
+                    raise queue.Empty
+            elif timeout is None:
+                while len(self.messages) == 0:
+                    self.notEmpty.wait()
+            elif timeout < 0:
+                raise ValueError("'timeout' must be a non-negative number")
+            else:
+                deadline = time.monotonic() + timeout
+                while len(self.messages) == 0:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise queue.Empty
+                    self.notEmpty.wait(remaining)
+            return self.messages.popleft()
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def empty(self):
+        with self.lock:
+            return len(self.messages) == 0
+
+    def qsize(self):
+        with self.lock:
+            return len(self.messages)
+
+    def latestMarkets(self):
+        """
+        Latest market snapshot received from each exchange, returns read only
+        dictionary indexed by exchange ID
+        """
+        with self.lock:
+            self.unread.clear()
+            return MappingProxyType(dict(self.markets))
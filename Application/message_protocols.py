@@ -2,13 +2,26 @@
 
 # Message protocols for information transfer between Exchange and Betting Agents
 
+from collections import namedtuple
+from collections.abc import Mapping, Sequence
 from system_constants import *
 
+# time-in-force of an order
+GOOD_TILL_CANCELLED = 'GTC'
+GOOD_FOR_SECONDS = 'GFS'      # expiry is how long the order rests for once it reaches the exchange
+GOOD_UNTIL_TIMESTEP = 'GUT'   # expiry is the timestep the order rests until
+FILL_OR_KILL = 'FOK'          # traded in full straight away or not at all
+
 class Order:
     """
-    Protocol for issuing a new order, from betting agent to exchange
+    Protocol for issuing a new order, from betting agent to exchange, slotted as
+    thousands are in flight at once
     """
-    def __init__(self, exchange, agentId, competitorId, direction, odds, stake, orderId, timestamp):
+    __slots__ = ('exchange', 'agentId', 'competitorId', 'direction', 'odds', 'stake', 'orderId',
+                 'timestamp', 'timeInForce', 'expiry')
+
+    def __init__(self, exchange, agentId, competitorId, direction, odds, stake, orderId, timestamp,
+                 timeInForce=GOOD_TILL_CANCELLED, expiry=None):
         self.exchange = exchange
         self.agentId = agentId
         self.competitorId = competitorId
@@ -17,6 +30,8 @@ class Order:
         self.stake = stake
         self.orderId = orderId
         self.timestamp = timestamp
+        self.timeInForce = timeInForce
+        self.expiry = expiry
 
     def __str__(self):
         return ("Order: [Agent ID: " + str(self.agentId) +
@@ -25,21 +40,93 @@ class Order:
                 str(self.odds) + " Stake: " + str(self.stake) + " Order ID: " +
                 str(self.orderId) + " Timestamp: " + str(self.timestamp) + "]")
 
-class exchangeUpdate:
+class Transaction(namedtuple('Transaction', ['type', 'time', 'exchange', 'competitor', 'odds',
+                                             'backer', 'layer', 'stake'])):
+    """
+    Record of a trade or cancellation, a tuple whose fields can also be read by
+    name as transaction['stake']
+    """
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return getattr(self, key)
+        return tuple.__getitem__(self, key)
+
+class exchangeUpdate(namedtuple('exchangeUpdate', ['transactions', 'order'])):
+    """
+    Protocol for transfer of trade information between exchange and betting agents,
+    order is the batch of orders that were matched to produce the transactions.
+    Market state is not carried, agents read it from the exchange's published snapshot.
+    Immutable, so one update can be shared by every agent it is sent to
+    """
+    __slots__ = ()
+    protocolNum = EXCHANGE_UPDATE_MSG_NUM
+
+def fillsByAgent(transactions):
+    """
+    Transactions each betting agent took part in, returns dictionary of tuples of
+    transactions indexed by agent ID, with only the backers and layers as keys
+    """
+    fills = {}
+    for transaction in transactions:
+        fills.setdefault(transaction['backer'], []).append(transaction)
+        if transaction['layer'] != transaction['backer']:
+            fills.setdefault(transaction['layer'], []).append(transaction)
+    return {agentId: tuple(agentFills) for agentId, agentFills in fills.items()}
+
+class raceUpdate(namedtuple('raceUpdate', ['timestep', 'compDistances'])):
     """
-    Protocol for transfer of trade information between exchange and betting agents
+    Protocol for transfer of new race information to betting agents, immutable and
+    shared by every betting agent
     """
-    def __init__(self, transactions, order, markets):
-        self.protocolNum = EXCHANGE_UPDATE_MSG_NUM
-        self.transactions = transactions
-        self.order = order
-        self.markets = markets
+    __slots__ = ()
+    protocolNum = RACE_UPDATE_MSG_NUM
 
-class raceUpdate:
+class MarketSnapshot(Mapping):
     """
-    Protocol for transfer of new race information to betting agents
+    Immutable market state published by an exchange, indexed by competitor ID and
+    tagged with the exchange version it was taken at, so readers can tell whether
+    anything has changed since they last looked. sequence is the number of the last
+    depth delta the snapshot includes
     """
-    def __init__(self, timestep, competitorDistances):
-        self.protocolNum = RACE_UPDATE_MSG_NUM
-        self.timestep = timestep
-        self.compDistances = competitorDistances
+    __slots__ = ('version', 'competitorsMarkets', 'sequence')
+
+    def __init__(self, version, competitorsMarkets, sequence=0):
+        self.version = version
+        self.competitorsMarkets = competitorsMarkets
+        self.sequence = sequence
+
+    def __getitem__(self, competitorId):
+        return self.competitorsMarkets[competitorId]
+
+    def __iter__(self):
+        return iter(self.competitorsMarkets)
+
+    def __len__(self):
+        return len(self.competitorsMarkets)
+
+class TapeView(Sequence):
+    """
+    Read only view of the records on an orderbook tape at the time a snapshot was taken
+    """
+    __slots__ = ('tape', 'length')
+
+    def __init__(self, tape, length):
+        self.tape = tape
+        self.length = length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.tape[i] for i in range(*index.indices(self.length))]
+        if index < 0:
+            index = index + self.length
+        if index < 0 or index >= self.length:
+            raise IndexError('tape index out of range')
+        return self.tape[index]
+
+    def __iter__(self):
+        return self.tape.iterRecords(0, self.length)
+
+    def __len__(self):
+        return self.length
@@ -0,0 +1,166 @@
+### ~ THREADED BRISTOL BETTING EXCHANGE ~ ###
+
+# Capture of the order flow into the exchanges and replay of it into fresh exchanges
+# as fast as they can match it, so a session's matching can be reproduced and profiled
+#
+# python orderflow.py <order flow file> [tape file]
+
+import sys, struct, threading, time, math
+from system_constants import NUM_OF_COMPETITORS
+from message_protocols import Order, GOOD_TILL_CANCELLED, GOOD_FOR_SECONDS, GOOD_UNTIL_TIMESTEP, FILL_OR_KILL
+from exchange import Exchange
+from positions import ExposureLedger
+
+ORDER_FLOW_MAGIC = b'BBEOF3\n'
+# kind of each record in the file, followed by the record itself
+RECORD_KIND = struct.Struct('<B')
+BATCH_RECORD = 0
+BALANCES_RECORD = 1
+TIMESTEP_RECORD = 2
+# batch of orders taken off an exchange's queue: time in event and number of orders
+BATCH = struct.Struct('<dI')
+# balances orders are checked against: number of agents, then agent and balance of each
+BALANCES = struct.Struct('<I')
+BALANCE = struct.Struct('<id')
+# race timestep reached, expiring the orders good until it: timestep and time in event
+TIMESTEP = struct.Struct('<id')
+# order as sent by a betting agent: exchange, agent, competitor, direction, odds, stake,
+# order ID, timestamp, time-in-force and expiry (NaN if none)
+ORDER = struct.Struct('<iiibddqdbd')
+DIRECTIONS = ['Back', 'Lay']
+TIMES_IN_FORCE = [GOOD_TILL_CANCELLED, GOOD_FOR_SECONDS, GOOD_UNTIL_TIMESTEP, FILL_OR_KILL]
+
+
+class OrderFlowRecorder:
+    """
+    Appends every batch of orders taken off the exchanges' queues to a binary file,
+    with the time in event the batch was matched at, the balances the orders were
+    checked against and the race timesteps reached
+    """
+    def __init__(self, fileName):
+        self.file = open(fileName, 'wb')
+        self.file.write(ORDER_FLOW_MAGIC)
+        # exchanges run on their own threads but share the file
+        self.lock = threading.Lock()
+        self.numOfOrders = 0
+
+    def recordBalances(self, balances):
+        # balances dictionary indexed by agent ID, applied to every exchange on replay
+        chunk = [RECORD_KIND.pack(BALANCES_RECORD), BALANCES.pack(len(balances))]
+        for agentId, balance in balances.items():
+            chunk.append(BALANCE.pack(agentId, balance))
+        with self.lock:
+            self.file.write(b''.join(chunk))
+
+    def recordTimestep(self, timestep, time):
+        with self.lock:
+            self.file.write(RECORD_KIND.pack(TIMESTEP_RECORD) + TIMESTEP.pack(timestep, time))
+
+    def record(self, time, orders):
+        # packed before matching takes any stake off the orders
+        chunk = [RECORD_KIND.pack(BATCH_RECORD), BATCH.pack(time, len(orders))]
+        for order in orders:
+            chunk.append(ORDER.pack(order.exchange, order.agentId, order.competitorId,
+                                    DIRECTIONS.index(order.direction), order.odds, order.stake,
+                                    order.orderId, order.timestamp, TIMES_IN_FORCE.index(order.timeInForce),
+                                    math.nan if order.expiry is None else order.expiry))
+        with self.lock:
+            self.file.write(b''.join(chunk))
+            self.numOfOrders = self.numOfOrders + len(orders)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def readRecords(fileName):
+    """
+    Read a recorded order flow, yields (BATCH_RECORD, (time, batch of orders)),
+    (BALANCES_RECORD, dictionary of balances indexed by agent ID) and
+    (TIMESTEP_RECORD, (timestep, time)) in recorded order
+    """
+    with open(fileName, 'rb') as file:
+        data = file.read()
+    if not data.startswith(ORDER_FLOW_MAGIC):
+        raise ValueError(fileName + ' is not an order flow file')
+    offset = len(ORDER_FLOW_MAGIC)
+    while offset < len(data):
+        kind, = RECORD_KIND.unpack_from(data, offset)
+        offset = offset + RECORD_KIND.size
+        if kind == BALANCES_RECORD:
+            numOfAgents, = BALANCES.unpack_from(data, offset)
+            offset = offset + BALANCES.size
+            balances = dict(BALANCE.iter_unpack(data[offset:offset + numOfAgents * BALANCE.size]))
+            offset = offset + numOfAgents * BALANCE.size
+            yield kind, balances
+            continue
+        if kind == TIMESTEP_RECORD:
+            yield kind, TIMESTEP.unpack_from(data, offset)
+            offset = offset + TIMESTEP.size
+            continue
+        time, numOfOrders = BATCH.unpack_from(data, offset)
+        offset = offset + BATCH.size
+        orders = []
+        for exchange, agentId, competitorId, direction, odds, stake, orderId, timestamp, timeInForce, expiry in \
+                ORDER.iter_unpack(data[offset:offset + numOfOrders * ORDER.size]):
+            orders.append(Order(exchange, agentId, competitorId, DIRECTIONS[direction], odds, stake,
+                                orderId, timestamp, TIMES_IN_FORCE[timeInForce],
+                                None if math.isnan(expiry) else expiry))
+        offset = offset + numOfOrders * ORDER.size
+        yield kind, (time, orders)
+
+
+def readOrderFlow(fileName):
+    """
+    Read a recorded order flow, yields (time, batch of orders) in recorded order
+    """
+    for kind, record in readRecords(fileName):
+        if kind == BATCH_RECORD:
+            yield record
+
+
+def replayOrderFlow(fileName, numOfCompetitors=NUM_OF_COMPETITORS, exchanges=None):
+    """
+    Feed a recorded order flow into exchanges as fast as they match it, fresh exchanges
+    are created for the exchange IDs in the flow unless given, sharing one exposure
+    ledger as in the session, returns dictionary of exchanges indexed by exchange ID
+    """
+    if exchanges is None:
+        exchanges = {}
+    exposure = ExposureLedger()
+    for kind, record in readRecords(fileName):
+        if kind == BALANCES_RECORD:
+            for agentId, balance in record.items():
+                exposure.setBalance(agentId, balance)
+            for exchange in exchanges.values():
+                if exchange.exposure is not exposure:
+                    exchange.setBalances(record)
+            continue
+        if kind == TIMESTEP_RECORD:
+            timestep, time = record
+            for exchange in exchanges.values():
+                exchange.expireTimestep(timestep, time)
+            continue
+        time, orders = record
+        # a batch only ever comes off a single exchange's queue
+        exchangeId = orders[0].exchange
+        if exchangeId not in exchanges:
+            exchanges[exchangeId] = Exchange(exchangeId, numOfCompetitors, exposure=exposure)
+        exchanges[exchangeId].processOrders(time, orders)
+    return exchanges
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit('usage: python orderflow.py <order flow file> [tape file]')
+    start = time.time()
+    exchanges = replayOrderFlow(sys.argv[1])
+    duration = time.time() - start
+    numOfOrders = sum(len(orders) for t, orders in readOrderFlow(sys.argv[1]))
+    numOfRecords = sum(len(orderbook.tape) for exchange in exchanges.values() for orderbook in exchange.compOrderbooks)
+    print("Replayed %d orders in %.3f seconds (%.0f orders/sec), %d tape records" %
+          (numOfOrders, duration, numOfOrders / duration if duration > 0 else 0, numOfRecords))
+    if len(sys.argv) > 2:
+        # exchanges appear in the order first traded on, dump them in exchange ID order
+        for id in sorted(exchanges):
+            exchanges[id].tapeDump(sys.argv[2], 'w' if id == min(exchanges) else 'a', 'keep')
@@ -0,0 +1,213 @@
+### ~ THREADED BRISTOL BETTING EXCHANGE ~ ###
+
+# Net positions and exposure of betting agents, kept up to date as orders and trades happen
+
+import math, threading
+import numpy as np
+
+# rows of a position, each held per competitor
+BACK_STAKE = 0   # total stake backed
+BACK_RETURN = 1  # total of odds * stake backed
+LAY_STAKE = 2    # total stake laid
+LAY_RETURN = 3   # total of odds * stake laid
+NUM_OF_POSITION_ROWS = 4
+
+
+class PositionLedger:
+    """
+    Net back and lay exposure of every betting agent that has traded on an exchange,
+    one (agent, row, competitor) array so settlement and marking to market are whole
+    array operations rather than a walk over the tape
+    """
+    def __init__(self, numOfCompetitors, capacity=64):
+        self.numOfCompetitors = numOfCompetitors
+        self.positions = np.zeros((capacity, NUM_OF_POSITION_ROWS, numOfCompetitors))
+        # agent ID -> index of its position, and agent ID at each index
+        self.agentIndex = {}
+        self.agentIds = []
+        # trades on different books of an exchange are recorded from their own threads
+        self.lock = threading.Lock()
+
+    def index(self, agentId):
+        if agentId in self.agentIndex:
+            return self.agentIndex[agentId]
+        index = len(self.agentIds)
+        if index == len(self.positions):
+            grown = np.zeros((2 * len(self.positions), NUM_OF_POSITION_ROWS, self.numOfCompetitors))
+            grown[:index] = self.positions
+            self.positions = grown
+        self.agentIndex[agentId] = index
+        self.agentIds.append(agentId)
+        return index
+
+    def recordTrade(self, competitor, odds, backer, layer, stake):
+        with self.lock:
+            # indexes first as a new agent may grow the positions array
+            backIndex = self.index(backer)
+            layIndex = self.index(layer)
+            backPosition = self.positions[backIndex]
+            backPosition[BACK_STAKE, competitor] += stake
+            backPosition[BACK_RETURN, competitor] += odds * stake
+            layPosition = self.positions[layIndex]
+            layPosition[LAY_STAKE, competitor] += stake
+            layPosition[LAY_RETURN, competitor] += odds * stake
+
+    def profits(self):
+        """
+        Profit of every agent on each competitor if that competitor wins and if it
+        loses, returns (ifWins, ifLoses) arrays of shape (agents, competitors)
+        """
+        positions = self.positions[:len(self.agentIds)]
+        backStake = positions[:, BACK_STAKE]
+        layStake = positions[:, LAY_STAKE]
+        ifWins = positions[:, BACK_RETURN] - backStake - positions[:, LAY_RETURN] + layStake
+        ifLoses = layStake - backStake
+        return ifWins, ifLoses
+
+    def settle(self, winningCompetitor):
+        """
+        Profit of every agent once the winning competitor is known, returns
+        dictionary of agent ID to profit
+        """
+        with self.lock:
+            ifWins, ifLoses = self.profits()
+            profit = ifLoses.sum(axis=1) + ifWins[:, winningCompetitor] - ifLoses[:, winningCompetitor]
+            return dict(zip(self.agentIds, profit.tolist()))
+
+    def markToMarket(self, probabilities):
+        """
+        Expected profit of every agent given each competitor's probability of winning,
+        returns dictionary of agent ID to profit
+        """
+        with self.lock:
+            ifWins, ifLoses = self.profits()
+            profit = ifLoses.sum(axis=1) + (ifWins - ifLoses) @ np.asarray(probabilities, dtype=float)
+            return dict(zip(self.agentIds, profit.tolist()))
+
+
+def liability(direction, odds, stake):
+    """
+    Most a bet can lose, the stake of a back or the winnings owed on a lay
+    """
+    if direction == 'Back':
+        return stake
+    return stake * (odds - 1)
+
+
+class ExposureLedger:
+    """
+    Liability of every betting agent's open orders and matched bets, kept up to date
+    as orders are added, overwritten, cancelled and filled so an order can be checked
+    against the agent's balance in constant time on entry. A session keeps one ledger
+    that all of its exchanges share, so an agent's balance covers its orders on every
+    exchange together. Back and lay liabilities are added rather than netted against each other
+    """
+    def __init__(self):
+        # indexed by agent ID, agents without a balance are not checked
+        self.balances = {}
+        self.openLiability = {}
+        self.matchedLiability = {}
+        # liability set aside for orders on their way to a shard, indexed by agent ID
+        self.reserved = {}
+        self.numOfRejections = 0
+        # exchanges sharing the ledger change it from their own threads, each held briefly
+        self.lock = threading.RLock()
+        # held while an agent's order is checked and put on a book, indexed by agent ID
+        self.agentLocks = {}
+        # open and matched liability changed since last collected, indexed by agent ID,
+        # only kept when the ledger is a shard's and reports its changes back
+        self.trackChanges = False
+        self.changes = {}
+
+    def setBalance(self, agentId, balance):
+        with self.lock:
+            self.balances[agentId] = balance
+
+    def exposure(self, agentId):
+        with self.lock:
+            return (self.openLiability.get(agentId, 0) + self.matchedLiability.get(agentId, 0) +
+                    self.reserved.get(agentId, 0))
+
+    def headroom(self, agentId):
+        """
+        Liability the agent's balance can still take on, None if it is not checked
+        """
+        with self.lock:
+            if agentId not in self.balances:
+                return None
+            return self.balances[agentId] - self.exposure(agentId)
+
+    def openChanged(self, agentId, direction, odds, stake):
+        # stake is the change in an open order's stake, negative when taken off the market
+        with self.lock:
+            self.changeLiability(agentId, liability(direction, odds, stake), 0)
+
+    def recordTrade(self, odds, backer, layer, stake):
+        with self.lock:
+            self.changeLiability(backer, 0, stake)
+            self.changeLiability(layer, 0, stake * (odds - 1))
+
+    def changeLiability(self, agentId, openChange, matchedChange):
+        self.openLiability[agentId] = self.openLiability.get(agentId, 0) + openChange
+        self.matchedLiability[agentId] = self.matchedLiability.get(agentId, 0) + matchedChange
+        if self.trackChanges:
+            change = self.changes.setdefault(agentId, [0, 0])
+            change[0] = change[0] + openChange
+            change[1] = change[1] + matchedChange
+
+    def collectChanges(self):
+        """
+        Open and matched liability changed since last collected, as dictionary of
+        agent ID to [open change, matched change]
+        """
+        with self.lock:
+            changes = self.changes
+            self.changes = {}
+            return changes
+
+    def applyChanges(self, changes):
+        """
+        Take on the liability changes collected from another ledger, such as a shard's
+        """
+        with self.lock:
+            for agentId, (openChange, matchedChange) in changes.items():
+                self.changeLiability(agentId, openChange, matchedChange)
+
+    def agentLock(self, agentId):
+        """
+        Lock of a single agent, so an order can be checked against its balance and put
+        on a book without orders of any other agent waiting
+        """
+        with self.lock:
+            lock = self.agentLocks.get(agentId)
+            if lock is None:
+                lock = threading.RLock()
+                self.agentLocks[agentId] = lock
+            return lock
+
+    def reserve(self, agentId, amount):
+        with self.lock:
+            self.reserved[agentId] = self.reserved.get(agentId, 0) + amount
+
+    def release(self, agentId, amount):
+        with self.lock:
+            self.reserved[agentId] = self.reserved[agentId] - amount
+
+    def admit(self, order, released=0):
+        """
+        Stake of an order the agent's balance covers, given the liability released by
+        the order it overwrites. The stake is trimmed to whole units if the balance only
+        covers part of it, 0 if the order should be rejected
+        """
+        with self.lock:
+            if order.agentId not in self.balances:
+                return order.stake
+            available = self.headroom(order.agentId) + released
+            if liability(order.direction, order.odds, order.stake) <= available:
+                return order.stake
+            stake = 0
+            if available > 0:
+                stake = math.floor(available / liability(order.direction, order.odds, 1))
+            if stake <= 0:
+                self.numOfRejections = self.numOfRejections + 1
+            return stake
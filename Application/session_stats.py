@@ -7,53 +7,39 @@ import pandas as pd
 # getExAnteOdds, getInPlayOdds
 
 
+def publishedMarkets(timestep, ex):
+    # last snapshot the exchange published, it is immutable so safe to read while the
+    # exchange thread carries on matching
+    if ex.snapshot is None:
+        return ex.publishMarketState(timestep)
+    return ex.snapshot
+
 def recordPrices(timestep, exchanges, record):
     for id, ex in exchanges.items():
         compData = {}
-        for orderbook in ex.compOrderbooks:
-            ob = orderbook.backs.bestOdds
-            ol = orderbook.lays.bestOdds
+        for competitorId, market in publishedMarkets(timestep, ex).items():
+            analytics = market['analytics']
+            ob = analytics['bestBack']
+            ol = analytics['bestLay']
 
             if(ob == None and ol == None):
-                compData[orderbook.competitorId] = MAX_ODDS
+                compData[competitorId] = MAX_ODDS
             elif(ob == None):
-                compData[orderbook.competitorId] = ol
+                compData[competitorId] = ol
             elif(ol == None):
-                compData[orderbook.competitorId] = ob
+                compData[competitorId] = ob
             else:
-                print(ob)
-                print(ol)
-                print(orderbook.backs.market)
-                print("BANG")
-                print(orderbook.lays.market)
-                qtyB = orderbook.backs.market[ob][0]
-                qtyL = orderbook.lays.market[ol][0]
-
-                microprice = ((ob * qtyL) + (ol * qtyB)) / (qtyB + qtyL)
-                #if ob == None: ob = MAX_ODDS
-                compData[orderbook.competitorId] = microprice
+                compData[competitorId] = analytics['microprice']
 
         record[timestep] = compData
 
 def recordSpread(timestep, exchanges, record):
     for id, ex in exchanges.items():
         compData = {}
-        for orderbook in ex.compOrderbooks:
-            ob = orderbook.backs.bestOdds
-            ol = orderbook.lays.bestOdds
-
-
-            # if(ob == None and ol == None):
-            #     compData[orderbook.competitorId] = None
-            # elif(ob == None):
-            #     compData[orderbook.competitorId] = None
-            # elif(ol == None):
-            #     compData[orderbook.competitorId] = None
-            if(ob != None and ol != None):
-                spread = abs((1/ob) - (1/ol))
-                #if ob == None: ob = MAX_ODDS
-                if spread != 0:
-                    compData[orderbook.competitorId] = spread
+        for competitorId, market in publishedMarkets(timestep, ex).items():
+            spread = market['analytics']['spread']
+            if spread != None and spread != 0:
+                compData[competitorId] = spread
 
         record[timestep] = compData
 
@@ -149,10 +135,7 @@ def transactions(trades, simId):
     header = ["type", "time", "exchange", "competitor", "odds", "backer", "layer", "stake"]
     tape = []
     for val in trades:
-        temp = []
-        for i, v in val.items():
-            temp.append(v)
-        tape.append(temp)
+        tape.append(list(val))
 
 
     fileName = "transactions_" + str(simId) + ".csv"
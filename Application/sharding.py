@@ -0,0 +1,286 @@
+### ~ THREADED BRISTOL BETTING EXCHANGE ~ ###
+
+# Exchange whose competitor orderbooks are matched in worker processes, each worker
+# holding a shard of the competitors. The books are independent of each other so
+# orders are routed to the worker holding their competitor and only the market data
+# and tape records of changed books come back
+
+import multiprocessing, threading
+from types import MappingProxyType
+from system_constants import TICK_LADDER, MAX_ORDERS_PER_AGENT, EXCHANGE_SHARDS
+from message_protocols import TapeView
+from exchange import Exchange, synchronised
+from tape import Tape
+from positions import liability
+
+
+def shardWorker(connection, exchangeId, numOfCompetitors, competitorIds, tickLadder, maxOrdersPerAgent):
+    """
+    Worker process matching the orders of a shard of an exchange's competitors,
+    runs until told to stop
+    """
+    exchange = Exchange(exchangeId, numOfCompetitors, tickLadder, maxOrdersPerAgent)
+    # the exchange's shared ledger is told of every change to the shard's exposure
+    exchange.exposure.trackChanges = True
+    books = [exchange.compOrderbooks[competitorId] for competitorId in competitorIds]
+    cursors = {book.competitorId: book.tape.cursor() for book in books}
+    sentVersions = {}
+
+    def shardUpdate(time):
+        # public data and new tape records of the books that changed since the last update
+        markets = {}
+        tapes = {}
+        for book in books:
+            if sentVersions.get(book.competitorId) == book.version:
+                continue
+            sentVersions[book.competitorId] = book.version
+            snapshot = exchange.snapshotOrderbook(book, time)
+            publicData = {key: snapshot[key] for key in ['time', 'competitor', 'QID']}
+            publicData['backs'] = dict(snapshot['backs'])
+            publicData['lays'] = dict(snapshot['lays'])
+            publicData['analytics'] = dict(snapshot['analytics'])
+            markets[book.competitorId] = publicData
+            columns = cursors[book.competitorId].readColumns()
+            if len(columns['type']) > 0:
+                tapes[book.competitorId] = columns
+        return markets, tapes
+
+    while True:
+        command, args = connection.recv()
+        if command == 'stop':
+            break
+        transactions = []
+        time = None
+        if command == 'executeOrders':
+            time, orders, headrooms = args
+            # agents may only take on the liability set aside for them on top of what they
+            # already have on this shard
+            for agentId, headroom in headrooms.items():
+                exchange.exposure.setBalance(agentId, exchange.exposure.exposure(agentId) + headroom)
+            exchange.expireOrders(time)
+            for order in orders:
+                exchange.executeOrder(time, order, transactions)
+        elif command == 'publish':
+            time = args[0]
+        elif command == 'expireTimestep':
+            timestep, time = args
+            exchange.expireTimestep(timestep, time)
+        elif command in ['delOrder', 'amendOrder', 'expireOrders']:
+            time = args[0]
+            getattr(exchange, command)(*args)
+        else:
+            # anything else leaves the books alone, so there is nothing to publish
+            getattr(exchange, command)(*args)
+        update = ({}, {}) if time is None else shardUpdate(time)
+        connection.send((transactions, update, exchange.exposure.collectChanges()))
+    connection.close()
+
+
+class ShardOrderbookHalf:
+    """
+    Best, worst and number of orders of one side of a book held by a worker
+    """
+    def __init__(self, booktype):
+        self.booktype = booktype
+        self.bestOdds = None
+        self.worstOdds = None
+        self.numOfOrders = 0
+
+
+class ShardOrderbook:
+    """
+    Exchange side copy of the public data and tape of a book held by a worker
+    """
+    def __init__(self, exchangeId, competitorId):
+        self.competitorId = competitorId
+        self.backs = ShardOrderbookHalf('Back')
+        self.lays = ShardOrderbookHalf('Lay')
+        self.tape = Tape(exchangeId, competitorId)
+        self.version = 0
+        self.snapshot = None
+        self.publicData = None  # public data last sent by the worker
+        # only held while a snapshot is taken, the book is only updated by the exchange's
+        # requests under the exchange's lock
+        self.lock = threading.RLock()
+        self.lastTradedOdds = None
+
+    def update(self, publicData, columns):
+        if columns is not None:
+            self.tape.extend(columns)
+        for half, key in [(self.backs, 'backs'), (self.lays, 'lays')]:
+            half.bestOdds = publicData[key]['best']
+            half.worstOdds = publicData[key]['worst']
+            half.numOfOrders = publicData[key]['n']
+            publicData[key] = MappingProxyType(publicData[key])
+        publicData['analytics'] = MappingProxyType(publicData['analytics'])
+        self.publicData = publicData
+        self.version = self.version + 1
+
+
+class ShardedExchange(Exchange):
+    """
+    Exchange with its competitor orderbooks sharded across worker processes, orders
+    are routed by competitor ID and the snapshots of the shards merged when published
+    """
+    def __init__(self, id, numOfCompetitors, numOfShards=EXCHANGE_SHARDS, tickLadder=TICK_LADDER,
+                 maxOrdersPerAgent=MAX_ORDERS_PER_AGENT, exposure=None):
+        # shards check orders against liability set aside for them from the exposure ledger,
+        # and report back every change to their exposure
+        self.initialiseExchange(id, [ShardOrderbook(id, competitorId) for competitorId in range(numOfCompetitors)],
+                                exposure)
+        # competitors are dealt out to shards in turn, shard of each competitor indexed by competitor ID
+        numOfShards = min(numOfShards, numOfCompetitors)
+        self.shardOf = [competitorId % numOfShards for competitorId in range(numOfCompetitors)]
+        self.connections = []
+        self.workers = []
+        # spawned rather than forked as the session's threads are running by now
+        context = multiprocessing.get_context('spawn')
+        for shard in range(numOfShards):
+            competitorIds = [competitorId for competitorId in range(numOfCompetitors)
+                             if self.shardOf[competitorId] == shard]
+            connection, workerConnection = context.Pipe()
+            worker = context.Process(target=shardWorker, daemon=True,
+                                     args=(workerConnection, id, numOfCompetitors, competitorIds,
+                                           tickLadder, maxOrdersPerAgent))
+            worker.start()
+            self.connections.append(connection)
+            self.workers.append(worker)
+        self.request({shard: ('publish', (0,)) for shard in range(numOfShards)})
+
+
+    @synchronised
+    def request(self, commands):
+        """
+        Send a command to each of the given shards so they all run at once, then
+        merge their results, returns transactions in shard order
+        """
+        for shard, command in commands.items():
+            self.connections[shard].send(command)
+        transactions = []
+        changed = False
+        for shard in commands:
+            shardTransactions, (markets, tapes), exposureChanges = self.connections[shard].recv()
+            self.exposure.applyChanges(exposureChanges)
+            for competitorId, publicData in markets.items():
+                self.compOrderbooks[competitorId].update(publicData, tapes.get(competitorId))
+                changed = True
+            for transaction in shardTransactions:
+                self.compOrderbooks[transaction['competitor']].lastTradedOdds = transaction['odds']
+                self.positions.recordTrade(transaction['competitor'], transaction['odds'],
+                                           transaction['backer'], transaction['layer'], transaction['stake'])
+            transactions.extend(shardTransactions)
+        if changed:
+            self.version = self.version + 1
+        return transactions
+
+
+    def snapshotOrderbook(self, book, time):
+        """
+        Read only copy of the public data last sent for a book, with its tape. The version
+        is read first, as an update coming in meanwhile only makes the copy newer than it says
+        """
+        version = book.version
+        publicData = dict(book.publicData)
+        publicData['version'] = version
+        publicData['tape'] = TapeView(book.tape, len(book.tape))
+        return MappingProxyType(publicData)
+
+
+    def processOrders(self, time, orders):
+        """
+        Route a burst of orders to the shards holding their competitors, returns
+        consolidated record of transactions and the merged market state
+        """
+        shardOrders = {}
+        for order in orders:
+            shardOrders.setdefault(self.shardOf[order.competitorId], []).append(order)
+        headrooms = self.reserveHeadroom(shardOrders)
+        try:
+            transactions = self.request({shard: ('executeOrders', (time, batch, headrooms[shard]))
+                                         for shard, batch in shardOrders.items()})
+        finally:
+            for shardHeadrooms in headrooms.values():
+                for agentId, headroom in shardHeadrooms.items():
+                    self.exposure.release(agentId, headroom)
+        markets = self.publishMarketState(time)
+        if len(transactions) > 0:
+            return (transactions, markets)
+        else:
+            return (None, markets)
+
+
+    def reserveHeadroom(self, shardOrders):
+        """
+        Set aside the liability each shard may let an agent take on for a batch of orders,
+        so the shards together never commit more than the agent's balance. An agent whose
+        orders go to several shards has its headroom shared between them in proportion
+        to what it asks of each. Returns dictionary of shard to dictionary of agent ID to
+        headroom, which is to be released once the shards have reported their exposure
+        """
+        requested = {}
+        for shard, batch in shardOrders.items():
+            for order in batch:
+                agentRequests = requested.setdefault(order.agentId, {})
+                agentRequests[shard] = agentRequests.get(shard, 0) + liability(order.direction, order.odds, order.stake)
+        headrooms = {shard: {} for shard in shardOrders}
+        for agentId, agentRequests in requested.items():
+            # as when an order is admitted, so no other exchange takes the same headroom
+            with self.exposure.agentLock(agentId):
+                headroom = self.exposure.headroom(agentId)
+                if headroom is None:
+                    continue
+                headroom = max(headroom, 0)
+                total = sum(agentRequests.values())
+                for shard, amount in agentRequests.items():
+                    if total > headroom:
+                        amount = headroom * amount / total
+                    headrooms[shard][agentId] = amount
+                    self.exposure.reserve(agentId, amount)
+        return headrooms
+
+
+    def processOrder(self, time, order):
+        return self.processOrders(time, [order])
+
+
+    def delOrder(self, time, order):
+        self.request({self.shardOf[order.competitorId]: ('delOrder', (time, order))})
+
+
+    def amendOrder(self, time, order, stake):
+        self.request({self.shardOf[order.competitorId]: ('amendOrder', (time, order, stake))})
+
+
+    @synchronised
+    def expireAll(self, command, args):
+        """
+        Send an expiry command to every shard, returns number of shards whose books changed
+        """
+        changed = [book.version for book in self.compOrderbooks]
+        self.request({shard: (command, args) for shard in range(len(self.connections))})
+        return len(set(self.shardOf[book.competitorId] for book in self.compOrderbooks
+                       if book.version != changed[book.competitorId]))
+
+
+    def expireOrders(self, time):
+        """
+        Have every shard cancel its orders good for some seconds whose time has run out
+        """
+        return self.expireAll('expireOrders', (time,))
+
+
+    def expireTimestep(self, timestep, time):
+        """
+        Have every shard cancel its orders good until a race timestep once it is reached
+        """
+        return self.expireAll('expireTimestep', (timestep, time))
+
+
+    def close(self):
+        """
+        Stop the worker processes
+        """
+        for connection in self.connections:
+            connection.send(('stop', ()))
+        for worker in self.workers:
+            worker.join()
@@ -5,20 +5,63 @@
 NUM_OF_SIMS = 100
 NUM_OF_COMPETITORS = 5
 NUM_OF_EXCHANGES = 1
+# Send orders that would trade straight away to the exchange with the best odds for them
+ORDER_ROUTING = False
+# Only deliver each betting agent its own fills and race updates in full, conflating market state to the latest
+CONFLATE_MARKET_DATA = False
 PRE_RACE_BETTING_PERIOD_LENGTH = 0
 IN_PLAY_CUT_OFF_PERIOD = 0
 SESSION_SPEED_MULTIPLIER = 1
 
 # Data Store Attributes
 RACE_DATA_FILENAME = 'race_event_core.csv'
+# Stream the tapes of each simulation to their own file on a background thread
+TAPE_WRITER = False
+TAPE_FILENAME = 'tape_%d.csv'
+# Seconds between background writes and bytes buffered before the file is written to
+TAPE_WRITER_INTERVAL = 0.5
+TAPE_WRITER_BUFFER_SIZE = 1 << 20
+# Record every order taken off the exchanges' queues to a binary file per simulation, for orderflow.py to replay
+ORDER_FLOW_RECORDER = False
+ORDER_FLOW_FILENAME = 'order_flow_%d.bin'
+# Write each simulation's top of book and depth history at every race timestep to its own file
+SNAPSHOT_HISTORY = False
+SNAPSHOT_HISTORY_FILENAME = 'snapshot_history_%d.csv'
+# Records of each tape kept in memory, older records are spilled to a segment file and read back from disk
+TAPE_MEMORY_RECORDS = 1 << 16
+# Directory tape segment files are written to, None for the system's temporary directory
+TAPE_SPILL_DIRECTORY = None
 
 # Message Protocol Numbers
 EXCHANGE_UPDATE_MSG_NUM = 1
 RACE_UPDATE_MSG_NUM = 2
 
 # Exchange Attributes
+# Seconds an exchange thread waits for orders before checking whether the event has ended
+EXCHANGE_QUEUE_TIMEOUT = 0.1
 MIN_ODDS = 1.1
 MAX_ODDS = 20.00
+# Snap orders onto a Betfair style ladder of odds instead of using raw floats
+TICK_LADDER = False
+# (upper odds of band, tick size) pairs for the ladder
+TICK_LADDER_BANDS = [(2, 0.01), (3, 0.02), (4, 0.05), (6, 0.1), (10, 0.2), (20, 0.5), (30, 1), (50, 2), (100, 5), (1000, 10)]
+# How many orders a betting agent may rest on each side of a book, its oldest order is overwritten beyond this
+MAX_ORDERS_PER_AGENT = 1
+# Publish incremental depth deltas for changed price levels alongside market snapshots
+DEPTH_DELTAS = False
+# How many of the most recent depth deltas the exchange keeps for readers to catch up from
+DEPTH_FEED_LENGTH = 10000
+# Number of worker processes each exchange's orderbooks are sharded across by competitor, 1 matches in process
+EXCHANGE_SHARDS = 1
+# Number of best price levels summed for the depth in each book's published analytics
+ANALYTICS_DEPTH_LEVELS = 3
+# Number of race timesteps of top of book and depth history each exchange keeps
+SNAPSHOT_RING_LENGTH = 10000
+# Timer wheel expiring orders at their time-in-force: width of a slot of the first wheel in
+# time in event, slots per wheel and number of wheels
+TIMER_WHEEL_TICK = 0.1
+TIMER_WHEEL_SLOTS = 64
+TIMER_WHEEL_LEVELS = 3
 
 # Print-Outs
 TBBE_VERBOSE = False
@@ -0,0 +1,298 @@
+### ~ THREADED BRISTOL BETTING EXCHANGE ~ ###
+
+# Append-only columnar tape of trades and cancellations for a single orderbook
+
+import threading, tempfile
+from array import array
+import numpy as np
+from system_constants import TAPE_WRITER_INTERVAL, TAPE_WRITER_BUFFER_SIZE, TAPE_MEMORY_RECORDS, TAPE_SPILL_DIRECTORY
+from message_protocols import Transaction
+
+# record types held in the type column
+TRADE = 0
+CANCEL = 1
+RECORD_TYPES = ['Trade', 'Cancel']
+
+# column name and array typecode, in the order records are published
+TAPE_COLUMNS = [('type', 'b'), ('time', 'd'), ('competitor', 'i'), ('odds', 'd'),
+                ('backer', 'i'), ('layer', 'i'), ('stake', 'd')]
+
+NO_AGENT = -1  # backer/layer column of a cancelled order on the other side of the book
+
+# layout of a record spilled to a segment file
+SEGMENT_RECORD = np.dtype(TAPE_COLUMNS)
+# records read back at a time when scanning a whole tape
+SCAN_CHUNK_RECORDS = 1 << 14
+
+
+class Tape:
+    """
+    Trades and cancellations recorded by an orderbook, held as one typed array per
+    column rather than one dictionary per record. Only the most recent records are
+    kept in memory, older ones are spilled to a segment file and mapped back in to read
+    """
+    def __init__(self, exchange, competitor, memoryRecords=TAPE_MEMORY_RECORDS,
+                 spillDirectory=TAPE_SPILL_DIRECTORY):
+        self.exchange = exchange
+        self.competitor = competitor
+        self.memoryRecords = memoryRecords
+        self.spillDirectory = spillDirectory
+        columns = {}
+        for name, typecode in TAPE_COLUMNS:
+            columns[name] = array(typecode)
+        # index of the first record held in memory and the columns from it onwards, replaced
+        # as a whole on a spill so readers on other threads see either the old or new window
+        self.window = (0, columns)
+        # file of spilled records, created on the first spill, and the latest map of it
+        self.segmentFile = None
+        self.segments = None
+        # only counted once every column of a record has been written, so readers
+        # on other threads never see a partly written record
+        self.numOfRecords = 0
+        # held while the columns in memory are written or read, as the arrays themselves
+        # are not safe to share between threads without the GIL
+        self.lock = threading.Lock()
+
+    def append(self, type, time, odds, backer, layer, stake):
+        with self.lock:
+            columns = self.window[1]
+            columns['type'].append(type)
+            columns['time'].append(time)
+            columns['competitor'].append(self.competitor)
+            columns['odds'].append(odds)
+            columns['backer'].append(backer)
+            columns['layer'].append(layer)
+            columns['stake'].append(stake)
+            self.numOfRecords = self.numOfRecords + 1
+            if self.numOfRecords - self.window[0] >= self.memoryRecords:
+                self.spill()
+
+    def extend(self, columns):
+        """
+        Append records read from another tape, given as dictionary of column name
+        to array of values
+        """
+        with self.lock:
+            window = self.window[1]
+            for name, typecode in TAPE_COLUMNS:
+                window[name].extend(columns[name])
+            self.numOfRecords = self.numOfRecords + len(columns['type'])
+            if self.numOfRecords - self.window[0] >= self.memoryRecords:
+                self.spill()
+
+    def spill(self):
+        """
+        Write all but the newest half of the records in memory to the segment file
+        """
+        start, columns = self.window
+        numToSpill = self.numOfRecords - start - self.memoryRecords // 2
+        records = np.empty(numToSpill, dtype=SEGMENT_RECORD)
+        for name, typecode in TAPE_COLUMNS:
+            records[name] = np.frombuffer(columns[name], dtype=typecode, count=numToSpill)
+        if self.segmentFile is None:
+            self.segmentFile = tempfile.TemporaryFile(dir=self.spillDirectory)
+        self.segmentFile.write(records.tobytes())
+        self.segmentFile.flush()
+        kept = {}
+        for name, typecode in TAPE_COLUMNS:
+            kept[name] = columns[name][numToSpill:]
+        self.window = (start + numToSpill, kept)
+
+    def spilled(self, end):
+        # map of the segment file covering at least the first end records
+        segments = self.segments
+        if segments is None or len(segments) < end:
+            segments = np.memmap(self.segmentFile, dtype=SEGMENT_RECORD, mode='r', shape=(self.window[0],))
+            self.segments = segments
+        return segments
+
+    def recordTrade(self, time, odds, backer, layer, stake):
+        self.append(TRADE, time, odds, backer, layer, stake)
+
+    def recordCancel(self, time, order):
+        if order.direction == 'Back':
+            self.append(CANCEL, time, order.odds, order.agentId, NO_AGENT, order.stake)
+        else:
+            self.append(CANCEL, time, order.odds, NO_AGENT, order.agentId, order.stake)
+
+    def readColumns(self, start=0, end=None):
+        """
+        Records from start up to end, returns dictionary of column name to array of values
+        """
+        if end is None:
+            end = self.numOfRecords
+        with self.lock:
+            windowStart, window = self.window
+            columns = {}
+            if start >= windowStart:
+                for name, typecode in TAPE_COLUMNS:
+                    columns[name] = window[name][start - windowStart:end - windowStart]
+                return columns
+            segments = self.spilled(min(end, windowStart))
+            for name, typecode in TAPE_COLUMNS:
+                columns[name] = array(typecode, segments[name][start:min(end, windowStart)].tobytes())
+                if end > windowStart:
+                    columns[name].extend(window[name][:end - windowStart])
+            return columns
+
+    def record(self, index):
+        """
+        Record at index as a transaction record
+        """
+        with self.lock:
+            windowStart, window = self.window
+            if index >= windowStart:
+                values = [window[name][index - windowStart] for name, typecode in TAPE_COLUMNS]
+            else:
+                values = self.spilled(index + 1)[index].item()
+        type, time, competitor, odds, backer, layer, stake = values
+        return Transaction(RECORD_TYPES[type], time, self.exchange, competitor, odds, backer, layer, stake)
+
+    def iterRecords(self, start=0, end=None):
+        """
+        Records from start up to end in order, spilled records are read back a chunk at a time
+        """
+        if end is None:
+            end = self.numOfRecords
+        for chunkStart in range(start, end, SCAN_CHUNK_RECORDS):
+            columns = self.readColumns(chunkStart, min(end, chunkStart + SCAN_CHUNK_RECORDS))
+            for type, time, competitor, odds, backer, layer, stake in zip(
+                    columns['type'], columns['time'], columns['competitor'], columns['odds'],
+                    columns['backer'], columns['layer'], columns['stake']):
+                yield Transaction(RECORD_TYPES[type], time, self.exchange, competitor, odds, backer, layer, stake)
+
+    def __len__(self):
+        return self.numOfRecords
+
+    def __getitem__(self, index):
+        if index < 0:
+            index = index + self.numOfRecords
+        if index < 0 or index >= self.numOfRecords:
+            raise IndexError('tape index out of range')
+        return self.record(index)
+
+    def __iter__(self):
+        return self.iterRecords(0, self.numOfRecords)
+
+    def cursor(self, position=0):
+        return TapeCursor(self, position)
+
+
+class TapeChain:
+    """
+    Records of several tapes one tape after another, for scanning the whole history
+    of a session without copying it into memory
+    """
+    def __init__(self):
+        self.tapes = []
+
+    def add(self, tape):
+        self.tapes.append(tape)
+
+    def __len__(self):
+        return sum(len(tape) for tape in self.tapes)
+
+    def __iter__(self):
+        for tape in self.tapes:
+            yield from tape.iterRecords()
+
+
+class TapeCursor:
+    """
+    Incremental reader of a tape, each read only returns the records appended
+    since the previous read
+    """
+    def __init__(self, tape, position=0):
+        self.tape = tape
+        self.position = position
+
+    def readColumns(self):
+        """
+        Read new records, returns dictionary of column name to array of new values
+        """
+        end = self.tape.numOfRecords
+        columns = self.tape.readColumns(self.position, end)
+        self.position = end
+        return columns
+
+    def read(self):
+        """
+        Read new records, returns list of transaction records
+        """
+        end = self.tape.numOfRecords
+        records = list(self.tape.iterRecords(self.position, end))
+        self.position = end
+        return records
+
+
+class TapeWriter:
+    """
+    Streams the records on the tapes of a set of exchanges to a CSV file on a background
+    thread, each drain writes everything recorded since the last one as a single chunk
+    """
+    def __init__(self, exchanges, fileName, mode='w', interval=TAPE_WRITER_INTERVAL,
+                 bufferSize=TAPE_WRITER_BUFFER_SIZE):
+        self.exchanges = exchanges
+        self.interval = interval
+        self.bufferSize = bufferSize
+        # cursor on the tape of each orderbook, indexed by (exchange ID, competitor ID)
+        self.cursors = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.file = None
+        self.rotate(fileName, mode)
+
+    def rotate(self, fileName, mode='w'):
+        """
+        Write out what is left on the tapes then carry on writing to a new file
+        """
+        with self.lock:
+            if self.file is not None:
+                self.writeChunk()
+                self.file.close()
+            self.file = open(fileName, mode, buffering=self.bufferSize)
+            if self.file.tell() == 0:
+                self.file.write(','.join(['type', 'time', 'exchange', 'competitor', 'odds',
+                                          'backer', 'layer', 'stake']) + '\n')
+
+    def writeChunk(self):
+        lines = []
+        for exchange in self.exchanges:
+            for orderbook in exchange.compOrderbooks:
+                key = (exchange.id, orderbook.competitorId)
+                cursor = self.cursors.get(key)
+                # a wiped tape is replaced so start again at the beginning of the new one
+                if cursor is None or cursor.tape is not orderbook.tape:
+                    cursor = self.cursors[key] = orderbook.tape.cursor()
+                columns = cursor.readColumns()
+                for type, time, competitor, odds, backer, layer, stake in zip(
+                        columns['type'], columns['time'], columns['competitor'], columns['odds'],
+                        columns['backer'], columns['layer'], columns['stake']):
+                    lines.append('%s,%r,%d,%d,%r,%d,%d,%r\n' % (RECORD_TYPES[type], time, exchange.id,
+                                                                competitor, odds, backer, layer, stake))
+        if len(lines) > 0:
+            self.file.write(''.join(lines))
+
+    def drain(self):
+        with self.lock:
+            self.writeChunk()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.drain()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        """
+        Stop the background thread and write out what is left on the tapes
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        with self.lock:
+            self.writeChunk()
+            self.file.close()
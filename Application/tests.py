@@ -5,6 +5,17 @@ from ex_ante_odds_generator import *
 from exchange import Exchange
 from message_protocols import *
 from session_stats import *
+from market_data import DepthBook, SnapshotRing, ConflatingQueue
+from tape import Tape, TapeWriter, TapeChain, CANCEL, NO_AGENT
+from sharding import ShardedExchange
+from benchmarks import benchmarkScenario, benchmarkScaling
+from orderflow import OrderFlowRecorder, readOrderFlow, replayOrderFlow
+from consolidated import ConsolidatedMarket, OrderRouter
+from positions import ExposureLedger
+from differential import firstDivergence, generateSteps, stressTest, tickLadderExchange
+from ODmodels import LocalConversation
+import os, tempfile, threading, queue
+from array import array
 
 
 #### TESTS ####
@@ -121,6 +132,765 @@ def test_tape_recording(exchange):
             assert orderbook.lays.numOfOrders == 0
 
 
+def test_price_levels(exchange):
+    competitor = 1
+    orderTime = time.time()
+    first = Order(exchange.id, 5, competitor, 'Lay', 3.0, 6, 0, orderTime)
+    second = Order(exchange.id, 6, competitor, 'Lay', 3.0, 4, 0, orderTime)
+    third = Order(exchange.id, 7, competitor, 'Lay', 2.8, 5, 0, orderTime)
+    for order in [first, second, third]:
+        exchange.addOrder(order)
+
+    lays = exchange.compOrderbooks[competitor].lays
+    assert lays.bestOdds == 3.0
+    assert lays.bestAgentId == 5
+    assert lays.marketDepth == 2
+    assert lays.anonymisedMarket == [[2.8, 5], [3.0, 10]]
+
+    # cancelling the head of a level promotes the next order in the queue
+    exchange.delOrder(orderTime, first)
+    assert lays.bestAgentId == 6
+    assert lays.bestOrderStake == 4
+    assert lays.anonymisedMarket == [[2.8, 5], [3.0, 4]]
+
+    # emptying the best level falls back to the next best price
+    exchange.delOrder(orderTime, second)
+    assert lays.bestOdds == 2.8
+    assert lays.numOfOrders == 1
+    assert lays.marketDepth == 1
+    assert 3.0 not in lays.market
+
+    # an overwrite moves the agent's order to its new level
+    response = exchange.addOrder(Order(exchange.id, 7, competitor, 'Lay', 3.2, 5, 0, orderTime))[1]
+    assert response == 'Overwrite'
+    assert lays.bestOdds == 3.2
+    assert lays.numOfOrders == 1
+    assert lays.anonymisedMarket == [[3.2, 5]]
+
+
+def test_tick_ladder():
+    exchange = Exchange(1, NUM_OF_COMPETITORS, tickLadder=True)
+    competitor = 0
+    orderTime = time.time()
+    # backs are rounded up and lays rounded down onto the ladder
+    exchange.addOrder(Order(exchange.id, 1, competitor, 'Back', 2.333, 10, 0, orderTime))
+    exchange.addOrder(Order(exchange.id, 2, competitor, 'Back', 2.34, 5, 0, orderTime))
+    exchange.addOrder(Order(exchange.id, 3, competitor, 'Lay', 2.339, 4, 0, orderTime))
+
+    orderbook = exchange.compOrderbooks[competitor]
+    assert orderbook.backs.bestOdds == 2.34
+    assert orderbook.backs.marketDepth == 1
+    assert orderbook.backs.anonymisedMarket == [[2.34, 15]]
+    assert orderbook.lays.bestOdds == 2.32
+
+    # a cancel sent as a fresh order is taped as the order rests, snapped and partly filled
+    back = Order(exchange.id, 6, 1, 'Back', 2.333, 10, 0, orderTime)
+    exchange.addOrder(back)
+    exchange.processOrder(orderTime, Order(exchange.id, 7, 1, 'Lay', 2.34, 4, 0, orderTime))
+    exchange.delOrder(orderTime, Order(exchange.id, 6, 1, 'Back', 2.333, 10, back.orderId, orderTime))
+    cancel = exchange.compOrderbooks[1].tape[-1]
+    assert cancel['type'] == 'Cancel' and cancel['odds'] == 2.34 and cancel['stake'] == 6
+
+    # orders that would have to be made more aggressive to fit on the ladder are rejected
+    numOfBacks = orderbook.backs.numOfOrders
+    numOfLays = orderbook.lays.numOfOrders
+    exchange.processOrder(orderTime, Order(exchange.id, 8, competitor, 'Back', MAX_ODDS + 0.1, 4, 0, orderTime))
+    exchange.processOrder(orderTime, Order(exchange.id, 8, competitor, 'Lay', MIN_ODDS - 0.005, 4, 0, orderTime))
+    assert orderbook.backs.numOfOrders == numOfBacks and orderbook.lays.numOfOrders == numOfLays
+
+    # passive orders outside of the ladder are held at its ends
+    exchange.addOrder(Order(exchange.id, 4, competitor, 'Lay', MAX_ODDS + 0.1, 4, 0, orderTime))
+    assert orderbook.lays.bestOdds == MAX_ODDS
+
+    (transactions, markets) = exchange.processOrder(orderTime, Order(exchange.id, 5, competitor, 'Back', 2.3, 6, 0, orderTime))
+    assert transactions[0]['odds'] == MAX_ODDS
+    assert transactions[0]['stake'] == 4
+    assert markets[competitor]['lays']['best'] == 2.32
+
+
+def test_market_snapshots():
+    exchange = Exchange(2, NUM_OF_COMPETITORS)
+    competitor = 0
+    orderTime = time.time()
+    empty = exchange.publishMarketState(orderTime)
+    assert exchange.publishMarketState(orderTime) is empty
+
+    exchange.processOrder(orderTime, Order(exchange.id, 1, competitor, 'Back', 2.5, 10, 0, orderTime))
+    markets = exchange.publishMarketState(orderTime)
+    assert markets.version > empty.version
+    assert empty[competitor]['backs']['n'] == 0
+    assert markets[competitor]['backs']['market'] == ((2.5, 10),)
+    # books that did not change keep their previous snapshot
+    assert markets[1] is empty[1]
+
+    exchange.processOrder(orderTime, Order(exchange.id, 2, competitor, 'Lay', 2.5, 4, 0, orderTime))
+    latest = exchange.publishMarketState(orderTime)
+    assert len(latest[competitor]['tape']) == 1
+    assert len(markets[competitor]['tape']) == 0
+    try:
+        latest[competitor]['backs']['best'] = MAX_ODDS
+        assert False
+    except TypeError:
+        pass
+
+
+def test_sweep_matching():
+    exchange = Exchange(3, NUM_OF_COMPETITORS)
+    competitor = 0
+    orderTime = time.time()
+    exchange.addOrder(Order(exchange.id, 1, competitor, 'Lay', 3.0, 5, 0, orderTime))
+    exchange.addOrder(Order(exchange.id, 2, competitor, 'Lay', 3.0, 5, 0, orderTime))
+    exchange.addOrder(Order(exchange.id, 3, competitor, 'Lay', 2.8, 5, 0, orderTime))
+    exchange.addOrder(Order(exchange.id, 4, competitor, 'Lay', 2.0, 5, 0, orderTime))
+
+    # a large back takes every lay it crosses in price-time order in one pass
+    (transactions, markets) = exchange.processOrder(orderTime, Order(exchange.id, 5, competitor, 'Back', 2.5, 18, 0, orderTime))
+    assert [(t['layer'], t['odds'], t['stake']) for t in transactions] == [(1, 3.0, 5), (2, 3.0, 5), (3, 2.8, 5)]
+    assert all(t['backer'] == 5 for t in transactions)
+
+    orderbook = exchange.compOrderbooks[competitor]
+    assert orderbook.lays.bestOdds == 2.0
+    assert orderbook.lays.numOfOrders == 1
+    assert orderbook.backs.bestOdds == 2.5
+    assert orderbook.backs.bestOrderStake == 3
+    assert markets[competitor]['backs']['market'] == ((2.5, 3),)
+
+    # betting agents do not fulfill their own orders
+    assert exchange.processOrder(orderTime, Order(exchange.id, 4, competitor, 'Back', 1.5, 5, 0, orderTime))[0] == None
+
+
+def test_batch_orders():
+    exchange = Exchange(4, NUM_OF_COMPETITORS)
+    orderTime = time.time()
+    orders = [Order(exchange.id, 1, competitor, 'Lay', 3.0, 5, 0, orderTime) for competitor in range(NUM_OF_COMPETITORS)]
+    orders.append(Order(exchange.id, 2, 0, 'Back', 2.5, 5, 0, orderTime))
+    orders.append(Order(exchange.id, 2, 1, 'Back', 3.5, 5, 0, orderTime))
+    version = exchange.version
+
+    (transactions, markets) = exchange.processOrders(orderTime, orders)
+    assert len(transactions) == 1
+    assert transactions[0]['competitor'] == 0
+    assert markets.version == exchange.version
+    assert exchange.version > version
+    assert markets[0]['lays']['n'] == 0
+    assert markets[1]['backs']['best'] == 3.5
+    for competitor in range(2, NUM_OF_COMPETITORS):
+        assert markets[competitor]['lays']['best'] == 3.0
+
+    (transactions, markets) = exchange.processOrders(orderTime, [])
+    assert transactions == None
+
+
+def test_order_id_index():
+    exchange = Exchange(5, NUM_OF_COMPETITORS, maxOrdersPerAgent=2)
+    competitor = 0
+    orderTime = time.time()
+    first = Order(exchange.id, 1, competitor, 'Back', 2.5, 10, 0, orderTime)
+    second = Order(exchange.id, 1, competitor, 'Back', 2.6, 10, 0, orderTime)
+    other = Order(exchange.id, 2, competitor, 'Back', 2.5, 10, 0, orderTime)
+    for order in [first, second, other]:
+        assert exchange.addOrder(order)[1] == 'Addition'
+
+    backs = exchange.compOrderbooks[competitor].backs
+    assert backs.numOfOrders == 3
+    assert backs.market[2.5][0] == 20
+
+    # amending down keeps the order at the front of its queue
+    exchange.amendOrder(orderTime, first, 4)
+    assert backs.bestAgentId == 1
+    assert backs.bestOrderStake == 4
+    assert backs.market[2.5][0] == 14
+
+    # amending up sends it to the back of the queue
+    exchange.amendOrder(orderTime, first, 12)
+    assert backs.bestAgentId == 2
+    assert backs.market[2.5][0] == 22
+
+    # cancelling by order ID only removes that order
+    exchange.delOrder(orderTime, other)
+    assert backs.bestAgentId == 1
+    assert backs.numOfOrders == 2
+    assert backs.market[2.6][0] == 10
+
+    # a third order from the same agent overwrites its oldest order
+    third = Order(exchange.id, 1, competitor, 'Back', 2.7, 10, 0, orderTime)
+    assert exchange.addOrder(third)[1] == 'Overwrite'
+    assert backs.numOfOrders == 2
+    assert 2.5 not in backs.market
+    assert backs.anonymisedMarket == [[2.6, 10], [2.7, 10]]
+
+    # churn behind a long lived order at the head of a level does not grow its queue
+    for i in range(1000):
+        exchange.addOrder(Order(exchange.id, 3, competitor, 'Back', 2.6, 1, 0, orderTime))
+    assert backs.market[2.6][2] == 3
+    assert len(backs.market[2.6][1]) <= 2 * backs.market[2.6][2]
+    assert backs.bestAgentId == 1
+
+
+def test_tape_cursor():
+    exchange = Exchange(6, NUM_OF_COMPETITORS)
+    competitor = 0
+    orderTime = time.time()
+    tape = exchange.compOrderbooks[competitor].tape
+    cursor = tape.cursor()
+
+    exchange.processOrder(orderTime, Order(exchange.id, 1, competitor, 'Back', 2.5, 10, 0, orderTime))
+    exchange.processOrder(orderTime, Order(exchange.id, 2, competitor, 'Lay', 2.5, 4, 0, orderTime))
+    records = cursor.read()
+    assert len(records) == 1
+    assert records[0]['type'] == 'Trade'
+    assert records[0]['exchange'] == exchange.id
+    assert records[0]['backer'] == 1
+    assert records[0]['layer'] == 2
+    assert cursor.read() == []
+
+    lay = Order(exchange.id, 3, competitor, 'Lay', 2.0, 4, 0, orderTime)
+    exchange.addOrder(lay)
+    exchange.delOrder(orderTime, lay)
+    exchange.processOrder(orderTime, Order(exchange.id, 4, competitor, 'Lay', 2.6, 6, 0, orderTime))
+    columns = cursor.readColumns()
+    assert list(columns['type']) == [1, 0]
+    assert list(columns['layer']) == [3, 4]
+    assert list(columns['stake']) == [4, 6]
+    assert len(tape) == 3
+    assert tape[-1]['stake'] == 6
+
+    # cancelling an order no longer on the book, or as another agent, records nothing
+    version = exchange.version
+    exchange.delOrder(orderTime, lay)
+    resting = Order(exchange.id, 5, competitor, 'Back', 3.0, 8, 0, orderTime)
+    exchange.addOrder(resting)
+    exchange.delOrder(orderTime, Order(exchange.id, 99, competitor, 'Back', 3.0, 8, resting.orderId, orderTime))
+    assert len(tape) == 3
+    assert exchange.version == version + 1
+
+    # amending an order to nothing cancels it on the tape
+    exchange.amendOrder(orderTime, resting, 0)
+    assert len(tape) == 4
+    assert tape[-1]['type'] == 'Cancel'
+    assert tape[-1]['backer'] == 5
+    assert tape[-1]['stake'] == 8
+
+
+def test_depth_deltas():
+    exchange = Exchange(7, NUM_OF_COMPETITORS, depthDeltas=True)
+    competitor = 0
+    orderTime = time.time()
+    depthBook = DepthBook(exchange)
+    depthBook.recover(orderTime)
+    assert depthBook.sequence == 0
+
+    exchange.processOrder(orderTime, Order(exchange.id, 1, competitor, 'Back', 2.5, 10, 0, orderTime))
+    exchange.processOrder(orderTime, Order(exchange.id, 2, competitor, 'Back', 3.0, 5, 0, orderTime))
+    exchange.processOrder(orderTime, Order(exchange.id, 3, competitor, 'Lay', 2.5, 4, 0, orderTime))
+    deltas = exchange.depthFeed.read(0)
+    assert [(delta.side, delta.odds, delta.stake) for delta in deltas] == \
+        [('Back', 2.5, 10), ('Back', 3.0, 5), ('Lay', 2.5, 4), ('Back', 2.5, 6), ('Lay', 2.5, 0)]
+    depthBook.update(orderTime)
+    assert depthBook.market(competitor, 'Back') == [(2.5, 6), (3.0, 5)]
+    assert depthBook.best(competitor, 'Back') == 2.5
+    assert depthBook.best(competitor, 'Lay') is None
+
+    # snapshot sequence lines up with the deltas it includes
+    snapshot = exchange.publishMarketState(orderTime)
+    assert snapshot.sequence == depthBook.sequence
+
+    # a reader that missed trimmed deltas recovers from a snapshot
+    exchange.depthFeed.length = 1
+    for agentId in range(4, 10):
+        exchange.processOrder(orderTime, Order(exchange.id, agentId, competitor, 'Lay', 1.5 + agentId / 10, 1, 0, orderTime))
+    assert exchange.depthFeed.read(depthBook.sequence) is None
+    depthBook.update(orderTime)
+    assert depthBook.sequence == exchange.depthFeed.sequence
+    assert depthBook.best(competitor, 'Lay') == exchange.compOrderbooks[competitor].lays.bestOdds
+
+
+def test_net_positions():
+    exchange = Exchange(8, NUM_OF_COMPETITORS)
+    orderTime = time.time()
+    exchange.processOrder(orderTime, Order(exchange.id, 1, 0, 'Back', 2.5, 10, 0, orderTime))
+    exchange.processOrder(orderTime, Order(exchange.id, 2, 0, 'Lay', 2.5, 4, 0, orderTime))
+    exchange.processOrder(orderTime, Order(exchange.id, 2, 1, 'Back', 4.0, 5, 0, orderTime))
+    exchange.processOrder(orderTime, Order(exchange.id, 3, 1, 'Lay', 4.0, 5, 0, orderTime))
+
+    # agent 1 backed 4 at 2.5 on competitor 0, agent 2 laid it and backed 5 at 4.0 on competitor 1
+    assert exchange.positions.settle(0) == {1: 6.0, 2: -11.0, 3: 5.0}
+    assert exchange.positions.settle(1) == {1: -4.0, 2: 19.0, 3: -15.0}
+    assert exchange.positions.settle(2) == {1: -4.0, 2: -1.0, 3: 5.0}
+
+    # marked at certainty of a winner, profit is that of settling on it
+    probabilities = [0] * NUM_OF_COMPETITORS
+    probabilities[1] = 1
+    assert exchange.markToMarket(probabilities) == exchange.positions.settle(1)
+    assert abs(sum(exchange.markToMarket().values())) < 1e-9
+    assert abs(sum(exchange.impliedProbabilities()) - 1) < 1e-9
+
+
+def test_tape_writer():
+    exchanges = [Exchange(9, NUM_OF_COMPETITORS), Exchange(10, NUM_OF_COMPETITORS)]
+    orderTime = time.time()
+    directory = tempfile.mkdtemp()
+    writer = TapeWriter(exchanges, os.path.join(directory, 'tape_0.csv'), interval=0.01)
+    writer.start()
+    for exchange in exchanges:
+        exchange.processOrder(orderTime, Order(exchange.id, 1, 0, 'Back', 2.5, 10, 0, orderTime))
+        exchange.processOrder(orderTime, Order(exchange.id, 2, 0, 'Lay', 2.5, 4, 0, orderTime))
+    writer.drain()
+
+    # each simulation goes to its own file, only holding what was recorded since rotating
+    writer.rotate(os.path.join(directory, 'tape_1.csv'))
+    exchanges[0].processOrder(orderTime, Order(exchanges[0].id, 3, 1, 'Lay', 3.0, 5, 0, orderTime))
+    exchanges[0].delOrder(orderTime, Order(exchanges[0].id, 3, 1, 'Lay', 3.0, 5, 0, orderTime))
+    writer.close()
+
+    with open(os.path.join(directory, 'tape_0.csv')) as file:
+        lines = file.read().splitlines()
+    assert lines[0] == 'type,time,exchange,competitor,odds,backer,layer,stake'
+    assert lines[1:] == ['Trade,%r,9,0,2.5,1,2,4.0' % orderTime, 'Trade,%r,10,0,2.5,1,2,4.0' % orderTime]
+    with open(os.path.join(directory, 'tape_1.csv')) as file:
+        lines = file.read().splitlines()
+    assert lines[1:] == ['Cancel,%r,9,1,3.0,-1,3,5.0' % orderTime]
+
+
+def test_sharded_exchange():
+    exchange = Exchange(11, NUM_OF_COMPETITORS)
+    sharded = ShardedExchange(11, NUM_OF_COMPETITORS, numOfShards=2)
+    orderTime = time.time()
+    # matching takes stake off the orders themselves so each exchange is sent its own copies
+    def batches():
+        return [[Order(11, 1, 0, 'Back', 2.5, 10, 0, orderTime), Order(11, 2, 1, 'Lay', 3.0, 5, 1, orderTime)],
+                [Order(11, 3, 0, 'Lay', 2.6, 4, 2, orderTime), Order(11, 4, 1, 'Back', 2.8, 8, 3, orderTime),
+                 Order(11, 5, 2, 'Back', 4.0, 6, 4, orderTime)]]
+    try:
+        for batch, shardedBatch in zip(batches(), batches()):
+            (transactions, markets) = exchange.processOrders(orderTime, batch)
+            (shardedTransactions, shardedMarkets) = sharded.processOrders(orderTime, shardedBatch)
+            assert transactions == shardedTransactions
+            for competitorId in range(NUM_OF_COMPETITORS):
+                for side in ['backs', 'lays']:
+                    assert dict(markets[competitorId][side]) == dict(shardedMarkets[competitorId][side])
+                assert list(markets[competitorId]['tape']) == list(shardedMarkets[competitorId]['tape'])
+        assert shardedMarkets.version == 3
+        assert exchange.positions.settle(1) == sharded.positions.settle(1)
+
+        # a command that leaves the books alone publishes nothing
+        version = sharded.version
+        assert sharded.request({0: ('setBalances', ({1: 100},))}) == []
+        assert sharded.version == version
+        # and the sharded exchange has all the state of any other exchange
+        assert sharded.expireTimestep(1, orderTime) == 0
+        assert sharded.exposure.headroom(1) is None
+    finally:
+        sharded.close()
+
+
+def test_benchmarks():
+    results = benchmarkScenario(5, 10, 2, 0.5, operations=50)
+    assert results['depth'] == 5 and results['filledDepth'] == 5
+    # a single agent can only fill as many levels as it may rest orders
+    assert benchmarkScenario(20, 1, 1, 0.5, operations=10)['filledDepth'] == results['ordersPerAgent']
+    for name in ['add', 'cancel', 'cross', 'sweep', 'flow']:
+        summary = results['operations'][name]
+        assert summary['count'] == 50
+        assert summary['p50'] <= summary['p99'] <= summary['p999']
+        # the loop's untimed work only ever slows the wall clock rate
+        assert summary['wallClockOrdersPerSecond'] <= summary['ordersPerSecond']
+
+
+def test_order_flow_replay():
+    exchange = Exchange(12, NUM_OF_COMPETITORS)
+    orderTime = time.time()
+    fileName = os.path.join(tempfile.mkdtemp(), 'order_flow_0.bin')
+    recorder = OrderFlowRecorder(fileName)
+    # agent 1's back is trimmed to its balance, which replay has to do too
+    balances = {1: 6, 2: 100, 3: 100}
+    exchange.setBalances(balances)
+    recorder.recordBalances(balances)
+    batches = [[Order(12, 1, 0, 'Back', 2.5, 10, 0, orderTime), Order(12, 2, 1, 'Lay', 3.0, 5, 0, orderTime),
+                Order(12, 2, 2, 'Back', 4.0, 5, 0, orderTime, GOOD_UNTIL_TIMESTEP, 3)],
+               [Order(12, 3, 0, 'Lay', 2.6, 4, 1, orderTime + 1, GOOD_FOR_SECONDS, 5)]]
+    for batchTime, batch in enumerate(batches):
+        recorder.record(batchTime, batch)
+        exchange.processOrders(batchTime, batch)
+    # reaching the timestep expires the order good until it, on replay too
+    recorder.recordTimestep(3, 7.5)
+    exchange.captureTimestep(3, 7.5)
+    assert exchange.compOrderbooks[2].tape[-1]['type'] == 'Cancel'
+    recorder.close()
+
+    replayed = list(readOrderFlow(fileName))
+    assert [batchTime for batchTime, batch in replayed] == [0, 1]
+    order = replayed[1][1][0]
+    assert [order.exchange, order.agentId, order.competitorId, order.direction, order.odds, order.stake,
+            order.orderId, order.timestamp, order.timeInForce, order.expiry] == \
+        [12, 3, 0, 'Lay', 2.6, 4, 1, orderTime + 1, GOOD_FOR_SECONDS, 5]
+    assert replayed[0][1][0].expiry is None
+    assert replayed[0][1][0].stake == 10
+    replayedExchange = replayOrderFlow(fileName)[12]
+    assert replayedExchange.exposure.balances == balances
+    assert replayedExchange.compOrderbooks[0].backs.anonymisedMarket == [[2.5, 2]]
+    for orderbook, replayedOrderbook in zip(exchange.compOrderbooks, replayedExchange.compOrderbooks):
+        assert list(orderbook.tape) == list(replayedOrderbook.tape)
+        assert orderbook.backs.anonymisedMarket == replayedOrderbook.backs.anonymisedMarket
+        assert orderbook.lays.anonymisedMarket == replayedOrderbook.lays.anonymisedMarket
+
+
+def test_exposure_ledger():
+    exchange = Exchange(13, NUM_OF_COMPETITORS)
+    exchange.setBalances({1: 100, 2: 100})
+    orderTime = time.time()
+
+    # lay liability is the winnings owed, 20 at 3.0 risks 40
+    exchange.processOrder(orderTime, Order(13, 1, 0, 'Lay', 3.0, 20, 0, orderTime))
+    assert exchange.exposure.exposure(1) == 40
+    # only 60 left, so a back of 80 is trimmed to 60
+    back = Order(13, 1, 1, 'Back', 4.0, 80, 0, orderTime)
+    exchange.processOrder(orderTime, back)
+    assert back.stake == 60
+    assert exchange.exposure.exposure(1) == 100
+    exchange.processOrder(orderTime, Order(13, 1, 2, 'Back', 4.0, 10, 0, orderTime))
+    assert exchange.exposure.numOfRejections == 1
+
+    # cancelling releases the liability, a fill moves it from open to matched at the traded odds
+    exchange.delOrder(orderTime, back)
+    assert exchange.exposure.exposure(1) == 40
+    exchange.processOrder(orderTime, Order(13, 2, 0, 'Back', 2.5, 5, 0, orderTime))
+    assert exchange.exposure.openLiability[1] == 30
+    assert exchange.exposure.matchedLiability[1] == 10
+    assert exchange.exposure.exposure(2) == 5
+
+    # an order overwriting another only needs the balance left once the other is gone
+    exchange.processOrder(orderTime, Order(13, 2, 1, 'Back', 6.0, 50, 0, orderTime))
+    exchange.processOrder(orderTime, Order(13, 2, 1, 'Back', 6.0, 90, 0, orderTime))
+    assert exchange.exposure.exposure(2) == 95
+
+
+def test_shared_exposure():
+    # exchanges sharing a ledger check an agent's orders on all of them against one balance
+    exposure = ExposureLedger()
+    exposure.setBalance(1, 100)
+    exchanges = [Exchange(id, NUM_OF_COMPETITORS, exposure=exposure) for id in [15, 16]]
+    orderTime = time.time()
+    exchanges[0].processOrder(orderTime, Order(15, 1, 0, 'Back', 2.0, 70, 0, orderTime))
+    back = Order(16, 1, 0, 'Back', 2.0, 70, 0, orderTime)
+    exchanges[1].processOrder(orderTime, back)
+    assert back.stake == 30
+    assert exposure.exposure(1) == 100
+
+    # as do the shards of a sharded exchange, whose orders in one batch share the headroom
+    sharded = ShardedExchange(17, NUM_OF_COMPETITORS, numOfShards=2, exposure=exposure)
+    try:
+        exposure.setBalance(2, 100)
+        (transactions, markets) = sharded.processOrders(orderTime, [Order(17, 2, 0, 'Back', 2.0, 80, 0, orderTime),
+                                                                    Order(17, 2, 1, 'Back', 2.0, 80, 0, orderTime)])
+        assert exposure.exposure(2) <= 100
+        assert markets[0]['backs']['market'][0][1] + markets[1]['backs']['market'][0][1] <= 100
+        assert exposure.reserved[2] == 0
+        sharded.processOrder(orderTime, Order(17, 2, 2, 'Back', 2.0, 10, 0, orderTime))
+        assert exposure.exposure(2) <= 100
+        # a fill in a shard moves the liability to matched in the shared ledger
+        sharded.processOrder(orderTime, Order(17, 3, 0, 'Lay', 2.0, 10, 0, orderTime))
+        assert exposure.matchedLiability[2] == 10
+        assert exposure.exposure(2) <= 100
+    finally:
+        sharded.close()
+
+
+def test_book_analytics():
+    for tickLadder in [False, True]:
+        exchange = Exchange(14, NUM_OF_COMPETITORS, tickLadder=tickLadder)
+        orderTime = time.time()
+        analytics = exchange.publishMarketState(orderTime)[0]['analytics']
+        assert analytics['microprice'] is None and analytics['vwap'] is None
+
+        for agentId, direction, odds, stake in [(1, 'Back', 3.0, 10), (2, 'Back', 3.5, 20), (3, 'Back', 4.0, 5),
+                                                (4, 'Back', 5.0, 5), (5, 'Lay', 2.0, 30), (6, 'Lay', 1.5, 10)]:
+            exchange.processOrder(orderTime, Order(14, agentId, 0, direction, odds, stake, 0, orderTime))
+        analytics = exchange.publishMarketState(orderTime)[0]['analytics']
+        assert analytics['bestBack'] == 3.0 and analytics['bestLay'] == 2.0
+        assert abs(analytics['spread'] - (1 / 2.0 - 1 / 3.0)) < 1e-9
+        assert abs(analytics['microprice'] - (3.0 * 30 + 2.0 * 10) / 40) < 1e-9
+        assert analytics['backDepth'] == 35 and analytics['layDepth'] == 40
+
+        # a lay at 3.5 takes the backs at 3.0 and 3.5
+        exchange.processOrder(orderTime, Order(14, 7, 0, 'Lay', 3.5, 15, 0, orderTime))
+        analytics = exchange.publishMarketState(orderTime)[0]['analytics']
+        assert analytics['tradedStake'] == 15
+        assert abs(analytics['vwap'] - (3.0 * 10 + 3.5 * 5) / 15) < 1e-9
+        assert analytics['bestBack'] == 3.5 and analytics['bestBackStake'] == 15
+
+        prices = {}
+        recordPrices(1, {exchange.id: exchange}, prices)
+        assert prices[1][0] == analytics['microprice']
+        assert prices[1][1] == MAX_ODDS
+
+
+def test_consolidated_market():
+    exchanges = {0: Exchange(0, NUM_OF_COMPETITORS), 1: Exchange(1, NUM_OF_COMPETITORS)}
+    consolidatedMarket = ConsolidatedMarket(exchanges)
+    router = OrderRouter(consolidatedMarket)
+    orderTime = time.time()
+    markets = consolidatedMarket.refresh(orderTime)
+    assert markets[0].version == 0 and consolidatedMarket.bestLay(0) is None
+
+    exchanges[0].processOrder(orderTime, Order(0, 1, 0, 'Lay', 2.0, 10, 0, orderTime))
+    exchanges[1].processOrder(orderTime, Order(1, 2, 0, 'Lay', 2.4, 10, 0, orderTime))
+    exchanges[0].processOrder(orderTime, Order(0, 3, 0, 'Back', 3.0, 10, 0, orderTime))
+    exchanges[1].processOrder(orderTime, Order(1, 4, 0, 'Back', 3.2, 10, 0, orderTime))
+    markets = consolidatedMarket.refresh(orderTime)
+    assert markets[1][0]['lays']['best'] == 2.4
+    assert consolidatedMarket.bestLay(0) == (2.4, 1)
+    assert consolidatedMarket.bestBack(0) == (3.0, 0)
+    # nothing new published, so the same view comes back
+    assert consolidatedMarket.refresh(orderTime) is markets
+
+    # orders that would trade go to the best odds, others stay where they were sent
+    assert router.route(Order(0, 5, 0, 'Back', 2.2, 5, 0, orderTime)) == 1
+    assert router.route(Order(1, 5, 0, 'Lay', 3.5, 5, 0, orderTime)) == 0
+    assert router.route(Order(0, 5, 0, 'Back', 2.6, 5, 0, orderTime)) == 0
+    assert router.route(Order(1, 5, 1, 'Lay', 3.5, 5, 0, orderTime)) == 1
+
+
+def test_time_in_force():
+    exchange = Exchange(15, NUM_OF_COMPETITORS)
+    orderTime = time.time()
+    lay = Order(15, 1, 0, 'Lay', 2.0, 10, 0, orderTime, GOOD_FOR_SECONDS, 1.0)
+    back = Order(15, 2, 0, 'Back', 3.0, 10, 0, orderTime, GOOD_UNTIL_TIMESTEP, 2)
+    exchange.processOrders(0, [lay, back, Order(15, 3, 1, 'Back', 3.0, 10, 0, orderTime)])
+    assert exchange.expireOrders(0.5) == 0
+    assert exchange.expireOrders(1.05) == 1
+    assert exchange.compOrderbooks[0].lays.numOfOrders == 0
+    assert exchange.compOrderbooks[0].tape[-1]['type'] == 'Cancel' and exchange.compOrderbooks[0].tape[-1]['time'] == 1.05
+
+    # an order good until a timestep is not expired by the event time, only once the race reaches it
+    assert exchange.expireOrders(2.5) == 0
+    exchange.captureTimestep(1, 11.0)
+    assert exchange.compOrderbooks[0].backs.numOfOrders == 1
+    exchange.captureTimestep(2, 12.0)
+    assert exchange.compOrderbooks[0].backs.numOfOrders == 0
+    assert exchange.compOrderbooks[0].tape[-1]['type'] == 'Cancel' and exchange.compOrderbooks[0].tape[-1]['time'] == 12.0
+    assert np.isnan(exchange.snapshotRing.history()['bestBack'][-1][0])
+
+    # an order good until a timestep already reached is rejected rather than resting
+    (transactions, markets) = exchange.processOrder(12.5, Order(15, 2, 0, 'Back', 3.0, 10, 0, orderTime, GOOD_UNTIL_TIMESTEP, 2))
+    assert transactions is None and exchange.compOrderbooks[0].backs.numOfOrders == 0
+
+    # an order taken by the time it would expire leaves nothing to cancel
+    back = Order(15, 2, 0, 'Back', 3.0, 10, 0, orderTime, GOOD_UNTIL_TIMESTEP, 4)
+    exchange.processOrder(13.0, back)
+    exchange.processOrder(13.5, Order(15, 4, 0, 'Lay', 3.0, 10, 0, orderTime))
+    numOfRecords = len(exchange.compOrderbooks[0].tape)
+    assert exchange.expireTimestep(4, 14.0) == 0
+    assert len(exchange.compOrderbooks[0].tape) == numOfRecords
+    assert exchange.compOrderbooks[1].backs.numOfOrders == 1
+
+    # a fill-or-kill is only matched if all of it can be, and never rests
+    exchange.processOrder(3, Order(15, 6, 2, 'Lay', 2.5, 10, 0, orderTime))
+    (transactions, markets) = exchange.processOrder(3, Order(15, 7, 2, 'Back', 2.5, 15, 0, orderTime, FILL_OR_KILL))
+    assert transactions is None and markets[2]['backs']['n'] == 0
+    (transactions, markets) = exchange.processOrder(3, Order(15, 7, 2, 'Back', 2.0, 8, 0, orderTime, FILL_OR_KILL))
+    assert sum(transaction['stake'] for transaction in transactions) == 8
+    assert markets[2]['backs']['n'] == 0 and markets[2]['lays']['n'] == 1
+
+    # nor does it take the place of the agent's order resting on the same side
+    exchange.processOrder(3, Order(15, 8, 2, 'Back', 5.0, 10, 0, orderTime))
+    (transactions, markets) = exchange.processOrder(3, Order(15, 8, 2, 'Back', 2.0, 2, 0, orderTime, FILL_OR_KILL))
+    assert sum(transaction['stake'] for transaction in transactions) == 2
+    assert markets[2]['backs']['n'] == 1 and exchange.compOrderbooks[2].backs.agentOrders[8]
+
+
+def test_tape_spill():
+    tape = Tape(16, 0, memoryRecords=4, spillDirectory=tempfile.mkdtemp())
+    cursor = tape.cursor()
+    for i in range(6):
+        tape.recordTrade(i, 2.0 + i, i, i + 1, 10 + i)
+    # the oldest records have gone to disk, the newest half of the window is still in memory
+    assert tape.window[0] == 4 and len(tape) == 6
+    assert [record['stake'] for record in tape] == [10, 11, 12, 13, 14, 15]
+    assert tape[1]['backer'] == 1 and tape[1]['type'] == 'Trade' and tape[5]['odds'] == 7.0
+    columns = cursor.readColumns()
+    assert list(columns['time']) == [0, 1, 2, 3, 4, 5]
+
+    tape.extend({'type': array('b', [CANCEL] * 5), 'time': array('d', range(6, 11)),
+                 'competitor': array('i', [0] * 5), 'odds': array('d', [3.0] * 5),
+                 'backer': array('i', range(6, 11)), 'layer': array('i', [NO_AGENT] * 5),
+                 'stake': array('d', [1] * 5)})
+    assert tape.window[0] == 9
+    assert list(cursor.readColumns()['backer']) == [6, 7, 8, 9, 10]
+    assert list(tape.readColumns(3, 8)['time']) == [3, 4, 5, 6, 7]
+    view = TapeView(tape, 8)
+    assert [record['time'] for record in view] == [0, 1, 2, 3, 4, 5, 6, 7]
+
+    chain = TapeChain()
+    chain.add(tape)
+    chain.add(Tape(16, 1))
+    assert len(chain) == 11 and [record['time'] for record in chain] == list(range(11))
+
+
+def test_message_types():
+    exchange = Exchange(17, NUM_OF_COMPETITORS)
+    orderTime = time.time()
+    order = Order(17, 1, 0, 'Back', 2.5, 10, 0, orderTime)
+    assert not hasattr(order, '__dict__')
+    exchange.processOrder(orderTime, order)
+    (transactions, markets) = exchange.processOrder(orderTime, Order(17, 2, 0, 'Lay', 2.5, 4, 0, orderTime))
+    transaction = transactions[0]
+    assert transaction['backer'] == transaction.backer == transaction[5] == 1
+    assert transaction == markets[0]['tape'][0] == exchange.compOrderbooks[0].tape[0]
+
+    update = exchangeUpdate(tuple(transactions), (order,))
+    assert update.protocolNum == EXCHANGE_UPDATE_MSG_NUM and update.transactions[0] is transaction
+    try:
+        update.order = None
+        assert False
+    except AttributeError:
+        pass
+    assert raceUpdate(1, {0: 5.0}).compDistances[0] == 5.0
+
+
+def test_snapshot_ring():
+    exchange = Exchange(18, NUM_OF_COMPETITORS)
+    exchange.snapshotRing = SnapshotRing(NUM_OF_COMPETITORS, length=3)
+    orderTime = time.time()
+    for timestep in range(1, 6):
+        exchange.processOrder(timestep, Order(18, timestep, 0, 'Back', 2.0 + timestep / 10, timestep, 0, orderTime))
+        exchange.captureTimestep(timestep, timestep + 0.5)
+
+    # only the last three timesteps are kept, oldest first
+    history = exchange.snapshotRing.history()
+    assert history.shape == (3, NUM_OF_COMPETITORS)
+    assert list(history['timestep'][:, 0]) == [3, 4, 5]
+    assert list(history['bestBack'][:, 0]) == [2.1, 2.1, 2.1]
+    assert list(history['backDepth'][:, 0]) == [6, 6, 6]
+    assert np.isnan(history['bestLay'][0, 0]) and np.isnan(history['bestBack'][0, 1])
+
+    fileName = os.path.join(tempfile.mkdtemp(), 'snapshot_history_0.csv')
+    exchange.snapshotRing.export(fileName, exchange.id)
+    with open(fileName) as file:
+        lines = file.read().splitlines()
+    assert len(lines) == 1 + 3 * NUM_OF_COMPETITORS
+    assert lines[1].startswith('18,0,3,3.5,2.1,1.0,')
+
+
+def test_concurrent_exchange():
+    exchange = Exchange(19, NUM_OF_COMPETITORS, maxOrdersPerAgent=100)
+    orderTime = time.time()
+    published = []
+
+    def send(agentId):
+        for i in range(100):
+            exchange.processOrder(orderTime, Order(19, agentId, i % NUM_OF_COMPETITORS, 'Back', 3.0 + i / 100, 1, 0, orderTime))
+            published.append(exchange.snapshot.version)
+
+    threads = [threading.Thread(target=send, args=(agentId,)) for agentId in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sum(orderbook.backs.numOfOrders for orderbook in exchange.compOrderbooks) == 400
+    assert exchange.publishMarketState(orderTime).version == max(published)
+
+    # a book held by one thread does not hold up matching on the other competitors' books
+    with exchange.compOrderbooks[0].lock:
+        thread = threading.Thread(target=exchange.executeOrder,
+                                  args=(orderTime, Order(19, 5, 1, 'Lay', 1.5, 1, 0, orderTime), []))
+        thread.start()
+        thread.join(5)
+        assert not thread.is_alive()
+    assert exchange.compOrderbooks[1].lays.numOfOrders == 1
+
+    scaling = benchmarkScaling(5, 10, 2, 0.5, operations=50, threadCounts=[1, 2])
+    assert [result['threads'] for result in scaling['scaling']] == [1, 2]
+    assert scaling['scaling'][0]['speedup'] == 1.0
+    assert all(result['ordersPerSecond'] > 0 for result in scaling['scaling'])
+
+
+def test_opinion_lock():
+    bettors = [Agent_Opinionated_Random(id, 'bettor', 100, 90, 1, 0.2 + id / 10, 1.0, 0, 1) for id in range(2)]
+    conversation = LocalConversation(0, bettors[1], bettors[0], 0, 'BC')
+    assert bettors[0].in_conversation == 1 and bettors[1].in_conversation == 1
+
+    # the end of a conversation waits for an agent changing its own local opinion, and uses the change
+    with bettors[0].opinion_lock:
+        thread = threading.Thread(target=conversation.change_local_opinions)
+        thread.start()
+        thread.join(0.1)
+        assert thread.is_alive()
+        bettors[0].local_opinion = 0.4
+    thread.join()
+    assert abs(bettors[1].local_opinion - (mu * 0.3 + (1 - mu) * 0.4)) < 1e-9
+    assert abs(bettors[0].local_opinion - (mu * 0.4 + (1 - mu) * 0.3)) < 1e-9
+    conversation.set_in_conversation(0)
+    assert bettors[0].in_conversation == 0 and bettors[1].in_conversation == 0
+
+
+class UncheckedFillOrKillExchange(Exchange):
+    # trades what it can of a fill-or-kill order instead of rejecting it
+    def fillable(self, order, orderbook):
+        return True
+
+
+def test_differential_harness():
+    assert firstDivergence(generateSteps(0, 300), tickLadderExchange) is None
+
+    seed, steps, description = stressTest(lambda: UncheckedFillOrKillExchange(0, 2, maxOrdersPerAgent=2),
+                                          numOfOrders=2000, sequenceLength=200)
+    assert len(steps) == 2
+    assert steps[1][0] == 'order' and steps[1][7] == FILL_OR_KILL
+    assert description.startswith('tape of competitor')
+
+
+def test_conflating_queue():
+    exchange = Exchange(21, NUM_OF_COMPETITORS)
+    agentQ = ConflatingQueue(1)
+    orderTime = time.time()
+    agentQ.putMarkets(21, exchange.publishMarketState(orderTime))
+    assert agentQ.latestMarkets()[21] is exchange.snapshot
+    exchange.processOrder(orderTime, Order(21, 1, 0, 'Back', 2.5, 10, 0, orderTime))
+    exchange.processOrder(orderTime, Order(21, 2, 1, 'Back', 2.5, 10, 0, orderTime))
+    agentQ.put(raceUpdate(1, {0: 5.0}))
+    for agentId, competitorId in [(3, 0), (4, 1), (5, 1)]:
+        orders = [Order(21, agentId, competitorId, 'Lay', 2.5, 2, 0, orderTime)]
+        (transactions, markets) = exchange.processOrders(orderTime, orders)
+        agentQ.putMarkets(21, markets)
+        if competitorId == 0:
+            agentQ.put(exchangeUpdate(tuple(transactions), tuple(orders)))
+    # an older snapshot never replaces a newer one
+    agentQ.putMarkets(21, markets)
+
+    # the race update and the agent's own fill are queued in full, the market state is
+    # only the latest, the two before it never having been read
+    assert agentQ.qsize() == 2 and agentQ.numOfConflated == 2
+    assert agentQ.get(block=False).protocolNum == RACE_UPDATE_MSG_NUM
+    fill = agentQ.get(timeout=0.01)
+    assert [transaction['layer'] for transaction in fill.transactions] == [3]
+    assert agentQ.empty()
+    assert agentQ.latestMarkets()[21] is exchange.snapshot
+    assert agentQ.latestMarkets()[21][1]['backs']['market'] == ((2.5, 6),)
+
+    # waiting for a message times out as queue.Queue does, or is woken by the next one
+    try:
+        agentQ.get(timeout=0.01)
+        assert False
+    except queue.Empty:
+        pass
+    threading.Timer(0.01, agentQ.put, args=(raceUpdate(2, {0: 6.0}),)).start()
+    assert agentQ.get(timeout=5).timestep == 2
+
+
+def test_fill_routing():
+    exchange = Exchange(22, NUM_OF_COMPETITORS)
+    orderTime = time.time()
+    exchange.processOrders(orderTime, [Order(22, 1, 0, 'Back', 2.5, 5, 0, orderTime),
+                                       Order(22, 2, 0, 'Back', 2.6, 5, 0, orderTime)])
+    (transactions, markets) = exchange.processOrders(orderTime, [Order(22, 3, 0, 'Lay', 2.6, 8, 0, orderTime)])
+    fills = fillsByAgent(transactions)
+    # only the agents in the trades are sent anything
+    assert sorted(fills) == [1, 2, 3]
+    assert fills[1] == (transactions[0],) and fills[2] == (transactions[1],)
+    assert fills[3] == tuple(transactions)
+
+
 def run_tests():
     # Create set-up
     exchange = Exchange(0, NUM_OF_COMPETITORS)
@@ -138,6 +908,84 @@ def run_tests():
     print("Testing tape recording...")
     test_tape_recording(exchange)
 
+    print("Testing price level book...")
+    test_price_levels(exchange)
+
+    print("Testing tick ladder book...")
+    test_tick_ladder()
+
+    print("Testing market snapshots...")
+    test_market_snapshots()
+
+    print("Testing sweep matching...")
+    test_sweep_matching()
+
+    print("Testing batch order entry...")
+    test_batch_orders()
+
+    print("Testing order ID index...")
+    test_order_id_index()
+
+    print("Testing tape cursors...")
+    test_tape_cursor()
+
+    print("Testing depth deltas...")
+    test_depth_deltas()
+
+    print("Testing net positions...")
+    test_net_positions()
+
+    print("Testing tape writer...")
+    test_tape_writer()
+
+    print("Testing sharded exchange...")
+    test_sharded_exchange()
+
+    print("Testing benchmark suite...")
+    test_benchmarks()
+
+    print("Testing order flow replay...")
+    test_order_flow_replay()
+
+    print("Testing exposure ledger...")
+    test_exposure_ledger()
+
+    print("Testing shared exposure...")
+    test_shared_exposure()
+
+    print("Testing book analytics...")
+    test_book_analytics()
+
+    print("Testing consolidated market...")
+    test_consolidated_market()
+
+    print("Testing time in force...")
+    test_time_in_force()
+
+    print("Testing tape spill...")
+    test_tape_spill()
+
+    print("Testing message types...")
+    test_message_types()
+
+    print("Testing snapshot ring...")
+    test_snapshot_ring()
+
+    print("Testing concurrent exchange...")
+    test_concurrent_exchange()
+
+    print("Testing opinion lock...")
+    test_opinion_lock()
+
+    print("Testing differential harness...")
+    test_differential_harness()
+
+    print("Testing conflating queue...")
+    test_conflating_queue()
+
+    print("Testing fill routing...")
+    test_fill_routing()
+
 
 if __name__ == "__main__":
     run_tests()
@@ -0,0 +1,82 @@
+### ~ THREADED BRISTOL BETTING EXCHANGE ~ ###
+
+# Hierarchical timer wheel, for expiring orders at their time-in-force without
+# keeping them sorted by expiry
+
+from system_constants import TIMER_WHEEL_TICK, TIMER_WHEEL_SLOTS, TIMER_WHEEL_LEVELS
+
+
+class TimerWheel:
+    """
+    Timers held in wheels of slots, the slots of the first wheel are a tick wide and
+    each slot of the next wheel spans a whole turn of the one below. Scheduling is
+    constant time, and a timer is moved down at most once per wheel before it expires.
+    Timers beyond the last wheel wait in its furthest slot until they come in range
+    """
+    def __init__(self, tick=TIMER_WHEEL_TICK, slots=TIMER_WHEEL_SLOTS, levels=TIMER_WHEEL_LEVELS):
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.wheels = [[[] for slot in range(slots)] for level in range(levels)]
+        # ticks up to and including currentTick have been expired
+        self.currentTick = 0
+        self.numOfTimers = 0
+
+    def tickOf(self, time):
+        return int(time // self.tick)
+
+    def schedule(self, time, item):
+        """
+        Expire item once time is reached, at the end of the tick it falls in so it is
+        never early, a time already passed expires at the next advance
+        """
+        self.place(max(-int(-time // self.tick), self.currentTick + 1), item)
+        self.numOfTimers = self.numOfTimers + 1
+
+    def place(self, tick, item):
+        delta = tick - self.currentTick
+        span = 1
+        for level in range(self.levels):
+            if delta < span * self.slots or level == self.levels - 1:
+                slotTick = tick
+                if delta >= span * self.slots:
+                    # too far out for the wheels, wait in the furthest slot and be placed again from there
+                    slotTick = self.currentTick + span * (self.slots - 1)
+                self.wheels[level][(slotTick // span) % self.slots].append((tick, item))
+                return
+            span = span * self.slots
+
+    def advance(self, time):
+        """
+        Move the wheels on to time, returns list of items whose time has been reached
+        """
+        expired = []
+        targetTick = self.tickOf(time)
+        while self.currentTick < targetTick:
+            if self.numOfTimers == 0:
+                self.currentTick = targetTick
+                break
+            self.currentTick = self.currentTick + 1
+            # when a wheel comes round, bring the timers of the next wheel's slot down
+            span = 1
+            for level in range(1, self.levels):
+                span = span * self.slots
+                if self.currentTick % span != 0:
+                    break
+                slot = self.wheels[level][(self.currentTick // span) % self.slots]
+                self.wheels[level][(self.currentTick // span) % self.slots] = []
+                for tick, item in slot:
+                    self.replace(tick, item, expired)
+            slot = self.wheels[0][self.currentTick % self.slots]
+            self.wheels[0][self.currentTick % self.slots] = []
+            for tick, item in slot:
+                self.replace(tick, item, expired)
+        return expired
+
+    def replace(self, tick, item, expired):
+        # expire a timer that is due, otherwise put it back on a lower wheel
+        if tick <= self.currentTick:
+            expired.append(item)
+            self.numOfTimers = self.numOfTimers - 1
+        else:
+            self.place(tick, item)